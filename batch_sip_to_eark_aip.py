@@ -0,0 +1,149 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import logging
+import os
+import sys
+
+from checksum import set_algorithms
+from metrics import DEFAULT_METRICS_PATH, PackageMetrics
+from sip_to_eark_aip import validate_conversion_options, validate_input_directories, process_pool, transform_sip_to_aip, split_options
+from xml_backend import set_backend
+
+
+def find_sips(paths:list) -> list:
+    # Expand the given paths into a list of SIP directories
+    # A directory without a representations directory is treated as a directory of SIPs
+    sip_paths = []
+    for path in paths:
+        if path.is_dir() and not (path / 'representations').is_dir():
+            sip_paths.extend(sorted(p for p in path.iterdir() if p.is_dir()))
+        else:
+            sip_paths.append(path)
+    return sip_paths
+
+
+def convert_sip(sip_path:Path, output_path:Path, options:dict, metrics_options:dict=None) -> tuple[bool, str]:
+    # Convert a single SIP, returning (success, aip name or error)
+    # fatal_error exits via SystemExit, catch it so one bad SIP doesn't stop the batch
+    # The metrics record of every SIP that got as far as the conversion is appended to the metrics file
+    metrics_options = dict(metrics_options or {})
+    metrics_path = metrics_options.pop('metrics_path', DEFAULT_METRICS_PATH)
+    metrics = PackageMetrics(**metrics_options)
+    try:
+        sip_path, output_path, inventory = validate_input_directories(sip_path, output_path)
+        return True, transform_sip_to_aip(sip_path, output_path, metrics=metrics, inventory=inventory, **options)
+    except SystemExit as e:
+        return False, str(e.code)
+    except Exception as e:
+        logging.exception("Converting '%s' failed" % sip_path)
+        return False, "%s: %s" % (type(e).__name__, e)
+    finally:
+        if metrics.record['package'] is not None:
+            metrics.write(metrics_path)
+
+
+def log_result(sip_path:Path, result:tuple[bool, str]):
+    if result[0]:
+        logging.info("Converted '%s' to '%s'" % (sip_path, result[1]))
+    else:
+        logging.error("Failed to convert '%s': %s" % (sip_path, result[1]))
+
+
+def transform_sips(sip_paths:list, output_path:Path, workers:int=None, metrics_options:dict=None, **options) -> dict:
+    # Convert SIPs on a pool of worker processes
+    # options are passed on to transform_sip_to_aip, metrics_options to metrics.PackageMetrics (plus metrics_path)
+    # At most one SIP per worker is submitted, so the SIPs running when a worker process dies are known: the SIP fails if it
+    # was the only one running, otherwise they're converted again one at a time to find the one that did it
+    # Returns {sip path: (success, aip name or error)} in input order
+    workers = workers or os.cpu_count() or 1
+    results = {}
+    queued = deque(sip_paths)
+    # {future: sip path}
+    running = {}
+    # SIPs that were running alongside others when a worker died
+    suspects = set()
+    executor = process_pool(workers)
+    try:
+        while queued or running:
+            while queued and len(running) < workers and not (running and (queued[0] in suspects or suspects.intersection(running.values()))):
+                sip_path = queued.popleft()
+                running[executor.submit(convert_sip, sip_path, output_path, options, metrics_options)] = sip_path
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # Every running conversion fails with the pool, wait for all of them before starting a new one
+                wait(running)
+                done = list(running)
+            crashed = []
+            for future in done:
+                sip_path = running.pop(future)
+                if isinstance(future.exception(), BrokenProcessPool):
+                    crashed.append(sip_path)
+                else:
+                    results[sip_path] = future.result()
+                    log_result(sip_path, results[sip_path])
+            if crashed:
+                executor.shutdown()
+                executor = process_pool(workers)
+                if len(crashed) == 1:
+                    results[crashed[0]] = (False, "The worker process converting it died")
+                    log_result(crashed[0], results[crashed[0]])
+                else:
+                    logging.warning("A worker process died converting one of %s, converting them one at a time" % ', '.join("'%s'" % sip_path for sip_path in crashed))
+                    suspects.update(crashed)
+                    queued.extendleft(reversed(crashed))
+    finally:
+        executor.shutdown()
+    return {sip_path: results[sip_path] for sip_path in sip_paths}
+
+
+def main(argv) -> dict:
+    Path("logs").mkdir(exist_ok=True)
+    logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    argv, options = split_options(argv)
+    if len(argv) < 2:
+        logging.error("Incorrect script call format")
+        sys.exit("Command should have the form:\npython batch_sip_to_eark_aip.py [--workers=N] [--copy=<Strategy>] [--streaming] [--package=<Format>] [--manifest] [--no-resume] [--verify] [--rep-workers=N] [--copy-workers=N] [--dedup=<Store Directory>] [--digests=<Algorithm>,...] [--xml=<Backend>] [--metrics=<Metrics File>] [--profile] [--trace-memory] <SIP Directory>... <Output Directory>")
+
+    # Bad options would otherwise fail every SIP one by one
+    validate_conversion_options(options)
+
+    if 'xml' in options:
+        # process_pool passes the backend on to the worker processes
+        try:
+            set_backend(options['xml'])
+        except ValueError as e:
+            sys.exit('Fatal Error: ' + str(e))
+
+    if 'digests' in options:
+        # Like the XML backend, the algorithms are passed on to the workers
+        try:
+            set_algorithms(str(options['digests']).split(','))
+        except ValueError as e:
+            sys.exit('Fatal Error: ' + str(e))
+
+    workers = int(options.get('workers', os.cpu_count()))
+    sip_paths = find_sips([Path(arg) for arg in argv[:-1]])
+    output_path = Path(argv[-1])
+
+    metrics_options = {
+        'metrics_path': options.get('metrics', DEFAULT_METRICS_PATH),
+        'profile': bool(options.get('profile')),
+        'trace_memory': bool(options.get('trace-memory')),
+    }
+
+    return transform_sips(sip_paths, output_path, workers, metrics_options, copy_strategy=options.get('copy', 'copy'), streaming=bool(options.get('streaming')), manifest=bool(options.get('manifest')),
+                          resume=not options.get('no-resume'), verify=bool(options.get('verify')), package_format=options.get('package'),
+                          rep_workers=int(options.get('rep-workers', 1)),
+                          copy_workers=int(options['copy-workers']) if 'copy-workers' in options else None,
+                          dedup_path=Path(options['dedup']) if 'dedup' in options else None)
+
+
+if __name__ == '__main__':
+    results = main(sys.argv[1:])
+    for sip_path, (success, message) in results.items():
+        print("%s\t%s\t%s" % (sip_path, 'OK' if success else 'FAILED', message))
+    if not all(success for success, _ in results.values()):
+        sys.exit(1)
@@ -0,0 +1,146 @@
+from datetime import datetime
+from pathlib import Path
+import json
+import platform
+import statistics
+import shutil
+import sys
+import tempfile
+import time
+
+from checksum import hash_files
+from file_copy import DEFAULT_COPY_WORKERS
+from sip_to_eark_aip import SOFTWARE_VERSION, copy_sip_to_aip, transform_representations, update_rep_mets, update_root_mets, require_values, split_options
+from synthetic_sip import create_synthetic_sip, create_preservation_payload
+from xml_backend import DEFAULT_BACKEND, set_backend
+import create_preservation_mets
+
+
+# Time each stage of the SIP to AIP conversion on synthetic SIPs
+# Results are written as JSON so runs can be compared across releases
+
+DEFAULT_PARAMETERS = {
+    'representations': 2,
+    'mets_files': 1000,
+    'payload_files': 100,
+    'payload_size': 64 * 1024,
+    'preservation_format': 'zip',
+    'preservation_files': 100,
+    'preservation_file_size': 64 * 1024,
+    'copy_strategy': 'copy',
+    'copy_workers': DEFAULT_COPY_WORKERS,
+    'streaming': False,
+    'xml_backend': DEFAULT_BACKEND,
+}
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = {}
+
+    def time(self, stage:str, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.timings[stage] = time.perf_counter() - start
+        return result
+
+
+def run_benchmark(work_path:Path, parameters:dict, seed:int=0) -> dict:
+    # Run every stage once on a freshly generated SIP and return the stage timings in seconds
+    sip_path = create_synthetic_sip((work_path / 'sip'), parameters['representations'], parameters['mets_files'],
+                                    parameters['payload_files'], parameters['payload_size'], seed)
+    aip_path = (work_path / 'aip')
+    aip_path.mkdir()
+    set_backend(parameters['xml_backend'])
+    timer = StageTimer()
+
+    timer.time('copy', copy_sip_to_aip, sip_path, aip_path, parameters['copy_strategy'], workers=parameters['copy_workers'])
+    timer.time('transform_representations', transform_representations, aip_path)
+    timer.time('update_rep_mets', update_rep_mets, aip_path, parameters['streaming'])
+    timer.time('update_root_mets', update_root_mets, aip_path, parameters['streaming'])
+
+    files = [path for path in aip_path.rglob('*') if path.is_file()]
+    timer.time('checksum', hash_files, files)
+    timer.timings['checksum_bytes'] = sum(path.stat().st_size for path in files)
+
+    preservation_paths = sorted((aip_path / 'representations').glob('*-preservation'))
+    for index, rep_path in enumerate(preservation_paths):
+        create_preservation_payload(rep_path, parameters['preservation_format'], parameters['preservation_files'],
+                                    parameters['preservation_file_size'], seed + index)
+    timer.timings['preservation_mets'] = 0.0
+    for rep_path in preservation_paths:
+        timer.time('preservation_validate', create_preservation_mets.validate_input_directory, rep_path)
+        timer.time('preservation_create_mets', create_preservation_mets.create_preservation_mets, rep_path)
+        timer.time('preservation_update_root_mets', create_preservation_mets.update_root_mets, rep_path)
+        timer.timings['preservation_mets'] += sum(timer.timings[stage] for stage in ['preservation_validate', 'preservation_create_mets', 'preservation_update_root_mets'])
+    for stage in ['preservation_validate', 'preservation_create_mets', 'preservation_update_root_mets']:
+        timer.timings.pop(stage, None)
+
+    return timer.timings
+
+
+def summarize(runs:list) -> dict:
+    summary = {}
+    for stage in runs[0]:
+        values = [run[stage] for run in runs]
+        summary[stage] = {'min': min(values), 'median': statistics.median(values), 'max': max(values)}
+    return summary
+
+
+def compare(results:dict, baseline:dict) -> dict:
+    # Ratio of median stage times, above 1 is slower than the baseline
+    ratios = {}
+    for stage, values in results['summary'].items():
+        if stage.endswith('_bytes') or stage not in baseline['summary'] or not baseline['summary'][stage]['median']:
+            continue
+        ratios[stage] = values['median'] / baseline['summary'][stage]['median']
+    return ratios
+
+
+def main(argv) -> dict:
+    argv, options = split_options(argv)
+    if len(argv) != 1:
+        sys.exit("Command should have the form:\npython benchmark.py [--repeat=N] [--compare=<Results File>] [--work-dir=<Directory>] [--<parameter>=<value>]... <Results File>\n"
+                 "Parameters: " + ', '.join('%s (default %s)' % (name.replace('_', '-'), value) for name, value in DEFAULT_PARAMETERS.items()))
+
+    require_values(options, ['repeat', 'compare', 'work-dir'] + [name.replace('_', '-') for name, value in DEFAULT_PARAMETERS.items() if not isinstance(value, bool)])
+
+    parameters = dict(DEFAULT_PARAMETERS)
+    for name, value in options.items():
+        name = name.replace('-', '_')
+        if name in parameters:
+            parameters[name] = type(DEFAULT_PARAMETERS[name])(value) if not isinstance(DEFAULT_PARAMETERS[name], bool) else value in (True, 'true', '1')
+
+    runs = []
+    for repeat in range(int(options.get('repeat', 1))):
+        work_path = Path(tempfile.mkdtemp(prefix='sip_to_eark_aip_benchmark_', dir=options.get('work-dir')))
+        try:
+            runs.append(run_benchmark(work_path, parameters, seed=repeat))
+        finally:
+            shutil.rmtree(work_path)
+
+    results = {
+        'software_version': SOFTWARE_VERSION,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        'parameters': parameters,
+        'runs': runs,
+        'summary': summarize(runs),
+    }
+    if 'compare' in options:
+        with open(options['compare']) as f:
+            results['comparison'] = compare(results, json.load(f))
+
+    with open(argv[0], 'w') as f:
+        json.dump(results, f, indent=4)
+    return results
+
+
+if __name__ == '__main__':
+    results = main(sys.argv[1:])
+    for stage, values in results['summary'].items():
+        line = "%-30s %12d" % (stage, values['median']) if stage.endswith('_bytes') else "%-30s %12.4f" % (stage, values['median'])
+        if stage in results.get('comparison', {}):
+            line += "  x%.2f" % results['comparison'][stage]
+        print(line)
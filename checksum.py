@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import mmap
+import os
+import threading
+
+
+# Read size for hashing - large reads keep syscall overhead low on big files
+BUFFER_SIZE = 1024 * 1024
+
+# hashlib algorithm: METS CHECKSUMTYPE, the algorithms files can be digested with
+METS_CHECKSUM_TYPES = {
+    'md5': 'MD5',
+    'sha1': 'SHA-1',
+    'sha256': 'SHA-256',
+    'sha384': 'SHA-384',
+    'sha512': 'SHA-512',
+}
+# METS CHECKSUMTYPE: hashlib algorithm
+CHECKSUM_ALGORITHMS = {checksum_type: algorithm for algorithm, checksum_type in METS_CHECKSUM_TYPES.items()}
+
+# The first algorithm is used for METS checksums, every algorithm gets a manifest
+DEFAULT_ALGORITHMS = ['sha256']
+_algorithms = list(DEFAULT_ALGORITHMS)
+
+# Buffers are reused per thread instead of allocating a new bytes object per read
+_buffers = threading.local()
+
+
+def _get_buffer(buffer_size:int) -> memoryview:
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = memoryview(bytearray(buffer_size))
+        _buffers.buffer = buffer
+    return buffer
+
+
+def set_algorithms(algorithms:list):
+    # Set the digests computed for every file, e.g. ['sha256', 'md5', 'sha512']
+    # Set before process pools are started, sip_to_eark_aip.process_pool passes them on to its workers
+    global _algorithms
+    if not algorithms or any(algorithm not in METS_CHECKSUM_TYPES for algorithm in algorithms):
+        raise ValueError("Digest algorithms must be some of: " + ', '.join(METS_CHECKSUM_TYPES))
+    _algorithms = list(dict.fromkeys(algorithms))
+
+
+def get_algorithms() -> list:
+    return list(_algorithms)
+
+
+def mets_algorithm() -> str:
+    # Algorithm of the CHECKSUM attributes written to METS
+    return _algorithms[0]
+
+
+class MultiHash:
+    # hashlib-like object computing several digests of the same data, so it's only read once
+    def __init__(self, algorithms:list=None):
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in (algorithms if algorithms is not None else get_algorithms())}
+
+    def update(self, data):
+        for file_hash in self.hashes.values():
+            file_hash.update(data)
+
+    def hexdigests(self) -> dict:
+        return {algorithm: file_hash.hexdigest() for algorithm, file_hash in self.hashes.items()}
+
+
+def hash_bytes(data:bytes, algorithms:list=None) -> dict:
+    # Returns {algorithm: hex digest} of data, all the set algorithms by default
+    data_hash = MultiHash(algorithms)
+    data_hash.update(data)
+    return data_hash.hexdigests()
+
+
+def hash_file_digests(file:Path, algorithms:list=None, buffer_size:int=BUFFER_SIZE) -> dict:
+    # Digest a file with every algorithm in one read, all the set algorithms by default
+    # Returns {algorithm: hex digest}
+    if algorithms is None:
+        algorithms = get_algorithms()
+    if len(algorithms) == 1:
+        return {algorithms[0]: hash_file(file, algorithms[0], buffer_size)}
+    file_hash = MultiHash(algorithms)
+    with open(file, 'rb', buffering=0) as f:
+        buffer = _get_buffer(buffer_size)
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            file_hash.update(buffer[:read])
+    return file_hash.hexdigests()
+
+
+def hash_file(file:Path, algorithm:str='sha256', buffer_size:int=BUFFER_SIZE, use_mmap:bool=False) -> str:
+    # Hash a file and return the hex digest
+    # use_mmap hashes the mapped file in one call, otherwise read into a reusable buffer
+    file_hash = hashlib.new(algorithm)
+    with open(file, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap and size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                file_hash.update(mapped)
+            return file_hash.hexdigest()
+        buffer = _get_buffer(buffer_size)
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            file_hash.update(buffer[:read])
+    return file_hash.hexdigest()
+
+
+def hash_files(files:list, algorithm:str='sha256', workers:int=None, use_mmap:bool=False) -> dict:
+    # Hash many files on a thread pool, hashlib releases the GIL while hashing
+    # Returns {file: hex digest} in input order
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(lambda file: hash_file(file, algorithm, use_mmap=use_mmap), files)
+        return dict(zip(files, digests))
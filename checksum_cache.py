@@ -0,0 +1,99 @@
+from pathlib import Path
+import logging
+import os
+import sqlite3
+import time
+
+from checksum import hash_file_digests
+
+
+DEFAULT_CACHE_PATH = Path('cache') / 'checksums.sqlite'
+DEFAULT_MAX_ENTRIES = 100000
+
+
+class ChecksumCache:
+    # On-disk cache of file checksums keyed by device, inode, size and mtime
+    # A file is only re-hashed if it changed since it was last hashed, or if verify is set
+
+    def __init__(self, cache_path:Path=DEFAULT_CACHE_PATH, max_entries:int=DEFAULT_MAX_ENTRIES, verify:bool=False):
+        cache_path = Path(cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.verify = verify
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS checksums (
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                algorithm TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (device, inode, algorithm)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get_checksum(self, file:Path, algorithm:str='sha256') -> str:
+        return self.get_digests(file, [algorithm])[algorithm]
+
+    def get_digests(self, file:Path, algorithms:list) -> dict:
+        # Returns {algorithm: hex digest}, the digests that aren't cached are computed in one read of the file
+        stat = os.stat(file)
+        cached = {}
+        for algorithm in algorithms:
+            key = (stat.st_dev, stat.st_ino, algorithm)
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, checksum FROM checksums WHERE device = ? AND inode = ? AND algorithm = ?", key).fetchone()
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                cached[algorithm] = row[2]
+
+        if len(cached) == len(algorithms) and not self.verify:
+            for algorithm in algorithms:
+                self.connection.execute(
+                    "UPDATE checksums SET last_used = ? WHERE device = ? AND inode = ? AND algorithm = ?", (time.time(), stat.st_dev, stat.st_ino, algorithm))
+            self.connection.commit()
+            logging.debug("Checksum cache hit for '%s'" % file)
+            return cached
+
+        digests = hash_file_digests(file, algorithms if self.verify else [algorithm for algorithm in algorithms if algorithm not in cached])
+        for algorithm, checksum in digests.items():
+            if cached.get(algorithm, checksum) != checksum:
+                logging.warning("Checksum of '%s' changed without its size or mtime changing" % file)
+            self.store(stat, algorithm, checksum)
+        return {algorithm: digests.get(algorithm, cached.get(algorithm)) for algorithm in algorithms}
+
+    def add(self, file:Path, checksum:str, algorithm:str='sha256'):
+        # Store a checksum computed elsewhere, e.g. while the file was written
+        self.store(os.stat(file), algorithm, checksum)
+
+    def add_digests(self, file:Path, digests:dict):
+        # Store {algorithm: hex digest} computed elsewhere
+        stat = os.stat(file)
+        for algorithm, checksum in digests.items():
+            self.store(stat, algorithm, checksum)
+
+    def store(self, stat:os.stat_result, algorithm:str, checksum:str):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (stat.st_dev, stat.st_ino, algorithm, stat.st_size, stat.st_mtime_ns, checksum, time.time()))
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        # Remove least recently used entries above max_entries
+        count = self.connection.execute("SELECT COUNT(*) FROM checksums").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM checksums WHERE rowid IN (SELECT rowid FROM checksums ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,))
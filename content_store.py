@@ -0,0 +1,196 @@
+from pathlib import Path
+import errno
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from checksum import hash_file_digests
+from file_copy import hardlink_file, hash_copy_file, reflink_file
+
+
+# Content-addressed store of payload files on the output volume, shared by the AIPs written there
+# Every distinct file is stored once as objects/<first 2 hex digits>/<rest of the SHA-256> and linked into the AIPs,
+# cloned (reflink) where the filesystem supports it and hardlinked otherwise
+# index.sqlite keeps how often each object was linked across runs, for the stats
+
+OBJECTS_DIRECTORY = 'objects'
+INDEX_NAME = 'index.sqlite'
+
+
+class ContentStore:
+    # Safe to use from the copy threads, the index is only written by flush
+
+    def __init__(self, store_path:Path):
+        self.store_path = Path(store_path)
+        (self.store_path / OBJECTS_DIRECTORY).mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect((self.store_path / INDEX_NAME), timeout=60)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS objects (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                links INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_linked REAL NOT NULL
+            )""")
+        self.connection.commit()
+        self.reflink = True
+        self.hardlink = True
+        # Sizes of the stored objects, a file of another size can't be in the store
+        self.sizes = {size for size, in self.connection.execute("SELECT DISTINCT size FROM objects")}
+        self.lock = threading.Lock()
+        # {sha256: [size, new links]} since the last flush
+        self.pending = {}
+        # This run: files linked to objects that were stored already, and the bytes they didn't take up
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def object_path(self, sha256:str) -> Path:
+        return (self.store_path / OBJECTS_DIRECTORY / sha256[:2] / sha256[2:])
+
+    def link(self, src:Path, dst:Path, algorithms:list=None) -> tuple[dict, bool]:
+        # Place src at dst through the store, storing it first if its content isn't there yet
+        # src is read once: a file of a size no object has can't be stored already, so it's hashed while it's copied into the
+        # store, other files are hashed first and only copied if their content turns out to be new
+        # Returns the digests of the file and whether it was stored already
+        algorithms = list(dict.fromkeys(['sha256'] + (algorithms or [])))
+        size = os.stat(src).st_size
+        with self.lock:
+            known_size = size in self.sizes
+        if known_size:
+            digests = hash_file_digests(src, algorithms)
+            object_path = self.object_path(digests['sha256'])
+            hit = object_path.is_file() and object_path.stat().st_size == size
+            if not hit:
+                self.store(src, object_path)
+        else:
+            digests, object_path, hit = self.hash_store(src, algorithms)
+        self.link_object(object_path, src, dst)
+        with self.lock:
+            self.sizes.add(size)
+            entry = self.pending.setdefault(digests['sha256'], [size, 0])
+            entry[1] += 1
+            if hit:
+                self.hits += 1
+                self.saved_bytes += size
+            else:
+                self.misses += 1
+        return digests, hit
+
+    def temporary_path(self, directory:Path) -> Path:
+        directory.mkdir(exist_ok=True)
+        return (directory / ('.tmp-' + str(uuid.uuid4())))
+
+    def store(self, src:Path, object_path:Path):
+        # Written under a temporary name and renamed, a concurrent writer of the same content just replaces it
+        # Objects are read-only, a hardlinked AIP file must never be changed in place
+        temporary_path = self.temporary_path(object_path.parent)
+        try:
+            shutil.copy2(src, temporary_path)
+            os.chmod(temporary_path, 0o444)
+            os.replace(temporary_path, object_path)
+        except BaseException:
+            temporary_path.unlink(missing_ok=True)
+            raise
+
+    def hash_store(self, src:Path, algorithms:list) -> tuple[dict, Path, bool]:
+        # Copy src into the store hashing it on the way, the object path is only known once it's been read
+        # Returns the digests of src, its object path and whether the object was there already
+        temporary_path = self.temporary_path(self.store_path / OBJECTS_DIRECTORY)
+        try:
+            digests = hash_copy_file(src, temporary_path, algorithms)
+            object_path = self.object_path(digests['sha256'])
+            if object_path.is_file() and object_path.stat().st_size == os.stat(temporary_path).st_size:
+                temporary_path.unlink()
+                return digests, object_path, True
+            object_path.parent.mkdir(exist_ok=True)
+            os.chmod(temporary_path, 0o444)
+            os.replace(temporary_path, object_path)
+            return digests, object_path, False
+        except BaseException:
+            temporary_path.unlink(missing_ok=True)
+            raise
+
+    def link_object(self, object_path:Path, src:Path, dst:Path):
+        # A clone gets the metadata of src like a copy, a hardlink shares the object's
+        if self.reflink:
+            try:
+                reflink_file(object_path, dst)
+                shutil.copystat(src, dst)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.ENOTTY, errno.EINVAL, errno.EPERM):
+                    raise
+                logging.info("Content store '%s' can't be cloned from, hardlinking instead: %s" % (self.store_path, e))
+                self.reflink = False
+        if self.hardlink:
+            try:
+                hardlink_file(object_path, dst)
+                return
+            except OSError as e:
+                if e.errno == errno.EMLINK:
+                    # The object has as many links as the filesystem allows, later links go to a new replica of it
+                    logging.info("Object '%s' reached the link limit, replacing it with a new replica" % object_path)
+                    self.store(object_path, object_path)
+                    try:
+                        hardlink_file(object_path, dst)
+                        return
+                    except OSError as e:
+                        if e.errno != errno.EMLINK:
+                            raise
+                elif e.errno in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP):
+                    logging.warning("Content store '%s' can't be linked from, copying instead: %s" % (self.store_path, e))
+                    self.hardlink = False
+                else:
+                    raise
+        # The files are stored but not deduplicated
+        shutil.copyfile(object_path, dst)
+        shutil.copystat(src, dst)
+
+    def flush(self):
+        # Record the links made since the last flush in the index, in one transaction
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO objects VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (sha256) DO UPDATE SET links = links + excluded.links, last_linked = excluded.last_linked""",
+                [(sha256, size, links, now, now) for sha256, (size, links) in pending.items()])
+
+    def stats(self) -> dict:
+        # Totals over every run, stored bytes are what the objects take up, saved bytes what further links would have copied
+        objects, stored_bytes, links, saved_bytes = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(links), 0), COALESCE(SUM(size * (links - 1)), 0) FROM objects").fetchone()
+        return {'objects': objects, 'stored_bytes': stored_bytes, 'links': links, 'saved_bytes': saved_bytes}
+
+
+def main(argv) -> dict:
+    if len(argv) != 1:
+        sys.exit("Command should have the form:\npython content_store.py <Store Directory>")
+    store_path = Path(argv[0])
+    if not (store_path / INDEX_NAME).is_file():
+        sys.exit('Fatal Error: ' + str(store_path) + " is not a content store")
+    with ContentStore(store_path) as store:
+        return store.stats()
+
+
+if __name__ == '__main__':
+    stats = main(sys.argv[1:])
+    for name, value in stats.items():
+        print("%s\t%d" % (name, value))
@@ -1,82 +1,108 @@
 import mimetypes
-import xml.etree.ElementTree as ET
 import logging
+import os
 import sys
 from pathlib import Path
-from pyunpack import Archive
-#import os
-import shutil
 
-from sip_to_eark_aip import extract_namespaces, get_checksum, new_uuid, date_time_now
+from checksum import METS_CHECKSUM_TYPES, hash_file_digests, mets_algorithm, set_algorithms
+from checksum_cache import ChecksumCache, DEFAULT_CACHE_PATH
+from manifest import Manifest, load_manifest
+from metrics import DEFAULT_METRICS_PATH, PackageMetrics
+from sip_to_eark_aip import extract_namespaces, get_checksum, new_uuid, date_time_now, process_pool, require_values, split_options
+from xml_backend import get_backend, set_backend
+from zip_check import check_zip_file
+from zip_transcode import transcode_7z_to_zip
 
 
-def update_root_mets(rep_path:Path):
-    root_path = rep_path.parents[1]
+def update_root_mets(rep_path:Path, manifest:Manifest=None) -> int:
+    # With a manifest the rep METS checksum is taken from it and the new root METS checksum recorded in it
+    # Returns the number of elements in the updated root METS
+    return update_root_mets_reps(rep_path.parents[1], [rep_path], manifest)
+
+
+def update_root_mets_reps(root_path:Path, rep_paths:list, manifest:Manifest=None) -> int:
+    # Add a file group and div for each preservation rep to the root METS, which is rewritten once for all of them
+    # Returns the number of elements in the updated root METS
     root_mets = (root_path / 'METS.xml')
     if not root_mets.exists() or not root_mets.is_file():
         fatal_error("Root METS.xml file not found")
     namespaces = extract_namespaces(root_mets)
-    tree = ET.parse(root_mets)
+    xml = get_backend()
+    tree = xml.parse(root_mets)
     mets_element = tree.getroot()
 
     # File Section
     fileSec_element = mets_element.find('{%s}fileSec' % namespaces[''])
 
-    # Remove any file group with the same USE attribute - for re-running script
-    marked_for_remove = []
-    for fileGrp_element in fileSec_element.findall('{%s}fileGrp' % namespaces['']):
-        if fileGrp_element.get('USE') == (rep_path.relative_to(root_path)):
-            marked_for_remove.append(fileGrp_element)
-    for fileGrp in marked_for_remove:
-        fileSec_element.remove(fileGrp)
-
-    rep_mets_path = (rep_path / 'METS.xml')
-
-    # New File Group
-    fileGrp_id = new_uuid()
-    fileGrp_element = ET.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
-        'ID': fileGrp_id,
-        'USE': str(rep_path.relative_to(root_path))
-    })
-    file_id = new_uuid('ID')
-    # Fix potential depreciated mimetype
-    file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
-    if file_mimetype == "application/x-zip-compressed": 
-        file_mimetype = "application/zip"
-    file_element = ET.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
-        'ID': file_id,
-        'MIMETYPE': file_mimetype,
-        'SIZE': str(rep_mets_path.stat().st_size),
-        'CREATED': date_time_now(),
-        'CHECKSUM': get_checksum(rep_mets_path),
-        'CHECKSUMTYPE': 'SHA-256'
-    })
-    ET.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
-        '{%s}type' % namespaces['xlink']: 'simple',
-        '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
-        '{%s}LOCTYPE' % namespaces['']: 'URL',
-    })
-
     # Struct Map
     structmap_element = mets_element.find('{%s}structMap' % namespaces[''])
     structmap_element.set('ID', new_uuid())
-
     root_div_element = structmap_element.find('{%s}div' % namespaces[''])
-    # New Div
-    div_element = ET.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
-        'ID': new_uuid(),
-        'LABEL': str(rep_path.relative_to(root_path))
-    })
-    ET.SubElement(div_element, '{%s}mptr' % namespaces[''], attrib={
-        '{%s}type' % namespaces['xlink']: 'simple',
-        '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
-        '{%s}title' % namespaces['xlink']: fileGrp_id,
-        '{%s}LOCTYPE' % namespaces['']: 'URL',
-    })
-    ET.indent(tree, space='    ', level=0)
-    tree.write(root_mets, encoding='utf-8', xml_declaration=True)
 
-def create_preservation_mets(rep_path:Path):
+    rep_names = {str(rep_path.relative_to(root_path)) for rep_path in rep_paths}
+
+    # Remove any file group with the same USE attribute and div with the same LABEL - for re-running script
+    for fileGrp_element in fileSec_element.findall('{%s}fileGrp' % namespaces['']):
+        if fileGrp_element.get('USE') in rep_names:
+            fileSec_element.remove(fileGrp_element)
+    for div_element in root_div_element.findall('{%s}div' % namespaces['']):
+        if div_element.get('LABEL') in rep_names:
+            root_div_element.remove(div_element)
+
+    for rep_path in rep_paths:
+        rep_mets_path = (rep_path / 'METS.xml')
+
+        # New File Group
+        fileGrp_id = new_uuid()
+        fileGrp_element = xml.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
+            'ID': fileGrp_id,
+            'USE': str(rep_path.relative_to(root_path))
+        })
+        file_id = new_uuid('ID')
+        # Fix potential depreciated mimetype
+        file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
+        if file_mimetype == "application/x-zip-compressed": 
+            file_mimetype = "application/zip"
+        file_element = xml.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
+            'ID': file_id,
+            'MIMETYPE': file_mimetype,
+            'SIZE': str(rep_mets_path.stat().st_size),
+            'CREATED': date_time_now(),
+            'CHECKSUM': (manifest.get(rep_mets_path, mets_algorithm()) if manifest is not None else None) or get_checksum(rep_mets_path),
+            'CHECKSUMTYPE': METS_CHECKSUM_TYPES[mets_algorithm()]
+        })
+        xml.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
+            '{%s}type' % namespaces['xlink']: 'simple',
+            '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
+            '{%s}LOCTYPE' % namespaces['']: 'URL',
+        })
+
+        # New Div
+        div_element = xml.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
+            'ID': new_uuid(),
+            'LABEL': str(rep_path.relative_to(root_path))
+        })
+        xml.SubElement(div_element, '{%s}mptr' % namespaces[''], attrib={
+            '{%s}type' % namespaces['xlink']: 'simple',
+            '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
+            '{%s}title' % namespaces['xlink']: fileGrp_id,
+            '{%s}LOCTYPE' % namespaces['']: 'URL',
+        })
+    xml.indent(tree)
+    xml.write(tree, root_mets, namespaces)
+    if manifest is not None:
+        manifest.set(root_mets, hash_file_digests(root_mets, manifest.algorithms))
+    return sum(1 for _ in mets_element.iter())
+
+def preservation_algorithms(manifest:Manifest=None) -> list:
+    # Digests needed of a preservation file, for its METS and the manifest
+    return list(dict.fromkeys([mets_algorithm()] + (manifest.algorithms if manifest is not None else [])))
+
+
+def create_preservation_mets(rep_path:Path, checksum_cache:ChecksumCache=None, manifest:Manifest=None) -> int:
+    # The preservation file digests are taken from the manifest, then the checksum cache, the missing ones computed in one read
+    # The preservation file and new METS digests are recorded in the manifest
+    # Returns the number of elements in the new METS
 
     # Use non-preservation rep mets as a template
     np_rep_mets_path = (rep_path.parent / rep_path.stem.replace('-preservation', '') / 'METS.xml')
@@ -87,7 +113,13 @@ def create_preservation_mets(rep_path:Path):
     namespaces = extract_namespaces(np_rep_mets_path)
 
     # Parse mets
-    tree = ET.parse(np_rep_mets_path) 
+    xml = get_backend()
+    tree = xml.parse(np_rep_mets_path)
+
+    preservation_file_digests = dict((manifest.get_digests(preservation_file_path) if manifest is not None else None) or {})
+    missing = [algorithm for algorithm in preservation_algorithms(manifest) if not preservation_file_digests.get(algorithm)]
+    if missing:
+        preservation_file_digests.update(checksum_cache.get_digests(preservation_file_path, missing) if checksum_cache is not None else hash_file_digests(preservation_file_path, missing))
 
     # Mets Element
     mets_element = tree.getroot()
@@ -100,11 +132,14 @@ def create_preservation_mets(rep_path:Path):
     metsHdr_element.set('RECORDSTATUS', 'NEW')
 
     # Remove all amdSecs
+    # Removed elements are cleared first, lxml would otherwise keep their whole subtree valid on its own
     for amdSec_element in mets_element.findall('{%s}amdSec' % namespaces['']):
+        amdSec_element.clear()
         mets_element.remove(amdSec_element)
         
     # Remove all dmdSecs
     for dmdSec_element in mets_element.findall('{%s}dmdSec' % namespaces['']):
+        dmdSec_element.clear()
         mets_element.remove(dmdSec_element)
 
     # File Section - should only be one
@@ -113,10 +148,11 @@ def create_preservation_mets(rep_path:Path):
 
     # Remove all File Groups
     for fileGrp_element in fileSec_element.findall('{%s}fileGrp' % namespaces['']):
+        fileGrp_element.clear()
         fileSec_element.remove(fileGrp_element)
 
     # Create new FileGroup and File Elements
-    fileGrp_element = ET.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
+    fileGrp_element = xml.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
         'ID': new_uuid(),
         'USE': 'data'
     })
@@ -125,15 +161,15 @@ def create_preservation_mets(rep_path:Path):
     file_mimetype = str(mimetypes.guess_type(preservation_file_path)[0])
     if file_mimetype == "application/x-zip-compressed": 
         file_mimetype = "application/zip"
-    file_element = ET.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
+    file_element = xml.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
         'ID': file_id,
         'MIMETYPE': file_mimetype,
         'SIZE': str(preservation_file_path.stat().st_size),
         'CREATED': date_time_now(),
-        'CHECKSUM': get_checksum(preservation_file_path),
-        'CHECKSUMTYPE': 'SHA-256'
+        'CHECKSUM': preservation_file_digests[mets_algorithm()],
+        'CHECKSUMTYPE': METS_CHECKSUM_TYPES[mets_algorithm()]
     })
-    ET.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
+    xml.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
         '{%s}type' % namespaces['xlink']: 'simple',
         '{%s}href' % namespaces['xlink']: str(preservation_file_path.relative_to(rep_path)),
         '{%s}LOCTYPE' % namespaces['']: 'URL',
@@ -149,19 +185,24 @@ def create_preservation_mets(rep_path:Path):
 
     # Remove all sub divs
     for sub_div_element in root_div_element.findall('{%s}div' % namespaces['']):
+        sub_div_element.clear()
         root_div_element.remove(sub_div_element)
 
     # Add data sub div
-    sub_div_element = ET.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
+    sub_div_element = xml.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
         'LABEL': 'data',
         'ID': new_uuid()
     })
-    ET.SubElement(sub_div_element, '{%s}fptr' % namespaces[''], attrib={
+    xml.SubElement(sub_div_element, '{%s}fptr' % namespaces[''], attrib={
         'FILEID': file_id
     })
 
-    ET.indent(tree, space='    ', level=0)
-    tree.write((rep_path / 'METS.xml'), encoding='utf-8', xml_declaration=True)
+    xml.indent(tree)
+    xml.write(tree, (rep_path / 'METS.xml'), namespaces)
+    if manifest is not None:
+        manifest.set(preservation_file_path, preservation_file_digests)
+        manifest.set((rep_path / 'METS.xml'), hash_file_digests((rep_path / 'METS.xml'), manifest.algorithms))
+    return sum(1 for _ in mets_element.iter())
 
 
 def fatal_error(error:str):
@@ -170,22 +211,36 @@ def fatal_error(error:str):
     sys.exit('Fatal Error: '+ error)
 
 
-def convert_7z_to_zip(file_path: Path):
-    # Get the path and filename of the input 7z file
-    
-    unarchived_dir = (file_path.parent / file_path.stem)
-    unarchived_dir.mkdir()
-    
-    Archive(file_path).extractall(unarchived_dir)
-    
-    shutil.make_archive(unarchived_dir, 'zip', unarchived_dir)
+def convert_7z_to_zip(file_path: Path, store_compressed:bool=False, algorithms:list=None) -> dict:
+    # Transcode the 7z straight into a zip next to it, without extracting it
+    # The 7z is only removed once the zip is complete under its final name
+    # Returns the digests of the zip
+    zip_path = file_path.with_suffix('.zip')
+    digests = transcode_7z_to_zip(file_path, zip_path, store_compressed, algorithms=algorithms)
     
-    # Remove the extracted folder and original 7z
-    shutil.rmtree(unarchived_dir)
+    # Remove the original 7z
     file_path.unlink()
+    return digests
         
 
-def validate_input_directory(rep_path:Path):
+def check_preservation_zip(zip_path:Path, checksum_cache:ChecksumCache=None, manifest:Manifest=None):
+    # Check the central directory and the CRC of every member, the digests computed in the same read are recorded
+    # in the checksum cache and manifest so create_preservation_mets doesn't read the zip again
+    report = check_zip_file(zip_path, preservation_algorithms(manifest))
+    for error in report['errors']:
+        logging.error("'%s'%s: %s" % (zip_path, '' if error['member'] is None else " member '%s'" % error['member'], error['error']))
+    if report['errors']:
+        first = report['errors'][0]
+        fatal_error("Preservation zip %s is corrupt, %d errors, first: %s%s" % (zip_path, len(report['errors']), '' if first['member'] is None else first['member'] + ': ', first['error']))
+    if report['unchecked']:
+        logging.warning("'%s': %d encrypted members not checked" % (zip_path, report['unchecked']))
+    if checksum_cache is not None:
+        checksum_cache.add_digests(zip_path, report['digests'])
+    if manifest is not None:
+        manifest.set(zip_path, report['digests'])
+
+
+def validate_input_directory(rep_path:Path, checksum_cache:ChecksumCache=None, store_compressed:bool=False, manifest:Manifest=None, check_zip:bool=False):
     # Rep must exists
     if not rep_path.exists():
         fatal_error(str(rep_path) + " not found")
@@ -205,31 +260,151 @@ def validate_input_directory(rep_path:Path):
         fatal_error('Preservation representaion data directory should contain a single zip file')
     
     # Convert 7z to zip
-    if preservation_files[0].suffix == '.7z':
+    transcoded = preservation_files[0].suffix == '.7z'
+    if transcoded:
         logging.info("7zip")
-        convert_7z_to_zip(preservation_files[0])
+        digests = convert_7z_to_zip(preservation_files[0], store_compressed, preservation_algorithms(manifest))
+        # Zip was hashed while it was written
+        if checksum_cache is not None:
+            checksum_cache.add_digests(preservation_files[0].with_suffix('.zip'), digests)
+        if manifest is not None:
+            manifest.rename(preservation_files[0], preservation_files[0].with_suffix('.zip'))
+            manifest.set(preservation_files[0].with_suffix('.zip'), digests)
         
     if len(preservation_files) != 1:
         fatal_error('Preservation representaion data directory should contain a single zip file - error in 7z zip conversion')
         
     if [Path(f) for f in (rep_path / 'data').iterdir()][0].suffix != '.zip':
         fatal_error('Preservation file should be a zip')
+
+    # A zip just written from the 7z doesn't need checking
+    if check_zip and not transcoded:
+        check_preservation_zip(preservation_files[0], checksum_cache, manifest)
     
     return rep_path
 
 
+def prepare_preservation_rep(rep_path:Path, cache_path:Path=DEFAULT_CACHE_PATH, verify:bool=False, store_compressed:bool=False, manifest:Manifest=None, check_zip:bool=False) -> tuple[int, dict]:
+    # Validate one preservation rep and create its METS, run on the create_all_preservation_mets process pool
+    # Returns the number of elements in the new METS and the manifest entries of the rep
+    with ChecksumCache(cache_path, verify=verify) as checksum_cache:
+        validate_input_directory(rep_path, checksum_cache, store_compressed, manifest, check_zip)
+        element_count = create_preservation_mets(rep_path, checksum_cache, manifest)
+    if manifest is None:
+        return element_count, None
+    prefix = manifest.key(rep_path) + '/'
+    return element_count, {key: checksum for key, checksum in manifest.checksums.items() if key.startswith(prefix)}
+
+
+def create_all_preservation_mets(aip_path:Path, cache_path:Path=DEFAULT_CACHE_PATH, verify:bool=False, store_compressed:bool=False, manifest:Manifest=None, workers:int=None, check_zip:bool=False) -> dict:
+    # Validate and create the METS of every *-preservation rep of the AIP, concurrently on a pool of worker processes (one per CPU by default)
+    # Add them to the root METS afterwards with update_root_mets_reps, so it's only rewritten once
+    # Returns {rep path: number of elements in its METS} in rep order
+    rep_paths = sorted(rep_path for rep_path in (aip_path / 'representations').iterdir() if rep_path.is_dir() and rep_path.name.endswith('-preservation'))
+    if not rep_paths:
+        fatal_error("No preservation reps found in " + str(aip_path / 'representations'))
+
+    if workers is None:
+        # CPUs this process may run on
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    workers = min(workers, len(rep_paths))
+    arguments = ([cache_path] * len(rep_paths), [verify] * len(rep_paths), [store_compressed] * len(rep_paths), [manifest] * len(rep_paths), [check_zip] * len(rep_paths))
+    if workers > 1:
+        with process_pool(workers) as executor:
+            results = list(executor.map(prepare_preservation_rep, rep_paths, *arguments))
+    else:
+        results = list(map(prepare_preservation_rep, rep_paths, *arguments))
+
+    element_counts = {}
+    for rep_path, (element_count, checksums) in zip(rep_paths, results):
+        logging.info(rep_path)
+        element_counts[rep_path] = element_count
+        if manifest is not None:
+            # Workers update a copy of the manifest, replace the rep's entries with theirs
+            prefix = manifest.key(rep_path) + '/'
+            for key in [key for key in manifest.checksums if key.startswith(prefix)]:
+                del manifest.checksums[key]
+            manifest.checksums.update(checksums)
+
+    return element_counts
+
+
+def create_aip_preservation_mets(aip_path:Path, options:dict):
+    # Every preservation rep of the AIP in one run, the root METS is updated once
+    metrics = PackageMetrics(profile=bool(options.get('profile')), trace_memory=bool(options.get('trace-memory')))
+    metrics.record['package'] = aip_path.resolve().name
+    # Keep the AIP manifest up to date if the AIP has one
+    manifest = load_manifest(aip_path.resolve())
+    metrics.start()
+    try:
+        with metrics.stage('create_preservation_mets') as stage:
+            element_counts = create_all_preservation_mets(aip_path, options.get('cache', DEFAULT_CACHE_PATH), bool(options.get('verify')), bool(options.get('store-compressed')), manifest,
+                                                          int(options['workers']) if 'workers' in options else None, bool(options.get('check-zip')))
+            stage['files'] = len(element_counts)
+            stage['mets_elements'] = sum(element_counts.values())
+        with metrics.stage('update_root_mets') as stage:
+            stage['mets_elements'] = update_root_mets_reps(aip_path, list(element_counts), manifest)
+            stage['files'] = 1
+        if manifest is not None:
+            # Entries the AIP's manifests don't all have
+            manifest.hash_missing()
+            manifest.write()
+    finally:
+        metrics.finish()
+        metrics.write(options.get('metrics', DEFAULT_METRICS_PATH))
+
+
 def main(argv):
     Path("logs").mkdir(exist_ok=True)
     logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
+    argv, options = split_options(argv)
     if len(argv) != 1:
         logging.error("Incorrect script call format")
-        sys.exit("Command should have the form:\npython create_preservation_mets.py <Rep Directory>")
-    
-    rep_path = validate_input_directory(Path(argv[0]))
-    logging.info(rep_path)
-    create_preservation_mets(rep_path)
-    update_root_mets(rep_path)
+        sys.exit("Command should have the form:\npython create_preservation_mets.py [--verify] [--cache=<Cache File>] [--store-compressed] [--check-zip] [--workers=N] [--digests=<Algorithm>,...] [--xml=<Backend>] [--metrics=<Metrics File>] [--profile] [--trace-memory] <Rep Directory>|<AIP Directory>")
+    require_values(options, ['cache', 'workers', 'digests', 'xml', 'metrics'])
+
+    if 'xml' in options:
+        try:
+            set_backend(options['xml'])
+        except ValueError as e:
+            fatal_error(str(e))
+
+    if 'digests' in options:
+        try:
+            set_algorithms(str(options['digests']).split(','))
+        except ValueError as e:
+            fatal_error(str(e))
+
+    rep_path = Path(argv[0])
+    if (rep_path / 'representations').is_dir():
+        return create_aip_preservation_mets(rep_path, options)
+
+    metrics = PackageMetrics(profile=bool(options.get('profile')), trace_memory=bool(options.get('trace-memory')))
+    metrics.record['package'] = rep_path.resolve().parents[1].name
+    # Keep the AIP manifest up to date if the AIP has one
+    manifest = load_manifest(rep_path.resolve().parents[1])
+    metrics.record['representation'] = rep_path.name
+    metrics.start()
+    try:
+        with ChecksumCache(options.get('cache', DEFAULT_CACHE_PATH), verify=bool(options.get('verify'))) as checksum_cache:
+            with metrics.stage('validate') as stage:
+                rep_path = validate_input_directory(rep_path, checksum_cache, bool(options.get('store-compressed')), manifest, bool(options.get('check-zip')))
+                stage['files'] = 1
+            logging.info(rep_path)
+            with metrics.stage('create_preservation_mets') as stage:
+                stage['mets_elements'] = create_preservation_mets(rep_path, checksum_cache, manifest)
+                stage['files'] = 1
+        with metrics.stage('update_root_mets') as stage:
+            stage['mets_elements'] = update_root_mets(rep_path, manifest)
+            stage['files'] = 1
+        if manifest is not None:
+            # Entries the AIP's manifests don't all have
+            manifest.hash_missing()
+            manifest.write()
+    finally:
+        metrics.finish()
+        metrics.write(options.get('metrics', DEFAULT_METRICS_PATH))
 
 
 if __name__ == '__main__':
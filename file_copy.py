@@ -0,0 +1,288 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+import errno
+import logging
+import os
+import queue
+import shutil
+import threading
+import uuid
+
+from checksum import BUFFER_SIZE, MultiHash, hash_file_digests
+from inventory import Inventory
+from journal import Journal
+from manifest import Manifest
+
+if TYPE_CHECKING:
+    # content_store imports this module
+    from content_store import ContentStore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ioctl request number for cloning a file (Linux FICLONE)
+FICLONE = 0x40049409
+
+COPY_STRATEGIES = ['auto', 'copy', 'reflink', 'hardlink', 'kernel']
+
+# Buffers in flight between the reader thread and the hashing/writing thread of hash_copy_file
+PIPELINE_BUFFERS = 4
+
+# Threads copying files in copy_tree, mostly waiting on the filesystem so more than the number of CPUs
+DEFAULT_COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+def reflink_file(src:Path, dst:Path):
+    # Clone file extents (XFS/Btrfs), the new file shares blocks copy-on-write
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported on this platform")
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            Path(dst).unlink()
+            raise
+    shutil.copystat(src, dst)
+
+
+def hardlink_file(src:Path, dst:Path):
+    # Link to the same inode - only safe for files that are never rewritten
+    os.link(src, dst)
+
+
+def kernel_copy_file(src:Path, dst:Path):
+    # Copy inside the kernel with copy_file_range, falling back to sendfile
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        size = os.fstat(src_file.fileno()).st_size
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    sent = os.copy_file_range(src_file.fileno(), dst_file.fileno(), size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        while copied < size:
+            sent = os.sendfile(dst_file.fileno(), src_file.fileno(), copied, size - copied)
+            if sent == 0:
+                break
+            copied += sent
+    shutil.copystat(src, dst)
+
+
+def hash_copy_file(src:Path, dst:Path, algorithms:list=None, buffer_size:int=BUFFER_SIZE) -> dict:
+    # Copy a file and hash it with every algorithm in the same pass, so it's only read once
+    # A reader thread fills a bounded set of buffers while this thread hashes and writes them
+    # Returns {algorithm: hex digest}, all the set algorithms by default
+    file_hash = MultiHash(algorithms)
+    with open(src, 'rb', buffering=0) as src_file, open(dst, 'wb') as dst_file:
+        if os.fstat(src_file.fileno()).st_size <= buffer_size:
+            data = src_file.read()
+            file_hash.update(data)
+            dst_file.write(data)
+        else:
+            free, filled = queue.Queue(), queue.Queue()
+            for _ in range(PIPELINE_BUFFERS):
+                free.put(bytearray(buffer_size))
+
+            def read():
+                try:
+                    while True:
+                        buffer = free.get()
+                        if buffer is None:
+                            return
+                        read = src_file.readinto(buffer)
+                        filled.put((buffer, read))
+                        if not read:
+                            return
+                except BaseException as e:
+                    filled.put((e, 0))
+
+            reader = threading.Thread(target=read, daemon=True)
+            reader.start()
+            try:
+                while True:
+                    buffer, read = filled.get()
+                    if isinstance(buffer, BaseException):
+                        raise buffer
+                    if not read:
+                        break
+                    data = memoryview(buffer)[:read]
+                    file_hash.update(data)
+                    dst_file.write(data)
+                    data.release()
+                    free.put(buffer)
+            finally:
+                # Stop the reader if writing failed
+                free.put(None)
+                reader.join()
+    shutil.copystat(src, dst)
+    return file_hash.hexdigests()
+
+
+COPY_FUNCTIONS = {
+    'copy': shutil.copy2,
+    'reflink': reflink_file,
+    'hardlink': hardlink_file,
+    'kernel': kernel_copy_file,
+}
+
+
+def is_rewritten(relative_path:Path) -> bool:
+    # METS and metadata files are rewritten after copying so must be real copies
+    return relative_path.name == 'METS.xml' or relative_path.parts[0] == 'metadata'
+
+
+def detect_copy_strategy(src_file:Path, dst_dir:Path) -> str:
+    # Probe whether the filesystems can clone src_file into dst_dir. A clone shares the extents, and an unsupported one fails
+    # before any data is copied, so probing with a real file of any size costs no data I/O
+    # Otherwise use copy_file_range where the platform has it. It can't be probed without copying data, and kernel_copy_file
+    # falls back to sendfile where it fails
+    probe_path = (dst_dir / ('.probe-' + str(uuid.uuid4())))
+    try:
+        reflink_file(src_file, probe_path)
+        return 'reflink'
+    except OSError:
+        pass
+    finally:
+        probe_path.unlink(missing_ok=True)
+    return 'kernel' if hasattr(os, 'copy_file_range') else 'copy'
+
+
+def copy_file(src:Path, dst:Path, strategy:str, algorithms:list=None) -> dict:
+    # Returns the digests of the file {algorithm: hex digest} if algorithms are given
+    if not algorithms:
+        COPY_FUNCTIONS[strategy](src, dst)
+        return None
+    if strategy == 'copy':
+        return hash_copy_file(src, dst, algorithms)
+    COPY_FUNCTIONS[strategy](src, dst)
+    return hash_file_digests(dst, algorithms)
+
+
+def walk_tree(src_path:Path, dst_path:Path, inventory:Inventory=None) -> tuple:
+    # Every directory and file under src_path with its destination, in a single walk or from the inventory of src_path
+    # Top level directories are placed at their stem, like the SIP was always copied, and symlinks are followed like shutil.copytree does
+    # Returns ([(src dir, dst dir)], [(src file, dst file)]), directories parents first
+    directories, files = [], []
+    if inventory is not None:
+        for relative_path, entry in inventory.entries.items():
+            parts = relative_path.split('/')
+            if len(parts) > 1 or entry['type'] == 'directory':
+                parts[0] = Path(parts[0]).stem
+            (directories if entry['type'] == 'directory' else files).append(((src_path / relative_path), dst_path.joinpath(*parts)))
+        return directories, files
+    for file_folder in sorted(src_path.iterdir()):
+        if not file_folder.is_dir():
+            files.append((file_folder, (dst_path / file_folder.name)))
+            continue
+        folder_dst = (dst_path / file_folder.stem)
+        for root, dir_names, file_names in os.walk(file_folder, followlinks=True):
+            dir_names.sort()
+            dst_root = folder_dst.joinpath(Path(root).relative_to(file_folder))
+            directories.append((Path(root), dst_root))
+            for name in sorted(file_names):
+                files.append(((Path(root) / name), (dst_root / name)))
+    return directories, files
+
+
+def copy_tree(src_path:Path, dst_path:Path, strategy:str='copy', manifest:Manifest=None, journal:Journal=None, workers:int=None, inventory:Inventory=None, store:'ContentStore'=None) -> tuple:
+    # Copy the contents of src_path into dst_path using the given strategy
+    # The directories are created first, then the files are copied on a pool of threads, which hides the per-file open and
+    # metadata latency when there are many small files. Files and directories keep their metadata like shutil.copytree with copy2
+    # With a manifest the digests of every file are recorded - copied files are hashed while they are copied,
+    # files that are cloned or linked are hashed once afterwards since their data wasn't read
+    # With a journal every copied file is journaled, and files a resumed journal already has are skipped ('resumed')
+    # With an inventory of src_path the tree isn't walked, and file sizes and modification times are taken from it
+    # With a content store the files that aren't rewritten are linked from it instead of copied,
+    # 'dedup' if their content was in the store already and 'stored' if it was added
+    # Returns the number of files copied with each strategy and the number of bytes copied
+    if strategy not in COPY_STRATEGIES:
+        raise ValueError("Unknown copy strategy '%s'" % strategy)
+    directories, files = walk_tree(src_path, dst_path, inventory)
+    if strategy == 'auto':
+        src_file = next((src for src, _ in files if not is_rewritten(src.relative_to(src_path))), None)
+        strategy = detect_copy_strategy(src_file, dst_path) if src_file is not None else 'copy'
+        logging.info("Detected copy strategy '%s'" % strategy)
+    if workers is None:
+        workers = DEFAULT_COPY_WORKERS
+
+    used = {}
+    copied_bytes = 0
+    lock = threading.Lock()
+    algorithms = manifest.algorithms if manifest is not None else None
+
+    def copy_function(src, dst):
+        nonlocal strategy, copied_bytes
+        src_entry = inventory.get(Path(src).relative_to(src_path).as_posix()) if inventory is not None else None
+        if journal is not None:
+            relative_path = Path(dst).relative_to(dst_path)
+            entry = journal.copied_file(relative_path, src, dst, src_entry)
+            if entry is not None:
+                checksums = entry.get('checksums') or (hash_file_digests(dst, algorithms) if manifest is not None else None)
+                with lock:
+                    if manifest is not None:
+                        manifest.set(dst, checksums)
+                    used['resumed'] = used.get('resumed', 0) + 1
+                return dst
+            if journal.resumed:
+                # Never write through a partial copy, it may be a hardlink to the SIP file
+                Path(dst).unlink(missing_ok=True)
+        rewritten = is_rewritten(Path(src).relative_to(src_path))
+        file_strategy = 'copy' if rewritten else strategy
+        if store is not None and not rewritten:
+            digests, hit = store.link(src, dst, algorithms)
+            file_strategy = 'dedup' if hit else 'stored'
+            checksums = {algorithm: digests[algorithm] for algorithm in algorithms} if manifest is not None else None
+        else:
+            try:
+                checksums = copy_file(src, dst, file_strategy, algorithms)
+            except OSError as e:
+                if file_strategy == 'copy':
+                    raise
+                logging.warning("Copy strategy '%s' failed for '%s', falling back to copy: %s" % (file_strategy, src, e))
+                # The filesystem doesn't support the strategy, don't retry it for every file
+                if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.ENOTTY, errno.EINVAL, errno.EPERM):
+                    strategy = 'copy'
+                file_strategy = 'copy'
+                checksums = copy_file(src, dst, file_strategy, algorithms)
+        size = src_entry['size'] if src_entry is not None else os.stat(dst).st_size
+        if journal is not None:
+            journal.add_copied(relative_path, Path(src).relative_to(src_path), src, checksums, src_entry)
+        with lock:
+            if manifest is not None:
+                manifest.set(dst, checksums)
+            used[file_strategy] = used.get(file_strategy, 0) + 1
+            copied_bytes += size
+        return dst
+
+    for _, dst_dir in directories:
+        os.makedirs(dst_dir, exist_ok=True)
+
+    if workers == 1 or len(files) < 2:
+        for src, dst in files:
+            copy_function(src, dst)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for _ in executor.map(copy_function, *zip(*files)):
+                    pass
+            except BaseException:
+                # Don't go on copying the rest of the files after a failure
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    # Copying files into a directory changes its modification time, so directory metadata is copied last, children first
+    for src_dir, dst_dir in reversed(directories):
+        shutil.copystat(src_dir, dst_dir)
+
+    logging.info("Copied '%s' to '%s': %s, %d bytes" % (src_path, dst_path, ', '.join("%s=%d" % (k, v) for k, v in sorted(used.items())), copied_bytes))
+    return used, copied_bytes
@@ -0,0 +1,79 @@
+from pathlib import Path
+import json
+import os
+
+
+# In-memory index of a SIP, built with one os.scandir walk and one stat per file or directory
+# The conversion stages take paths, types, sizes and modification times from it instead of asking the filesystem again,
+# which is a round trip for every call on NFS
+
+
+class Inventory:
+    # Entries keyed by their POSIX path relative to root_path, parents before their children and in directory order
+    # Every entry is {'type': 'file' or 'directory', 'size', 'mtime_ns'}, the root itself has no entry
+
+    def __init__(self, root_path:Path, entries:dict=None):
+        self.root_path = Path(root_path)
+        self.entries = entries if entries is not None else {}
+        self.child_names = {'': []}
+        for relative_path in self.entries:
+            parent, _, name = relative_path.rpartition('/')
+            self.child_names.setdefault(parent, []).append(name)
+            if self.entries[relative_path]['type'] == 'directory':
+                self.child_names.setdefault(relative_path, [])
+
+    def get(self, relative_path:str) -> dict:
+        # Returns None if there's nothing at relative_path
+        return self.entries.get(relative_path)
+
+    def is_dir(self, relative_path:str) -> bool:
+        return relative_path == '' or self.entries.get(relative_path, {}).get('type') == 'directory'
+
+    def is_file(self, relative_path:str) -> bool:
+        return self.entries.get(relative_path, {}).get('type') == 'file'
+
+    def children(self, relative_path:str='') -> list:
+        # Names in the directory at relative_path, in directory order
+        return list(self.child_names.get(relative_path, []))
+
+    def walk(self, relative_path:str=''):
+        # Like os.walk, yields (directory, directory names, file names) with directory relative to the root
+        # Sorting or removing directory names in place changes which directories are walked next and in what order
+        directory_names, file_names = [], []
+        for name in self.children(relative_path):
+            (directory_names if self.is_dir(join(relative_path, name)) else file_names).append(name)
+        yield relative_path, directory_names, file_names
+        for name in directory_names:
+            yield from self.walk(join(relative_path, name))
+
+    def files(self) -> list:
+        return [relative_path for relative_path, entry in self.entries.items() if entry['type'] == 'file']
+
+    def write(self, path:Path):
+        # JSON dump for debugging
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'root': str(self.root_path), 'entries': self.entries}, f, indent=4)
+
+
+def join(relative_path:str, name:str) -> str:
+    return relative_path + '/' + name if relative_path else name
+
+
+def scan_inventory(root_path:Path) -> Inventory:
+    # Symlinks are followed, like shutil.copytree does when the SIP is copied
+    entries = {}
+
+    def scan(directory:str, relative_path:str):
+        with os.scandir(directory) as it:
+            for dir_entry in it:
+                entry_path = join(relative_path, dir_entry.name)
+                stat = dir_entry.stat()
+                if dir_entry.is_dir():
+                    entries[entry_path] = {'type': 'directory', 'size': 0, 'mtime_ns': stat.st_mtime_ns}
+                    scan(dir_entry.path, entry_path)
+                else:
+                    entries[entry_path] = {'type': 'file', 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    scan(root_path, '')
+    return Inventory(root_path, entries)
+
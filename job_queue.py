@@ -0,0 +1,153 @@
+from contextlib import contextmanager
+from pathlib import Path
+import os
+import socket
+import sqlite3
+import time
+
+
+# Queue of conversion jobs in an SQLite database on a volume shared by the ingest hosts
+# Workers on any host claim jobs in a write transaction, so a job is only ever running on one worker,
+# and keep a heartbeat on the jobs they run. Jobs whose worker stopped heartbeating are queued again
+# The database keeps the default rollback journal: WAL needs shared memory, which only works for processes on the same host
+# Heartbeats are compared with the clock of the host requeuing, the hosts' clocks are expected to be synchronised
+
+JOB_KINDS = ['aip', 'preservation']
+JOB_STATES = ['queued', 'running', 'done', 'failed']
+DEFAULT_HEARTBEAT_TIMEOUT = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def worker_name() -> str:
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class JobQueue:
+    # A job is {'id', 'kind', 'path', 'output', 'state', 'worker', 'claim', 'attempts', 'heartbeat', 'queued', 'started', 'finished', 'result'}
+    # kind 'aip' converts the SIP at path into the output directory, 'preservation' creates the preservation METS of the AIP at path
+    # claim numbers every claim of the job, a worker only updates a job while its claim is the current one
+    # attempts counts the claims since the job was queued, failed jobs that are queued again start over
+    # now is the clock for queued, started, finished and heartbeat times, and for finding stale jobs
+
+    def __init__(self, queue_path:Path, now=time.time):
+        self.queue_path = Path(queue_path)
+        self.now = now
+        # Transactions are begun explicitly, claims need BEGIN IMMEDIATE to take the write lock before reading
+        self.connection = sqlite3.connect(self.queue_path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                path TEXT NOT NULL,
+                output TEXT NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                claim INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                heartbeat REAL,
+                queued REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                result TEXT,
+                UNIQUE (kind, path, output)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def add(self, kind:str, path:Path, output_path:Path=None) -> bool:
+        # Paths are stored resolved, so every host finds the same SIP on the shared volume
+        # Returns False if the job is in the queue already, whatever its state
+        if kind not in JOB_KINDS:
+            raise ValueError("Job kind must be one of: " + ', '.join(JOB_KINDS))
+        with self.transaction():
+            cursor = self.connection.execute("INSERT OR IGNORE INTO jobs (kind, path, output, state, queued) VALUES (?, ?, ?, 'queued', ?)",
+                                             (kind, str(Path(path).resolve()), str(Path(output_path).resolve()) if output_path is not None else '', self.now()))
+        return cursor.rowcount == 1
+
+    def claim(self, worker:str) -> dict:
+        # Take the oldest queued job, returns None if there isn't one
+        with self.transaction():
+            row = self.connection.execute("SELECT id FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            now = self.now()
+            self.connection.execute("UPDATE jobs SET state = 'running', worker = ?, claim = claim + 1, attempts = attempts + 1, heartbeat = ?, started = ?, finished = NULL, result = NULL WHERE id = ?",
+                                    (worker, now, now, row['id']))
+            return dict(self.connection.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone())
+
+    def heartbeat(self, jobs:list) -> list:
+        # Renew the claims on jobs, returns the ones that were taken from the worker in the meantime
+        lost = []
+        with self.transaction():
+            now = self.now()
+            for job in jobs:
+                cursor = self.connection.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND claim = ? AND state = 'running'", (now, job['id'], job['claim']))
+                if cursor.rowcount == 0:
+                    lost.append(job)
+        return lost
+
+    def finish(self, job:dict, success:bool, result:str) -> bool:
+        # Returns False if the job was taken from the worker, its result is dropped then
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE jobs SET state = ?, finished = ?, result = ? WHERE id = ? AND claim = ? AND state = 'running'",
+                                             ('done' if success else 'failed', self.now(), result, job['id'], job['claim']))
+        return cursor.rowcount == 1
+
+    def release(self, job:dict) -> bool:
+        # Queue a job the worker won't run after all, without counting its claim as an attempt
+        # Returns False if the job was taken from the worker already
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE jobs SET state = 'queued', worker = NULL, attempts = attempts - 1 WHERE id = ? AND claim = ? AND state = 'running'",
+                                             (job['id'], job['claim']))
+        return cursor.rowcount == 1
+
+    def requeue_stale(self, timeout:float=DEFAULT_HEARTBEAT_TIMEOUT, max_attempts:int=DEFAULT_MAX_ATTEMPTS) -> list:
+        # Queue the running jobs that haven't had a heartbeat for timeout seconds again,
+        # or fail them once they've been claimed max_attempts times, so a SIP that brings its worker down isn't retried forever
+        # Returns the jobs requeued or failed
+        with self.transaction():
+            now = self.now()
+            stale = [dict(row) for row in self.connection.execute("SELECT * FROM jobs WHERE state = 'running' AND heartbeat < ?", (now - timeout,))]
+            for job in stale:
+                if job['attempts'] >= max_attempts:
+                    self.connection.execute("UPDATE jobs SET state = 'failed', finished = ?, result = ? WHERE id = ?",
+                                            (now, "Worker '%s' stopped heartbeating, %d attempts" % (job['worker'], job['attempts']), job['id']))
+                else:
+                    self.connection.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE id = ?", (job['id'],))
+        return stale
+
+    def requeue_failed(self) -> int:
+        # Queue the failed jobs again with their attempts reset, returns how many there were
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE jobs SET state = 'queued', worker = NULL, attempts = 0, finished = NULL WHERE state = 'failed'")
+        return cursor.rowcount
+
+    def counts(self) -> dict:
+        # Number of jobs in each state
+        counts = dict.fromkeys(JOB_STATES, 0)
+        counts.update(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return counts
+
+    def jobs(self, state:str=None) -> list:
+        if state is None:
+            return [dict(row) for row in self.connection.execute("SELECT * FROM jobs ORDER BY id")]
+        return [dict(row) for row in self.connection.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,))]
@@ -0,0 +1,250 @@
+from pathlib import Path
+import json
+import logging
+import os
+import threading
+
+from checksum import hash_file_digests
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Journal of an unfinished SIP to AIP conversion, kept next to the AIP in the output directory
+# The conversion holds an exclusive lock on its journal until it's done, so an AIP is only resumed once its conversion has stopped
+JOURNAL_SUFFIX = '.journal'
+
+
+class JournalLockedError(Exception):
+    # The journal is locked by a conversion that is still running
+    pass
+
+
+def lock_file(file) -> bool:
+    # Take an exclusive lock on an open file without waiting, False if another process holds it
+    # The lock is released when the file is closed, or by the kernel when the process dies
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def open_locked(path:Path):
+    # Open a journal for appending with its lock held, None if another process holds the lock
+    # or the journal was removed while the lock was waited for
+    try:
+        # Not created if it's gone
+        file = open(os.open(path, os.O_WRONLY | os.O_APPEND), 'a', encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    try:
+        if lock_file(file) and os.path.samestat(os.stat(path), os.fstat(file.fileno())):
+            return file
+    except FileNotFoundError:
+        pass
+    file.close()
+    return None
+
+
+class Journal:
+    # Append-only record of the stages completed and the files copied and updated so far
+    # One JSON object per line, a line cut short by a crash is ignored when the journal is read back
+
+    def __init__(self, journal_path:Path, sip_path:Path, aip_name:str, verify:bool=False, file=None):
+        # file is the journal opened for appending with its lock held
+        self.journal_path = journal_path
+        self.sip_path = sip_path
+        self.aip_name = aip_name
+        self.verify = verify
+        self.resumed = False
+        self.stages = set()
+        self.copied = {}
+        self.updated = {}
+        self.renames = None
+        self.file = file
+        # Files are journaled from the copy threads
+        self.lock = threading.Lock()
+
+    def read(self):
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning("Ignoring incomplete journal entry in '%s'" % self.journal_path)
+                    continue
+                if 'stage' in entry:
+                    self.stages.add(entry['stage'])
+                elif 'copied' in entry:
+                    self.copied[entry['copied']] = entry
+                elif 'updated' in entry:
+                    self.updated[entry['updated']] = entry
+                elif 'renames' in entry:
+                    self.renames = entry['renames']
+        self.resumed = True
+
+    def append(self, entry:dict, sync:bool=False):
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def is_done(self, stage:str) -> bool:
+        return stage in self.stages
+
+    def done(self, stage:str):
+        self.stages.add(stage)
+        self.append({'stage': stage}, sync=True)
+
+    def add_copied(self, relative_path:Path, sip_relative_path:Path, src:Path, checksums:dict=None, src_entry:dict=None):
+        # Source size and mtime, copies keep the mtime of the source
+        # src_entry is the inventory entry of src, saving a stat
+        if src_entry is None:
+            stat = os.stat(src)
+            src_entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        entry = {'copied': relative_path.as_posix(), 'src': sip_relative_path.as_posix(), 'size': src_entry['size'], 'mtime_ns': src_entry['mtime_ns'], 'checksums': checksums}
+        self.copied[entry['copied']] = entry
+        self.append(entry)
+
+    def copied_file(self, relative_path:Path, src:Path, dst:Path, src_entry:dict=None) -> dict:
+        # Returns the journal entry if dst is a complete copy of src, otherwise None
+        # Verified by size and mtime, and by its digests as well if verify is set and they are known
+        # src_entry is the inventory entry of src, saving a stat
+        entry = self.copied.get(relative_path.as_posix())
+        if entry is None:
+            return None
+        try:
+            if src_entry is None:
+                stat = os.stat(src)
+                src_entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            dst_stat = os.stat(dst)
+        except FileNotFoundError:
+            return None
+        if not (src_entry['size'] == dst_stat.st_size == entry['size'] and src_entry['mtime_ns'] == dst_stat.st_mtime_ns == entry['mtime_ns']):
+            return None
+        if self.verify and entry.get('checksums') and hash_file_digests(dst, list(entry['checksums'])) != entry['checksums']:
+            logging.warning("'%s' doesn't match its journaled checksum, copying it again" % dst)
+            return None
+        return entry
+
+    def add_renames(self, renames:dict):
+        self.renames = renames
+        self.append({'renames': renames}, sync=True)
+
+    def add_updated(self, relative_path:Path, checksums:dict=None):
+        entry = {'updated': relative_path.as_posix(), 'checksums': checksums}
+        self.updated[entry['updated']] = entry
+        self.append(entry)
+
+    def sip_file(self, relative_path:Path) -> Path:
+        # Path in the SIP of a file in the AIP, undoing representation renames
+        parts = list(relative_path.parts)
+        if len(parts) > 1 and parts[0] == 'representations' and self.renames is not None:
+            original_names = {new_name: name for name, new_name in self.renames.items()}
+            parts[1] = original_names.get(parts[1], parts[1])
+        entry = self.copied.get('/'.join(parts))
+        return self.sip_path / entry['src'] if entry is not None else self.sip_path.joinpath(*parts)
+
+    def remove(self):
+        # Removed before the lock is released, a process waiting for it finds the journal gone
+        self.journal_path.unlink(missing_ok=True)
+        self.close()
+
+
+def journal_path(output_path:Path, aip_name:str) -> Path:
+    return (output_path / (aip_name + JOURNAL_SUFFIX))
+
+
+def create_journal(output_path:Path, sip_path:Path, aip_name:str, verify:bool=False) -> Journal:
+    # Create the AIP directory output_path/aip_name and its journal, raises FileExistsError if the directory exists
+    # The journal is written and locked under a temporary name first, so it's never found without its header or its lock,
+    # and the directory is only created once the header is written, so a conversion killed in between can be cleaned up
+    # by remove_abandoned_journals
+    path = journal_path(output_path, aip_name)
+    temporary_path = path.with_name('.' + path.name + '.tmp')
+    file = open(temporary_path, 'x', encoding='utf-8')
+    aip_path = None
+    try:
+        lock_file(file)
+        journal = Journal(path, sip_path, aip_name, verify, file)
+        journal.append({'sip': str(sip_path.resolve()), 'aip': aip_name}, sync=True)
+        (output_path / aip_name).mkdir()
+        aip_path = (output_path / aip_name)
+        os.rename(temporary_path, path)
+    except BaseException:
+        file.close()
+        if aip_path is not None:
+            aip_path.rmdir()
+        temporary_path.unlink(missing_ok=True)
+        raise
+    return journal
+
+
+def read_journal_header(path:Path) -> dict:
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def remove_abandoned_journals(output_path:Path, sip_path:Path):
+    # A conversion killed before its journal was in place leaves the journal under its temporary name and maybe an empty
+    # AIP directory, remove both for sip_path. A temporary journal that's locked is still being created
+    for path in sorted(output_path.glob('.*' + JOURNAL_SUFFIX + '.tmp')):
+        header = read_journal_header(path)
+        if header is None or header.get('sip') != str(sip_path.resolve()):
+            continue
+        file = open_locked(path)
+        if file is None:
+            continue
+        try:
+            # Nothing is copied before the journal is in place, so the directory is left if it isn't empty
+            (output_path / header['aip']).rmdir()
+        except OSError:
+            pass
+        path.unlink()
+        file.close()
+
+
+def find_journal(output_path:Path, sip_path:Path, verify:bool=False) -> Journal:
+    # Journal of an unfinished conversion of sip_path into output_path, None if there isn't one
+    # The journal is returned locked, raises JournalLockedError if the conversion is still running in another process
+    if not output_path.is_dir():
+        return None
+    remove_abandoned_journals(output_path, sip_path)
+    for path in sorted(output_path.glob('*' + JOURNAL_SUFFIX)):
+        header = read_journal_header(path)
+        if header is None or header.get('sip') != str(sip_path.resolve()) or not (output_path / header['aip']).is_dir():
+            continue
+        file = open_locked(path)
+        if file is None:
+            if path.exists():
+                raise JournalLockedError("'%s' is being converted to '%s' by another process" % (sip_path, header['aip']))
+            # Finished while the lock was taken
+            continue
+        journal = Journal(path, sip_path, header['aip'], verify, file)
+        journal.read()
+        return journal
+    return None
+
+
+def unfinished_aips(output_path:Path) -> dict:
+    # {aip name: sip path} of every unfinished conversion in output_path
+    aips = {}
+    for path in sorted(output_path.glob('*' + JOURNAL_SUFFIX)):
+        header = read_journal_header(path)
+        aips[path.name[:-len(JOURNAL_SUFFIX)]] = header.get('sip') if header is not None else None
+    return aips
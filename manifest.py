@@ -0,0 +1,90 @@
+from pathlib import Path
+import os
+import re
+
+from checksum import METS_CHECKSUM_TYPES, get_algorithms, hash_file_digests
+
+
+# Per-file manifests at the root of the AIP in BagIt manifest format, manifest-<algorithm>.txt for each digest algorithm
+MANIFEST_PATTERN = re.compile(r'manifest-([a-z0-9]+)\.txt')
+
+
+def manifest_name(algorithm:str) -> str:
+    return 'manifest-%s.txt' % algorithm
+
+
+class Manifest:
+    # Digests of the files under root_path, keyed by their POSIX path relative to root_path, {key: {algorithm: hex digest}}
+    # Filled in while files are copied or written so they don't have to be read again
+    # algorithms are the digests kept for every file, the set algorithms by default
+
+    def __init__(self, root_path:Path, checksums:dict=None, algorithms:list=None):
+        self.root_path = Path(root_path).absolute()
+        self.checksums = checksums if checksums is not None else {}
+        self.algorithms = algorithms if algorithms is not None else get_algorithms()
+
+    def key(self, path:Path) -> str:
+        # path includes root_path, like every path passed around in the scripts
+        return Path(path).absolute().relative_to(self.root_path).as_posix()
+
+    def get(self, path:Path, algorithm:str=None) -> str:
+        # Digest of the file with algorithm, the first of the manifest's by default
+        # Returns None if the file or its digest isn't in the manifest
+        return self.checksums.get(self.key(path), {}).get(algorithm or self.algorithms[0])
+
+    def get_digests(self, path:Path) -> dict:
+        # {algorithm: hex digest} of the file, None if it isn't in the manifest
+        return self.checksums.get(self.key(path))
+
+    def set(self, path:Path, digests:dict):
+        # digests {algorithm: hex digest}, algorithms missing from it are hashed by hash_missing
+        self.checksums[self.key(path)] = dict(digests) if digests else {}
+
+    def rename(self, old_path:Path, new_path:Path):
+        # Move the entries of a renamed file or directory
+        old_key, new_key = self.key(old_path), self.key(new_path)
+        for key in list(self.checksums):
+            if key == old_key or key.startswith(old_key + '/'):
+                self.checksums[new_key + key[len(old_key):]] = self.checksums.pop(key)
+
+    def hash_missing(self):
+        # Hash the files that are in the manifest without all its digests, the missing digests in one read
+        for key, digests in self.checksums.items():
+            missing = [algorithm for algorithm in self.algorithms if not digests.get(algorithm)]
+            if missing:
+                digests.update(hash_file_digests((self.root_path / key), missing))
+
+    def text(self, algorithm:str=None) -> str:
+        algorithm = algorithm or self.algorithms[0]
+        return ''.join("%s  %s\n" % (self.checksums[key][algorithm], key) for key in sorted(self.checksums) if not MANIFEST_PATTERN.fullmatch(key))
+
+    def write(self) -> list:
+        # Returns the paths of the manifests written, one per algorithm
+        manifest_paths = []
+        for algorithm in self.algorithms:
+            manifest_path = (self.root_path / manifest_name(algorithm))
+            temporary_path = manifest_path.with_name(manifest_path.name + '.tmp')
+            with open(temporary_path, 'w', encoding='utf-8', newline='\n') as f:
+                f.write(self.text(algorithm))
+            os.replace(temporary_path, manifest_path)
+            manifest_paths.append(manifest_path)
+        return manifest_paths
+
+
+def load_manifest(root_path:Path) -> Manifest:
+    # Reads every manifest-<algorithm>.txt, the algorithms in the order they're set and then by name
+    # Returns None if root_path has no manifest
+    if not Path(root_path).is_dir():
+        return None
+    found = [match.group(1) for match in map(MANIFEST_PATTERN.fullmatch, os.listdir(root_path)) if match is not None and match.group(1) in METS_CHECKSUM_TYPES]
+    algorithms = [algorithm for algorithm in get_algorithms() if algorithm in found] + sorted(algorithm for algorithm in found if algorithm not in get_algorithms())
+    if not algorithms:
+        return None
+    checksums = {}
+    for algorithm in algorithms:
+        with open((Path(root_path) / manifest_name(algorithm)), encoding='utf-8') as f:
+            for line in f:
+                checksum, _, key = line.rstrip('\n').partition('  ')
+                if key:
+                    checksums.setdefault(key, {})[algorithm] = checksum
+    return Manifest(root_path, checksums, algorithms)
@@ -0,0 +1,156 @@
+from pathlib import Path
+from xml.parsers import expat
+import os
+
+from checksum import MultiHash
+from xml_rewrite import escape_attrib, escape_cdata
+
+
+# Replace a name in the text and attribute values of an XML document (EAD, PREMIS, DC...) in one streaming pass
+# The document is parsed with expat without building a tree and written out as it's parsed, so memory use doesn't grow with
+# the size of the document. Everything but the start tags is passed through as it was read: text keeps its entity and
+# character references, and comments, processing instructions, CDATA sections and the DOCTYPE are kept.
+# Start tags are written again with their attributes in double quotes, and the output is encoded as UTF-8
+
+# Bytes written to the output at a time
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+XSI_NAMESPACE = 'http://www.w3.org/2001/XMLSchema-instance'
+# xsi attributes pointing at schemas, which like namespace declarations aren't references to the SIP
+SCHEMA_LOCATION_ATTRIBUTES = ('schemaLocation', 'noNamespaceSchemaLocation')
+
+
+class NameReplacer:
+    # expat handlers writing the document with old replaced by new
+    # Raw text is collected until the next tag, so a name split over several expat callbacks is still found
+
+    def __init__(self, file, old:str, new:str, algorithms:list=None):
+        self.file = file
+        self.old, self.new = old, new
+        self.old_text, self.new_text = escape_cdata(old), escape_cdata(new)
+        self.hash = MultiHash(algorithms or [])
+        self.replacements = 0
+        self.depth = 0
+        self.output = []
+        self.output_size = 0
+        self.text = []
+        # {prefix: namespace URI} declared on each open element
+        self.namespaces = []
+        # A start tag is closed with '>' once something follows it, or as an empty element tag at its end
+        self.start_tag_open = False
+
+    def write(self, data:str):
+        if self.start_tag_open:
+            self.start_tag_open = False
+            self.write('>')
+        self.output.append(data)
+        self.output_size += len(data)
+        if self.output_size >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = ''.join(self.output).encode('utf-8')
+        self.hash.update(data)
+        self.file.write(data)
+        self.output = []
+        self.output_size = 0
+
+    def flush_text(self):
+        if not self.text:
+            return
+        text = ''.join(self.text)
+        self.text = []
+        # Outside the root element there's only markup, e.g. the DOCTYPE names the root element
+        if self.depth and self.old_text in text:
+            self.replacements += text.count(self.old_text)
+            text = text.replace(self.old_text, self.new_text)
+        self.write(text)
+
+    def xml_declaration(self, version:str, encoding:str, standalone:int):
+        if version is not None:
+            self.write('<?xml version="%s" encoding="utf-8"%s?>' % (version, '' if standalone == -1 else ' standalone="%s"' % ('yes' if standalone else 'no')))
+
+    def namespace_uri(self, prefix:str) -> str:
+        for declarations in reversed(self.namespaces):
+            if prefix in declarations:
+                return declarations[prefix]
+        return None
+
+    def is_replaced(self, key:str) -> bool:
+        # Only text and ordinary attribute values are rewritten, namespace declarations and schema locations are kept
+        if key == 'xmlns' or key.startswith('xmlns:'):
+            return False
+        prefix, _, local_name = key.rpartition(':')
+        return not (prefix and local_name in SCHEMA_LOCATION_ATTRIBUTES and self.namespace_uri(prefix) == XSI_NAMESPACE)
+
+    def start_element(self, name:str, attributes:list):
+        self.flush_text()
+        self.write('<' + name)
+        # ordered_attributes gives [name, value, name, value...]
+        attributes = list(zip(attributes[::2], attributes[1::2]))
+        self.namespaces.append({key[6:]: value for key, value in attributes if key.startswith('xmlns:')})
+        for key, value in attributes:
+            if self.old in value and self.is_replaced(key):
+                self.replacements += value.count(self.old)
+                value = value.replace(self.old, self.new)
+            self.write(' %s="%s"' % (key, escape_attrib(value)))
+        self.start_tag_open = True
+        self.depth += 1
+
+    def end_element(self, name:str):
+        self.flush_text()
+        self.depth -= 1
+        self.namespaces.pop()
+        if self.start_tag_open:
+            self.start_tag_open = False
+            self.write('/>')
+        else:
+            self.write('</%s>' % name)
+
+    def default(self, data:str):
+        self.text.append(data)
+
+    def close(self):
+        self.flush_text()
+        self.flush()
+
+
+def replace_name_stream(source_file, destination_file, old:str, new:str, algorithms:list=None) -> tuple[int, dict]:
+    # Write the document read from the binary file source_file to destination_file with old replaced by new
+    # Returns the number of replacements and the digests of the document written with algorithms
+    replacer = NameReplacer(destination_file, old, new, algorithms)
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    # Attributes defaulted by the DTD aren't added to the start tags
+    parser.specified_attributes = True
+    parser.XmlDeclHandler = replacer.xml_declaration
+    parser.StartElementHandler = replacer.start_element
+    parser.EndElementHandler = replacer.end_element
+    # Text, comments, processing instructions and the DOCTYPE as they are in the document, entities aren't expanded
+    parser.DefaultHandler = replacer.default
+    parser.ParseFile(source_file)
+    replacer.close()
+    return replacer.replacements, replacer.hash.hexdigests()
+
+
+def replace_name(source:Path, destination:Path, old:str, new:str, algorithms:list=None) -> tuple[int, dict]:
+    # Write the document at source to destination with old replaced by new
+    # Returns the number of replacements and the digests of destination with algorithms
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        return replace_name_stream(source_file, destination_file, old, new, algorithms)
+
+
+def replace_name_in_file(path:Path, old:str, new:str, algorithms:list=None) -> tuple[int, dict]:
+    # Replace old by new in the document at path through a temporary file
+    # A document without old is left untouched, the digests are None then
+    # Returns the number of replacements and the digests of the rewritten file with algorithms
+    temporary_path = path.with_name(path.name + '.tmp')
+    try:
+        replacements, digests = replace_name(path, temporary_path, old, new, algorithms)
+        if not replacements:
+            return 0, None
+        os.replace(temporary_path, path)
+        return replacements, digests
+    finally:
+        if temporary_path.exists():
+            temporary_path.unlink()
@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from pathlib import Path
+import cProfile
+import json
+import logging
+import resource
+import time
+import tracemalloc
+
+
+DEFAULT_METRICS_PATH = Path('logs') / 'metrics.jsonl'
+
+
+def read_io_counters() -> dict:
+    # Bytes read and written by this process through system calls (Linux only)
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return {'bytes_read': int(counters['rchar']), 'bytes_written': int(counters['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def cpu_time() -> float:
+    # CPU time of this process and of the child processes it waited for, e.g. a finished process pool
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def process_peak_rss() -> int:
+    # Peak resident set size of the process in bytes (ru_maxrss is in KiB on Linux)
+    # It's the peak over the process's whole life, not of one package or stage: a pool worker reports the
+    # largest package it has converted so far, and a stage reports the peak of the stages before it too
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PackageMetrics:
+    # Per stage wall/CPU time, I/O and memory of converting one package, emitted as one JSON record
+    # profile captures a cProfile of the whole package, trace_memory records Python peak memory per stage,
+    # the only memory figure that is per stage, process_peak_rss is the peak of the whole process so far
+
+    def __init__(self, profile:bool=False, trace_memory:bool=False):
+        self.record = {'package': None, 'stages': {}}
+        self.profiler = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        self.started = None
+
+    def start(self):
+        self.started = (time.perf_counter(), cpu_time(), read_io_counters())
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name:str):
+        # Yields a dict the caller can add stage counts to, e.g. files or METS elements
+        stage = {}
+        wall_start, cpu_start, io_start = time.perf_counter(), cpu_time(), read_io_counters()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        try:
+            yield stage
+        except BaseException:
+            stage['failed'] = True
+            raise
+        finally:
+            stage['wall_time'] = time.perf_counter() - wall_start
+            stage['cpu_time'] = cpu_time() - cpu_start
+            io_end = read_io_counters()
+            for key in io_end:
+                stage[key] = io_end[key] - io_start[key]
+            stage['process_peak_rss'] = process_peak_rss()
+            if tracemalloc.is_tracing():
+                stage['python_peak_memory'] = tracemalloc.get_traced_memory()[1]
+            self.record['stages'][name] = stage
+
+    def finish(self) -> dict:
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if self.started is not None:
+            wall_start, cpu_start, io_start = self.started
+            self.record['wall_time'] = time.perf_counter() - wall_start
+            self.record['cpu_time'] = cpu_time() - cpu_start
+            io_end = read_io_counters()
+            for key in io_end:
+                self.record[key] = io_end[key] - io_start[key]
+        self.record['process_peak_rss'] = process_peak_rss()
+        return self.record
+
+    def write(self, metrics_path:Path=DEFAULT_METRICS_PATH):
+        # Append the record as a JSON line, the cProfile stats are written next to it
+        metrics_path = Path(metrics_path)
+        metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.profiler is not None:
+            name = '-'.join(str(self.record[key]) for key in ['package', 'representation'] if self.record.get(key))
+            profile_path = metrics_path.parent / ('%s.prof' % name)
+            self.profiler.dump_stats(profile_path)
+            self.record['profile'] = str(profile_path)
+        line = json.dumps(self.record)
+        with open(metrics_path, 'a') as f:
+            f.write(line + '\n')
+        logging.info(line)
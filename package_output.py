@@ -0,0 +1,157 @@
+from pathlib import Path
+import gzip
+import io
+import tarfile
+import time
+import zipfile
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+from checksum import BUFFER_SIZE, MultiHash
+from zip_transcode import COMPRESSED_SUFFIXES
+
+
+# Package format: file extension
+PACKAGE_FORMATS = {
+    'tar': '.tar',
+    'tar.gz': '.tar.gz',
+    'tar.zst': '.tar.zst',
+    'zip': '.zip',
+}
+
+
+class HashingReader:
+    # Read-only file wrapper hashing everything read with every algorithm
+    def __init__(self, file, algorithms:list=None):
+        self.file = file
+        self.hash = MultiHash(algorithms)
+
+    def read(self, size:int=-1) -> bytes:
+        data = self.file.read(size)
+        self.hash.update(data)
+        return data
+
+    def hexdigests(self) -> dict:
+        return self.hash.hexdigests()
+
+
+class TarPackageWriter:
+    # Writes members to a tar stream, optionally gzip or zstd compressed
+    # Member names are relative to the package root directory
+
+    def __init__(self, package_path:Path, root_name:str, compression:str=None):
+        self.root_name = root_name
+        self.file = open(package_path, 'wb')
+        if compression == 'gz':
+            self.stream = gzip.GzipFile(fileobj=self.file, mode='wb', mtime=0)
+        elif compression == 'zst':
+            self.stream = zstd.ZstdFile(self.file, 'w')
+        else:
+            self.stream = self.file
+        self.tar = tarfile.open(fileobj=self.stream, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def name(self, relative_path:str) -> str:
+        return self.root_name + '/' + relative_path if relative_path else self.root_name
+
+    def add_directory(self, relative_path:str, src:Path=None):
+        if src is not None:
+            tar_info = self.tar.gettarinfo(src, self.name(relative_path))
+        else:
+            tar_info = tarfile.TarInfo(self.name(relative_path))
+            tar_info.type = tarfile.DIRTYPE
+            tar_info.mode = 0o755
+            tar_info.mtime = int(time.time())
+        self.tar.addfile(tar_info)
+
+    def add_file(self, relative_path:str, src:Path, algorithms:list=None) -> dict:
+        # Stream a file into the package, returns its digests {algorithm: hex digest}
+        tar_info = self.tar.gettarinfo(src, self.name(relative_path))
+        with open(src, 'rb') as f:
+            reader = HashingReader(f, algorithms)
+            self.tar.addfile(tar_info, reader)
+        return reader.hexdigests()
+
+    def add_bytes(self, relative_path:str, data:bytes):
+        self.add_fileobj(relative_path, io.BytesIO(data), len(data))
+
+    def add_fileobj(self, relative_path:str, file, size:int):
+        # Add size bytes read from a binary file object as a new file
+        tar_info = tarfile.TarInfo(self.name(relative_path))
+        tar_info.size = size
+        tar_info.mode = 0o644
+        tar_info.mtime = int(time.time())
+        self.tar.addfile(tar_info, file)
+
+    def close(self):
+        self.tar.close()
+        if self.stream is not self.file:
+            self.stream.close()
+        self.file.close()
+
+
+class ZipPackageWriter:
+    # Writes members to a zip, already compressed formats are stored as is
+
+    def __init__(self, package_path:Path, root_name:str):
+        self.root_name = root_name
+        self.zip = zipfile.ZipFile(package_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def name(self, relative_path:str) -> str:
+        return self.root_name + '/' + relative_path if relative_path else self.root_name
+
+    def add_directory(self, relative_path:str, src:Path=None):
+        zip_info = zipfile.ZipInfo(self.name(relative_path) + '/', time.localtime()[:6])
+        zip_info.external_attr = 0o40755 << 16 | 0x10
+        self.zip.writestr(zip_info, b'')
+
+    def add_file(self, relative_path:str, src:Path, algorithms:list=None) -> dict:
+        # Stream a file into the package, returns its digests {algorithm: hex digest}
+        zip_info = zipfile.ZipInfo.from_file(src, self.name(relative_path))
+        zip_info.compress_type = zipfile.ZIP_STORED if Path(src).suffix.lower() in COMPRESSED_SUFFIXES else zipfile.ZIP_DEFLATED
+        file_hash = MultiHash(algorithms)
+        with open(src, 'rb') as f, self.zip.open(zip_info, 'w', force_zip64=zip_info.file_size > zipfile.ZIP64_LIMIT) as member:
+            while True:
+                data = f.read(BUFFER_SIZE)
+                if not data:
+                    break
+                file_hash.update(data)
+                member.write(data)
+        return file_hash.hexdigests()
+
+    def add_bytes(self, relative_path:str, data:bytes):
+        zip_info = zipfile.ZipInfo(self.name(relative_path), time.localtime()[:6])
+        zip_info.external_attr = 0o644 << 16
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        self.zip.writestr(zip_info, data)
+
+    def add_fileobj(self, relative_path:str, file, size:int):
+        # Add size bytes read from a binary file object as a new file
+        zip_info = zipfile.ZipInfo(self.name(relative_path), time.localtime()[:6])
+        zip_info.external_attr = 0o644 << 16
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        with self.zip.open(zip_info, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as member:
+            while True:
+                data = file.read(BUFFER_SIZE)
+                if not data:
+                    break
+                member.write(data)
+
+    def close(self):
+        self.zip.close()
+
+
+def open_package(package_path:Path, root_name:str, package_format:str):
+    # Returns a writer for the given package format, members are written under root_name/
+    if package_format not in PACKAGE_FORMATS:
+        raise ValueError("Unknown package format '%s'" % package_format)
+    if package_format == 'zip':
+        return ZipPackageWriter(package_path, root_name)
+    if package_format == 'tar.zst' and zstd is None:
+        raise ValueError("zstd compression needs Python 3.14 or the backports.zstd package")
+    return TarPackageWriter(package_path, root_name, package_format.partition('.')[2] or None)
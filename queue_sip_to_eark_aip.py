@@ -0,0 +1,277 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import ctypes
+import ctypes.util
+import json
+import logging
+import mimetypes
+import os
+import signal
+import sys
+import time
+
+from batch_sip_to_eark_aip import convert_sip, find_sips
+from checksum import set_algorithms
+from create_preservation_mets import create_aip_preservation_mets
+from job_queue import DEFAULT_HEARTBEAT_TIMEOUT, DEFAULT_MAX_ATTEMPTS, JobQueue, worker_name
+from metrics import DEFAULT_METRICS_PATH
+from sip_to_eark_aip import process_pool, require_values, split_options, validate_conversion_options
+from xml_backend import set_backend
+
+
+# Convert SIPs from a job queue shared by several ingest hosts, see job_queue
+# Every host runs a worker with its own pool of processes, they claim jobs from the queue until it's empty or they're stopped
+# A job taken over from a dead worker resumes its unfinished AIP from the journal
+# A job that brings its worker process down fails, the jobs that were running alongside it are run again on their own,
+# still claimed by the worker, so they aren't charged another attempt
+
+DEFAULT_HEARTBEAT_INTERVAL = 30.0
+
+# prctl option killing the process when its parent dies
+PR_SET_PDEATHSIG = 1
+
+
+def create_preservation(aip_path:Path, options:dict) -> tuple[bool, str]:
+    # Create the preservation METS of every preservation rep of the AIP, returning (success, AIP name or error)
+    # options are create_preservation_mets command line options
+    try:
+        create_aip_preservation_mets(aip_path, options)
+        return True, aip_path.name
+    except SystemExit as e:
+        return False, str(e.code)
+    except Exception as e:
+        logging.exception("Creating the preservation METS of '%s' failed" % aip_path)
+        return False, "%s: %s" % (type(e).__name__, e)
+
+
+def run_job(job:dict, options:dict, metrics_options:dict=None, preservation_options:dict=None) -> tuple[bool, str]:
+    if job['kind'] == 'preservation':
+        return create_preservation(Path(job['path']), preservation_options or {})
+    return convert_sip(Path(job['path']), Path(job['output']), options, metrics_options)
+
+
+def warm_worker():
+    # Runs once in each worker process, the shell's Ctrl+C is handled by the queue worker, not the processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # A process left running after its queue worker died would go on with a job that's been requeued for another worker
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass
+    mimetypes.init()
+
+
+class QueueWorker:
+    # options are passed on to transform_sip_to_aip, metrics_options to metrics.PackageMetrics (plus metrics_path),
+    # preservation_options to create_preservation_mets
+
+    def __init__(self, queue_path:Path, workers:int=None, heartbeat_interval:float=DEFAULT_HEARTBEAT_INTERVAL, timeout:float=DEFAULT_HEARTBEAT_TIMEOUT,
+                 max_attempts:int=DEFAULT_MAX_ATTEMPTS, poll_interval:float=5.0, metrics_options:dict=None, preservation_options:dict=None, **options):
+        self.queue_path = queue_path
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.metrics_options = metrics_options
+        self.preservation_options = preservation_options
+        self.options = options
+        self.name = worker_name()
+        self.stopping = False
+
+        # {future: job}
+        self.running = {}
+        # Jobs that were running alongside others when a worker process died, run one at a time to find the one that did it
+        self.suspects = deque()
+        self.suspect_ids = set()
+        self.completed = 0
+        self.failed = 0
+        self.lost = 0
+
+    def stop(self, signal_number=None, frame=None):
+        logging.info("Stopping, waiting for %d running jobs" % len(self.running))
+        self.stopping = True
+
+    def finish(self, queue:JobQueue, job:dict, success:bool, message:str):
+        if not queue.finish(job, success, message):
+            # Another worker took the job over, its result counts
+            self.lost += 1
+            logging.warning("Job %d ('%s') was taken over by another worker, dropping its result: %s" % (job['id'], job['path'], message))
+        elif success:
+            self.completed += 1
+            logging.info("Job %d: '%s' done: %s" % (job['id'], job['path'], message))
+        else:
+            self.failed += 1
+            logging.error("Job %d: '%s' failed: %s" % (job['id'], job['path'], message))
+
+    def can_claim(self) -> bool:
+        # New jobs aren't claimed while there are suspects to run
+        return len(self.running) < self.workers and not self.suspects and not any(job['id'] in self.suspect_ids for job in self.running.values())
+
+    def worker_died(self, queue:JobQueue, crashed:list):
+        # crashed - the jobs that were running when a worker process died
+        if len(crashed) == 1:
+            self.suspect_ids.discard(crashed[0]['id'])
+            self.finish(queue, crashed[0], False, "The worker process running it died")
+            return
+        logging.warning("A worker process died running one of jobs %s, running them one at a time" % ', '.join(str(job['id']) for job in crashed))
+        self.suspects.extend(crashed)
+        self.suspect_ids.update(job['id'] for job in crashed)
+
+    def status(self) -> dict:
+        return {
+            'worker': self.name,
+            'running': sorted(job['path'] for job in self.running.values()),
+            'completed': self.completed,
+            'failed': self.failed,
+            'lost': self.lost,
+        }
+
+    def run(self, once:bool=False) -> dict:
+        # Run jobs until stopped, or with once until there are no queued jobs left
+        # Returns the final status of the worker
+        logging.info("Worker '%s' taking jobs from '%s' with %d processes" % (self.name, self.queue_path, self.workers))
+        # The processes are forked before the queue's connection is opened, SQLite connections can't be shared with them
+        executor = process_pool(self.workers, warm_worker)
+        try:
+            with JobQueue(self.queue_path) as queue:
+                last_heartbeat = time.time()
+                while True:
+                    if not self.stopping:
+                        for job in queue.requeue_stale(self.timeout, self.max_attempts):
+                            logging.warning("Worker '%s' stopped heartbeating, requeued job %d ('%s')" % (job['worker'], job['id'], job['path']))
+                        if self.suspects and not self.running:
+                            job = self.suspects.popleft()
+                            self.running[executor.submit(run_job, job, self.options, self.metrics_options, self.preservation_options)] = job
+                        while self.can_claim():
+                            job = queue.claim(self.name)
+                            if job is None:
+                                break
+                            logging.info("Job %d: claimed '%s' (attempt %d)" % (job['id'], job['path'], job['attempts']))
+                            future = executor.submit(run_job, job, self.options, self.metrics_options, self.preservation_options)
+                            self.running[future] = job
+                    elif self.suspects:
+                        # Left for another worker, they haven't been run again yet
+                        for job in self.suspects:
+                            queue.release(job)
+                        self.suspects.clear()
+
+                    if time.time() - last_heartbeat >= self.heartbeat_interval:
+                        for job in queue.heartbeat(list(self.running.values()) + list(self.suspects)):
+                            logging.warning("Job %d ('%s') was requeued while it was running" % (job['id'], job['path']))
+                            if job in self.suspects:
+                                self.suspects.remove(job)
+                        last_heartbeat = time.time()
+
+                    done = [f for f in self.running if f.done()]
+                    if any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+                        # Every running job fails with the pool, wait for all of them before starting a new one
+                        wait(list(self.running))
+                        done = list(self.running)
+                    crashed = []
+                    for future in done:
+                        job = self.running.pop(future)
+                        if isinstance(future.exception(), BrokenProcessPool):
+                            crashed.append(job)
+                        else:
+                            self.suspect_ids.discard(job['id'])
+                            success, message = future.result()
+                            self.finish(queue, job, success, message)
+                    if crashed:
+                        executor.shutdown()
+                        executor = process_pool(self.workers, warm_worker)
+                        self.worker_died(queue, crashed)
+
+                    if not self.running and not self.suspects and (self.stopping or (once and queue.counts()['queued'] == 0)):
+                        break
+                    # Wake up as soon as a job finishes to claim the next one
+                    if self.running:
+                        wait(list(self.running), timeout=min(self.poll_interval, self.heartbeat_interval), return_when=FIRST_COMPLETED)
+                    elif not self.suspects:
+                        time.sleep(self.poll_interval)
+        finally:
+            executor.shutdown()
+        return self.status()
+
+
+def main(argv):
+    Path("logs").mkdir(exist_ok=True)
+    logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    argv, options = split_options(argv)
+    if len(argv) < 2 or argv[0] not in ('add', 'work', 'status', 'retry'):
+        logging.error("Incorrect script call format")
+        sys.exit("Command should have the form:\n"
+                 "python queue_sip_to_eark_aip.py add <Queue File> <SIP Directory>... <Output Directory>\n"
+                 "python queue_sip_to_eark_aip.py add --preservation <Queue File> <AIP Directory>...\n"
+                 "python queue_sip_to_eark_aip.py work [--workers=N] [--heartbeat=<Seconds>] [--timeout=<Seconds>] [--attempts=N] [--poll=<Seconds>] [--once] "
+                 "[--copy=<Strategy>] [--streaming] [--package=<Format>] [--manifest] [--verify] [--rep-workers=N] [--copy-workers=N] [--dedup=<Store Directory>] "
+                 "[--cache=<Cache File>] [--store-compressed] [--check-zip] [--preservation-workers=N] [--digests=<Algorithm>,...] [--xml=<Backend>] [--metrics=<Metrics File>] [--profile] [--trace-memory] <Queue File>\n"
+                 "python queue_sip_to_eark_aip.py status <Queue File>\n"
+                 "python queue_sip_to_eark_aip.py retry <Queue File>")
+
+    command, queue_path = argv[0], Path(argv[1])
+
+    if command == 'add':
+        with JobQueue(queue_path) as queue:
+            if options.get('preservation'):
+                return {str(aip_path): queue.add('preservation', aip_path) for aip_path in argv[2:]}
+            if len(argv) < 4:
+                sys.exit('Fatal Error: No SIPs given')
+            output_path = Path(argv[-1])
+            return {str(sip_path): queue.add('aip', sip_path, output_path) for sip_path in find_sips([Path(arg) for arg in argv[2:-1]])}
+
+    if not queue_path.is_file():
+        sys.exit('Fatal Error: ' + str(queue_path) + " is not a job queue")
+
+    if command == 'status':
+        with JobQueue(queue_path) as queue:
+            return {'counts': queue.counts(), 'running': [{'path': job['path'], 'worker': job['worker'], 'heartbeat': job['heartbeat']} for job in queue.jobs('running')],
+                    'failed': [{'path': job['path'], 'error': job['result']} for job in queue.jobs('failed')]}
+
+    if command == 'retry':
+        with JobQueue(queue_path) as queue:
+            return {'requeued': queue.requeue_failed()}
+
+    validate_conversion_options(options)
+    require_values(options, ['heartbeat', 'timeout', 'attempts', 'poll', 'cache', 'preservation-workers'])
+
+    if 'xml' in options:
+        # process_pool passes the backend on to the worker processes
+        try:
+            set_backend(options['xml'])
+        except ValueError as e:
+            sys.exit('Fatal Error: ' + str(e))
+
+    if 'digests' in options:
+        # Like the XML backend, the algorithms are passed on to the workers
+        try:
+            set_algorithms(str(options['digests']).split(','))
+        except ValueError as e:
+            sys.exit('Fatal Error: ' + str(e))
+
+    metrics_options = {
+        'metrics_path': options.get('metrics', DEFAULT_METRICS_PATH),
+        'profile': bool(options.get('profile')),
+        'trace_memory': bool(options.get('trace-memory')),
+    }
+    # Each job already runs in a worker process, its preservation reps are done one after the other by default
+    preservation_options = {key: options[key] for key in ('cache', 'verify', 'store-compressed', 'check-zip', 'metrics', 'profile', 'trace-memory') if key in options}
+    preservation_options['workers'] = options.get('preservation-workers', 1)
+
+    worker = QueueWorker(queue_path, int(options.get('workers', os.cpu_count())), float(options.get('heartbeat', DEFAULT_HEARTBEAT_INTERVAL)), float(options.get('timeout', DEFAULT_HEARTBEAT_TIMEOUT)),
+                         int(options.get('attempts', DEFAULT_MAX_ATTEMPTS)), float(options.get('poll', 5)), metrics_options, preservation_options,
+                         copy_strategy=options.get('copy', 'copy'), streaming=bool(options.get('streaming')), manifest=bool(options.get('manifest')), verify=bool(options.get('verify')),
+                         package_format=options.get('package'), rep_workers=int(options.get('rep-workers', 1)),
+                         copy_workers=int(options['copy-workers']) if 'copy-workers' in options else None,
+                         dedup_path=Path(options['dedup']) if 'dedup' in options else None)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    return worker.run(bool(options.get('once')))
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(sys.argv[1:]), indent=4))
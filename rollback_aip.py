@@ -0,0 +1,50 @@
+from pathlib import Path
+import logging
+import shutil
+import sys
+
+from journal import journal_path, open_locked, unfinished_aips
+
+
+def rollback(output_path:Path, aip_names:list=None) -> list:
+    # Remove unfinished AIPs and their journals from output_path, all of them if no AIP names are given
+    # Returns the names of the AIPs removed
+    unfinished = unfinished_aips(output_path)
+    removed = []
+    for aip_name in (aip_names if aip_names else unfinished):
+        if aip_name not in unfinished:
+            logging.warning("'%s' has no journal, it isn't an unfinished AIP" % aip_name)
+            continue
+        # A conversion still running holds the lock on its journal
+        journal_file = open_locked(journal_path(output_path, aip_name))
+        if journal_file is None:
+            logging.warning("'%s' is being converted, not rolling it back" % aip_name)
+            continue
+        with journal_file:
+            aip_path = (output_path / aip_name)
+            if aip_path.is_dir():
+                shutil.rmtree(aip_path)
+            journal_path(output_path, aip_name).unlink(missing_ok=True)
+        logging.info("Rolled back '%s' (SIP '%s')" % (aip_name, unfinished[aip_name]))
+        removed.append(aip_name)
+    return removed
+
+
+def main(argv) -> list:
+    Path("logs").mkdir(exist_ok=True)
+    logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    if len(argv) < 1:
+        logging.error("Incorrect script call format")
+        sys.exit("Command should have the form:\npython rollback_aip.py <Output Directory> [<AIP Name>...]")
+
+    output_path = Path(argv[0])
+    if not output_path.is_dir():
+        sys.exit('Fatal Error: ' + str(output_path) + " is not a directory")
+
+    return rollback(output_path, argv[1:])
+
+
+if __name__ == '__main__':
+    for aip_name in main(sys.argv[1:]):
+        print(aip_name)
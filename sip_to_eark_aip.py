@@ -1,345 +1,858 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-import hashlib
 import logging
 import mimetypes
+import os
 import shutil
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
 import sys
+import tempfile
 import uuid
 
+from content_store import ContentStore
+from checksum import CHECKSUM_ALGORITHMS, METS_CHECKSUM_TYPES, hash_bytes, hash_file, hash_file_digests, hash_files, get_algorithms, mets_algorithm, set_algorithms
+from file_copy import COPY_STRATEGIES, copy_tree
+from inventory import Inventory, scan_inventory
+from journal import Journal, JournalLockedError, create_journal, find_journal
+from manifest import Manifest, manifest_name
+from metadata_rewrite import replace_name_in_file, replace_name_stream
+from metrics import DEFAULT_METRICS_PATH, PackageMetrics
+from package_output import PACKAGE_FORMATS, open_package
+from xml_backend import ELEMENT_TREE, get_backend, set_backend
+from xml_rewrite import rewrite_file_streaming, rewrite_tree, walk_streaming, walk_tree
+
 
 SOFTWARE_NAME = "E-ARK AIP Creator"
 SOFTWARE_VERSION = "v0.2.0-dev"
 
+# Rewritten metadata files are kept in memory up to this size in package output, larger ones go to a temporary file
+METADATA_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Conversion options that take a value, see validate_conversion_options
+CONVERSION_VALUE_OPTIONS = ['workers', 'copy', 'package', 'rep-workers', 'copy-workers', 'dedup', 'digests', 'xml', 'metrics', 'inventory']
+
 
 def date_time_now() -> str:
     return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
 
-def update_root_mets(aip_path:Path):
-    update_mets((aip_path / 'METS.xml'))
+def split_options(argv:list) -> tuple[list, dict]:
+    # Separate '--name=value' and '--flag' options from positional arguments
+    positional = []
+    options = {}
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value if value else True
+        else:
+            positional.append(arg)
+    return positional, options
+
+
+def require_values(options:dict, names:list):
+    # A bare '--name' parses as True, reject it for options that take a value instead of reading it as 1 or 'True'
+    for name in names:
+        if options.get(name) is True:
+            fatal_error("--%s needs a value, --%s=<value>" % (name, name))
+
+
+def init_worker(algorithms:list, backend:str, initializer=None):
+    # Runs once in each worker process of a process_pool
+    set_algorithms(algorithms)
+    set_backend(backend)
+    if initializer is not None:
+        initializer()
 
 
-def get_checksum(file:Path) -> str:
-    sha256_hash = hashlib.sha256()
-    with open(file, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+def process_pool(workers:int, initializer=None) -> ProcessPoolExecutor:
+    # A pool of worker processes using the digest algorithms and XML backend set in this process
+    # Forked workers would inherit them, but not workers started with the forkserver or spawn start methods
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(get_algorithms(), get_backend().name, initializer))
+
+
+def update_root_mets(aip_path:Path, streaming:bool=False, manifest:Manifest=None, journal:Journal=None, metadata:dict=None, rep_names:list=None) -> 'MetsUpdate':
+    # metadata - {path relative to the AIP: (size, digests)} of rewritten metadata files, their mdRef checksums are updated
+    # rep_names - the representations to add, e.g. the new names of the SIP representations, listed from the representations directory if not given
+    # Returns None if the journal has the root METS as updated already
+    mets_path = (aip_path / 'METS.xml')
+    if journal is not None and not prepare_journaled_mets(mets_path, aip_path, manifest, journal):
+        return None
+    mets_update = update_mets(mets_path, streaming, manifest, metadata, rep_names)
+    if journal is not None:
+        journal.add_updated(mets_path.relative_to(aip_path), manifest.get_digests(mets_path) if manifest is not None else None)
+    return mets_update
+
+
+def get_checksum(file:Path, algorithm:str=None) -> str:
+    # Checksum for METS, with the set METS algorithm by default
+    return hash_file(file, algorithm or mets_algorithm())
+
+
+def map_namespace(key:str, value:str) -> tuple[str, str]:
+    # Use METS as the default namespace and rename the SIP extension to AIP
+    if key == 'mets':
+        key = ''
+    elif key == 'sip':
+        key = 'aip'
+        value = value.replace('SIP', 'AIP')
+    ET.register_namespace(key, value)
+    return key, value
 
 
 def extract_namespaces(mets_path:Path) -> dict:
     # Extract namespaces from mets files
     # Store and register namespaces
+    # Only namespace declarations are handled, no tree is built
     namespaces = {}
-    for _, values, in ET.iterparse(mets_path, events=['start-ns']):
-        key, value = str(values[0]), str(values[1])
-        if key == 'mets':
-            key = ''
-        elif key == 'sip':
-            key = 'aip'
-            value = value.replace('SIP', 'AIP')
+    def start_namespace(prefix:str, uri:str):
+        key, value = map_namespace(prefix or '', uri or '')
         namespaces[key] = value
-        ET.register_namespace(key, value)
+    parser = expat.ParserCreate(namespace_separator='}')
+    parser.StartNamespaceDeclHandler = start_namespace
+    with open(mets_path, 'rb') as f:
+        parser.ParseFile(f)
     return namespaces
 
 
-def update_mets(mets_path:Path):
+# Attributes referencing IDs (IDREF or IDREFS) in METS
+IDREF_ATTRIBUTES = ['DMDID', 'ADMID', 'FILEID', 'STRUCTID', '{http://www.w3.org/1999/xlink}from', '{http://www.w3.org/1999/xlink}to']
+# E-ARK uses xlink:title on mptr to reference the representation's file group
+# Only updated if it matches an ID, never reported as dangling
+OPTIONAL_IDREF_ATTRIBUTES = ['{http://www.w3.org/1999/xlink}title']
+
+
+class MetsUpdate:
+    # Rules for updating a SIP METS to an AIP METS, applied element by element in document order
+    # Used in two passes:
+    #   index_start/index_end with xml_rewrite.walk_tree or walk_streaming - give every ID a new ID
+    #   start/end with xml_rewrite.rewrite_tree or rewrite_streaming - update the METS and all ID references
+
+    def __init__(self, mets_path:Path, namespaces:dict=None, manifest:Manifest=None, representations:dict=None, xml=ELEMENT_TREE, metadata:dict=None, rep_names:list=None):
+        # representations - {rep path: (size, METS checksum)} of the representation METS, read from disk if not given - (root mets only)
+        # rep_names - names of the representations whose METS are read from disk, listed from the representations directory if not given - (root mets only)
+        # xml - xml_backend the new elements are created with, the one the METS was parsed with
+        # metadata - {path relative to the METS: (size, digests)} of metadata files that were rewritten - (root mets only)
+        self.mets_path = mets_path
+        self.xml = xml
+        self.metadata = metadata if metadata is not None else {}
+        self.namespaces = namespaces if namespaces is not None else {}
+        self.manifest = manifest
+        self.representations = representations
+        self.rep_names = rep_names
+        self.id_updates = {}
+        self.dangling_references = []
+        self.new_fileGrp_ids = {}
+        self.element_count = 0
+        self.reset()
+
+    def reset(self):
+        # Reset document position state between passes
+        self.structmap_count = 0
+        self.root_div = None
+        self.in_root_div = False
+
+    def start_ns(self, key:str, value:str) -> tuple[str, str]:
+        key, value = map_namespace(key, value)
+        self.namespaces.setdefault(key, value)
+        return key, value
+
+    def tag(self, name:str) -> str:
+        return '{%s}%s' % (self.namespaces[''], name)
+
+    def visit(self, element:ET.Element, path:tuple):
+        # Track the first Struct Map and its root Div
+        depth = len(path)
+        if depth == 2 and element.tag == self.tag('structMap'):
+            self.structmap_count += 1
+        elif depth == 3 and path[1] == self.tag('structMap') and self.structmap_count == 1 and self.root_div is None and element.tag == self.tag('div'):
+            self.root_div = element
+            self.in_root_div = True
+
+    def leave(self, element:ET.Element):
+        if element is self.root_div:
+            self.in_root_div = False
+
+    def is_removed(self, element:ET.Element, path:tuple) -> bool:
+        depth = len(path)
+
+        if depth == 3 and path[1] == self.tag('metsHdr'):
+            # Mets Header - MetsDocumentID
+            if element.tag == self.tag('metsDocumentID'):
+                return True
+            # Mets Header - Agent
+            # Remove Software Agent and Individuals
+            if element.tag == self.tag('agent'):
+                agent_attribs = element.attrib
+                try:
+                    if agent_attribs['ROLE'] == 'CREATOR' and agent_attribs['TYPE'] == 'OTHER' and agent_attribs['OTHERTYPE'] == 'SOFTWARE':
+                        return True
+                    elif agent_attribs['ROLE'] == 'CREATOR' and agent_attribs['TYPE'] == 'INDIVIDUAL':
+                        return True
+                except KeyError:
+                    pass
+
+        # File Section - File Groups
+        # Remove Representation File Groups - (root mets)
+        if depth == 3 and path[1] == self.tag('fileSec') and element.tag == self.tag('fileGrp'):
+            return element.get('USE', '').lower().startswith('representation')
+
+        # Struct Map - Div - Div
+        # Remove representations - (root mets)
+        if depth == 4 and self.in_root_div and element.tag == self.tag('div'):
+            return element.get('LABEL', '').lower().startswith('representations')
+
+        return False
+
+    def index_start(self, element:ET.Element, path:tuple) -> bool:
+        # First pass - new ID for every ID that is kept
+        self.visit(element, path)
+        if self.is_removed(element, path):
+            return False
+        old_id = element.get('ID')
+        if old_id is not None:
+            self.id_updates[old_id] = new_uuid('ID' if element.tag == self.tag('file') else 'uuid')
+        return True
+
+    def index_end(self, element:ET.Element, path:tuple):
+        self.leave(element)
+
+    def update_references(self, element:ET.Element):
+        old_id = element.get('ID')
+        if old_id in self.id_updates:
+            element.set('ID', self.id_updates[old_id])
+        for attribute in IDREF_ATTRIBUTES:
+            value = element.get(attribute)
+            if value is None:
+                continue
+            new_ids = []
+            for old_id in value.split():
+                if old_id in self.id_updates:
+                    new_ids.append(self.id_updates[old_id])
+                else:
+                    self.dangling_references.append((element.tag, attribute, old_id))
+                    new_ids.append(old_id)
+            element.set(attribute, ' '.join(new_ids))
+        for attribute in OPTIONAL_IDREF_ATTRIBUTES:
+            if element.get(attribute) in self.id_updates:
+                element.set(attribute, self.id_updates[element.get(attribute)])
+
+    def start(self, element:ET.Element, path:tuple) -> bool:
+        # Second pass - update the METS
+        namespaces = self.namespaces
+        depth = len(path)
+
+        self.visit(element, path)
+        if self.is_removed(element, path):
+            return False
+        self.update_references(element)
+        self.element_count += 1
+
+        # Mets Element
+        if depth == 1:
+            element.set('OBJID', str(self.mets_path.parent.stem))
+            # Update SIP schema location to AIP
+            schema_location = element.get('{%s}schemaLocation' % namespaces['xsi'], '')
+            if "https://dilcis.eu/XML/METS/SIPExtensionMETS" in schema_location:
+                element.set('{%s}schemaLocation' % namespaces['xsi'], schema_location.replace("https://dilcis.eu/XML/METS/SIPExtensionMETS", "https://dilcis.eu/XML/METS/AIPExtensionMETS"))
+
+        # Mets Header
+        elif depth == 2 and element.tag == self.tag('metsHdr'):
+            # element.set('CREATEDATE', date_time_now())
+            element.set('LASTMODDATE', date_time_now())
+            element.set('RECORDSTATUS', "Revised")
+            element.set('{%s}OAISPACKAGETYPE' % namespaces['csip'], "AIP")
+
+        # Mets Header - DMD Section
+        elif depth == 2 and element.tag == self.tag('dmdSec'):
+            element.set('CREATED', date_time_now())
+
+        # Struct Map - Div
+        elif element is self.root_div:
+            element.set('LABEL', self.mets_path.parent.stem)
+
+        # Metadata Reference - checksum of a rewritten metadata file - (root mets only)
+        elif element.tag == self.tag('mdRef') and element.get('{%s}href' % namespaces['xlink']) in self.metadata:
+            self.update_checksum(element, *self.metadata[element.get('{%s}href' % namespaces['xlink'])])
+
+        return True
+
+    def update_checksum(self, element:ET.Element, size:int, digests:dict):
+        # SIZE and CHECKSUM are only updated if the element has them, keeping its CHECKSUMTYPE if it's supported
+        if element.get('SIZE') is not None:
+            element.set('SIZE', str(size))
+        if element.get('CHECKSUM') is not None:
+            algorithm = CHECKSUM_ALGORITHMS.get(element.get('CHECKSUMTYPE'), mets_algorithm())
+            if algorithm not in digests:
+                digests[algorithm] = hash_file((self.mets_path.parent / element.get('{%s}href' % self.namespaces['xlink'])), algorithm)
+            element.set('CHECKSUMTYPE', METS_CHECKSUM_TYPES[algorithm])
+            element.set('CHECKSUM', digests[algorithm])
+
+    def end(self, element:ET.Element, path:tuple) -> list:
+        namespaces = self.namespaces
+        depth = len(path)
+        self.leave(element)
+
+        # Add Software Agent
+        if depth == 2 and element.tag == self.tag('metsHdr'):
+            new_agent = self.xml.Element(self.tag('agent'), attrib={'ROLE': 'CREATOR', 'TYPE': 'OTHER', 'OTHERTYPE': 'SOFTWARE'})
+            self.xml.SubElement(new_agent, self.tag('name')).text = SOFTWARE_NAME
+            self.xml.SubElement(new_agent, self.tag('note'), attrib={'{%s}NOTETYPE' % namespaces['csip']: 'SOFTWARE VERSION'}).text = SOFTWARE_VERSION
+            return [new_agent]
+
+        # Add File Groups for new representations - (root mets only)
+        if depth == 2 and element.tag == self.tag('fileSec'):
+            new_fileGrp_elements = []
+            for rep_path, (size, checksum) in self.representation_mets().items():
+                rep_mets_path = (rep_path / 'METS.xml')
+                self.new_fileGrp_ids[rep_path] = new_uuid()
+                new_fileGrp_element = self.xml.Element(self.tag('fileGrp'), attrib={
+                    'ID': self.new_fileGrp_ids[rep_path],
+                    'USE': str(rep_path.relative_to(self.mets_path.parent))
+                })
+                new_file_id = new_uuid('ID')
+                new_file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
+                # Fix potential depreciated mimetype
+                if new_file_mimetype == "application/x-zip-compressed": 
+                    new_file_mimetype = "application/zip"
+                new_file_element = self.xml.SubElement(new_fileGrp_element, self.tag('file'), attrib={
+                    'ID': new_file_id,
+                    'MIMETYPE': new_file_mimetype,
+                    'SIZE': str(size),
+                    'CREATED': date_time_now(),
+                    'CHECKSUM': checksum,
+                    'CHECKSUMTYPE': METS_CHECKSUM_TYPES[mets_algorithm()]
+                })
+                self.xml.SubElement(new_file_element, self.tag('FLocat'), attrib={
+                    '{%s}type' % namespaces['xlink']: 'simple',
+                    '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(self.mets_path.parent)),
+                    '{%s}LOCTYPE' % namespaces['']: 'URL',
+                })
+                new_fileGrp_elements.append(new_fileGrp_element)
+            return new_fileGrp_elements
+
+        # Add Struct Map Divs for new representations - (root mets only)
+        if element is self.root_div:
+            new_div_elements = []
+            for rep_path in self.representation_mets():
+                rep_mets_path = (rep_path / 'METS.xml')
+                new_div = self.xml.Element(self.tag('div'), attrib={
+                    'ID': new_uuid(),
+                    'LABEL': str(rep_path.relative_to(rep_path.parents[1]))
+                })
+                self.xml.SubElement(new_div, self.tag('mptr'), attrib={
+                    '{%s}type' % namespaces['xlink']: 'simple',
+                    '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(rep_path)),
+                    '{%s}title' % namespaces['xlink']: self.new_fileGrp_ids.get(rep_path, new_uuid()),
+                    '{%s}LOCTYPE' % namespaces['']: 'URL',
+                })
+                new_div_elements.append(new_div)
+            return new_div_elements
+
+        return []
+
+    def representation_mets(self) -> dict:
+        # {rep path: (size, checksum)} of the representation METS - (root mets only)
+        if self.representations is None:
+            rep_paths = self.representation_paths()
+            # Take checksums from the manifest, hash the remaining representation METS concurrently
+            checksums = {}
+            if self.manifest is not None:
+                checksums = {(rep_path / 'METS.xml'): self.manifest.get((rep_path / 'METS.xml'), mets_algorithm()) for rep_path in rep_paths}
+            checksums.update(hash_files([(rep_path / 'METS.xml') for rep_path in rep_paths if checksums.get(rep_path / 'METS.xml') is None], mets_algorithm()))
+            self.representations = {rep_path: ((rep_path / 'METS.xml').stat().st_size, checksums[rep_path / 'METS.xml']) for rep_path in rep_paths}
+        return self.representations
+
+    def representation_paths(self) -> list:
+        # Non-preservation representations next to the METS - (root mets only)
+        representations_path = (self.mets_path.parent / 'representations')
+        if self.rep_names is not None:
+            rep_paths = [(representations_path / rep_name) for rep_name in self.rep_names]
+        elif representations_path.is_dir():
+            rep_paths = list(representations_path.iterdir())
+        else:
+            return []
+        return [rep_path for rep_path in rep_paths if not rep_path.stem.endswith('-preservation')]
+
+
+def update_mets_tree(source_path:Path, mets_path:Path, manifest:Manifest=None, representations:dict=None, metadata:dict=None, rep_names:list=None) -> tuple[ET.ElementTree, MetsUpdate]:
+    # Parse the METS at source_path and update it as the METS at mets_path
+    # Returns the updated tree, ready to be written, and the applied update
 
-    id_updates = {}
-    
     # Extract namespaces
-    namespaces = extract_namespaces(mets_path)
+    namespaces = extract_namespaces(source_path)
 
     # Parse mets
-    tree = ET.parse(mets_path)
-
-    # Mets Element
-    mets_element = tree.getroot()
-    mets_element.set('OBJID', str(mets_path.parent.stem))
-
-    # Update SIP schema location to AIP
-    if "https://dilcis.eu/XML/METS/SIPExtensionMETS" in mets_element.get('{%s}schemaLocation' % namespaces['xsi']):
-        mets_element.set('{%s}schemaLocation' % namespaces['xsi'], mets_element.get('{%s}schemaLocation' % namespaces['xsi']).replace("https://dilcis.eu/XML/METS/SIPExtensionMETS", "https://dilcis.eu/XML/METS/AIPExtensionMETS"))
-
-    # Mets Header
-    metsHdr_element = mets_element.find('{%s}metsHdr' % namespaces[''])
-    # metsHdr_element.set('CREATEDATE', date_time_now())
-    metsHdr_element.set('LASTMODDATE', date_time_now())
-    metsHdr_element.set('RECORDSTATUS', "Revised")
-    metsHdr_element.set('{%s}OAISPACKAGETYPE' % namespaces['csip'], "AIP")
-
-    # Mets Header - MetsDocumentID
-    # Remove
-    metsDocumentId_element = metsHdr_element.find('{%s}metsDocumentID' % namespaces[''])
-    if metsDocumentId_element is not None:
-        metsHdr_element.remove(metsDocumentId_element)
-
-    # Mets Header - Agent
-    # Remove Software Agent and Individuals
-    marked_for_remove = []
-    for agent_element in metsHdr_element.findall('{%s}agent' % namespaces['']):
-        agent_attribs = agent_element.attrib
-        try:
-            if agent_attribs['ROLE'] == 'CREATOR' and agent_attribs['TYPE'] == 'OTHER' and agent_attribs['OTHERTYPE'] == 'SOFTWARE':
-                marked_for_remove.append(agent_element)
-            elif agent_attribs['ROLE'] == 'CREATOR' and agent_attribs['TYPE'] == 'INDIVIDUAL':
-                marked_for_remove.append(agent_element)
-        except KeyError:
-            pass
-    for agent in marked_for_remove:
-        metsHdr_element.remove(agent)
-
-    # Add Software Agent
-    new_agent = ET.SubElement(metsHdr_element, '{%s}agent' % namespaces[''], attrib={'ROLE': 'CREATOR', 'TYPE': 'OTHER', 'OTHERTYPE': 'SOFTWARE'})
-    ET.SubElement(new_agent, '{%s}name' % namespaces['']).text = SOFTWARE_NAME
-    ET.SubElement(new_agent, '{%s}note' % namespaces[''], attrib={'{%s}NOTETYPE' % namespaces['csip']: 'SOFTWARE VERSION'}).text = SOFTWARE_VERSION
-
-    # Mets Header - DMD Section
-    # Update and Store ID
-    for dmdSec in mets_element.findall('{%s}dmdSec' % namespaces['']):
-        id_updates[dmdSec.get('ID')] = new_uuid()
-        dmdSec.set('ID', id_updates[dmdSec.get('ID')])
-        dmdSec.set('CREATED', date_time_now())
-
-    # Mets Header - AMD Section
-    # Update and Store ID
-    for amdSec in mets_element.findall('{%s}amdSec' % namespaces['']):
-        id_updates[amdSec.get('ID')] = new_uuid()
-        amdSec.set('ID', id_updates[amdSec.get('ID')])
-
-    # File Section
-    # Update ID - Don't Store
-    fileSec_element = mets_element.find('{%s}fileSec' % namespaces[''])
-    fileSec_element.set('ID', new_uuid())
-
-    # File Section - File Groups
-    # Remove Representation File Groups - (root mets)
-    # Update and Store ID
-    marked_for_remove = []
-    for fileGrp_element in fileSec_element.findall('{%s}fileGrp' % namespaces['']):
-        if fileGrp_element.get('USE').lower().startswith('representation'):
-            marked_for_remove.append(fileGrp_element)
-            continue
-        else:
-            id_updates[fileGrp_element.get('ID')] = new_uuid()
-            fileGrp_element.set('ID', id_updates[fileGrp_element.get('ID')])
-            # File Section - File Group - File
-            # Update and Store ID
-            for file_element in fileGrp_element.findall('{%s}file' % namespaces['']):
-                id_updates[file_element.get('ID')] = new_uuid('ID')
-                file_element.set('ID', id_updates[file_element.get('ID')])
-    for fileGrp in marked_for_remove:
-        fileSec_element.remove(fileGrp)
-
-    # Struct Map
-    # Update ID - Don't store
-    structmap_element = mets_element.find('{%s}structMap' % namespaces[''])
-    structmap_element.set('ID', new_uuid())
-
-    # Struct Map - Div
-    root_div_element = structmap_element.find('{%s}div' % namespaces[''])
-    root_div_element.set('LABEL', mets_path.parent.stem)
-    root_div_element.set('ID', new_uuid())
-
-    # Struct Map - Div - Div
-    # Remove representations - (root mets)
-    # Update metadata DMDID
-    # Update IDs
-    marked_for_remove = []
-    for div_element in root_div_element.findall('{%s}div' % namespaces['']):
-        if div_element.get('LABEL').lower().startswith('representations'):
-            marked_for_remove.append(div_element)
-            continue
-        if div_element.get('LABEL').lower().startswith('metadata'):
-            if div_element.get('DMDID') in id_updates:
-                div_element.set('DMDID', id_updates[div_element.get('DMDID')])
-        div_element.set('ID', new_uuid())
-
-        # Struct Map - Div - Div - FPTR
-        # Update ID to fileGrp ID
-        """
-        fptr_element = div_element.find('{%s}fptr' % namespaces[''])
-        if fptr_element is not None:
-            if fptr_element.get('FILEID') in id_updates:
-                fptr_element.set('FILEID', id_updates[fptr_element.get('FILEID')])
-            else:
-                fptr_element.set('FILEID', new_uuid())
-        """
-        for fptr_element in div_element.findall('{%s}fptr' % namespaces['']):
-            if fptr_element.get('FILEID') in id_updates:
-                fptr_element.set('FILEID', id_updates[fptr_element.get('FILEID')])
-            else:
-                fptr_element.set('FILEID', new_uuid())
-
-        # Struct Map - Div - Div - MPTR
-        # Update ID to file ID
-        """
-        mptr_element = div_element.find('{%s}mptr' % namespaces[''])
-        if mptr_element is not None:
-            if mptr_element.get('FILEID') in id_updates:
-                mptr_element.set('FILEID', id_updates[mptr_element.get('FILEID')])
-            else:
-                fptr_element.set('FILEID', new_uuid())
-        """
-        for mptr_element in div_element.findall('{%s}mptr' % namespaces['']):
-            if mptr_element.get('FILEID') in id_updates:
-                mptr_element.set('FILEID', id_updates[mptr_element.get('FILEID')])
-            else:
-                mptr_element.set('FILEID', new_uuid())
-
-    for div in marked_for_remove:
-        root_div_element.remove(div)
-
-    # Add File Groups and Struct Map Divs for new representations - (root mets only)
-    representations_path = (mets_path.parent / 'representations')
-    if representations_path.is_dir():
-        for rep_path in representations_path.iterdir():
-            rep_mets_path = (rep_path / 'METS.xml')
-            if rep_path.stem.endswith('-preservation'):
-                continue
-            # File Group
-            new_fileGrp_id = new_uuid()
-            new_fileGrp_element = ET.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
-                'ID': new_fileGrp_id,
-                'USE': str(rep_path.relative_to(mets_path.parent))
-            })
-            new_file_id = new_uuid('ID')
-            new_file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
-            # Fix potential depreciated mimetype
-            if new_file_mimetype == "application/x-zip-compressed": 
-                new_file_mimetype = "application/zip"
-            new_file_element = ET.SubElement(new_fileGrp_element, '{%s}file' % namespaces[''], attrib={
-                'ID': new_file_id,
-                'MIMETYPE': new_file_mimetype,
-                'SIZE': str(rep_mets_path.stat().st_size),
-                'CREATED': date_time_now(),
-                'CHECKSUM': get_checksum(rep_mets_path),
-                'CHECKSUMTYPE': 'SHA-256'
-            })
-            ET.SubElement(new_file_element, '{%s}FLocat' % namespaces[''], attrib={
-                '{%s}type' % namespaces['xlink']: 'simple',
-                '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(mets_path.parent)),
-                '{%s}LOCTYPE' % namespaces['']: 'URL',
-            })
-            # Struct Map
-            new_div = ET.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
-                'ID': new_uuid(),
-                'LABEL': str(rep_path.relative_to(rep_path.parents[1]))
-            })
-            ET.SubElement(new_div, '{%s}mptr' % namespaces[''], attrib={
-                '{%s}type' % namespaces['xlink']: 'simple',
-                '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(rep_path)),
-                '{%s}title' % namespaces['xlink']: new_fileGrp_id,
-                '{%s}LOCTYPE' % namespaces['']: 'URL',
-            })
-
-    ET.indent(tree, space='    ', level=0)
-    tree.write(mets_path, encoding='utf-8', xml_declaration=True)
-
-
-def update_rep_mets(aip_path:Path):
-    # Update each non-preservation METS.xml
-    for rep_path in (aip_path / 'representations').iterdir():
+    xml = get_backend()
+    tree = xml.parse(source_path)
+
+    mets_update = MetsUpdate(mets_path, namespaces, manifest, representations, xml, metadata, rep_names)
+    walk_tree(tree.getroot(), mets_update.index_start, mets_update.index_end)
+    mets_update.reset()
+    rewrite_tree(tree.getroot(), mets_update.start, mets_update.end)
+
+    xml.indent(tree)
+    return tree, mets_update
+
+
+def update_mets(mets_path:Path, streaming:bool=False, manifest:Manifest=None, metadata:dict=None, rep_names:list=None) -> MetsUpdate:
+    # streaming rewrites the METS while parsing it, keeping memory use flat for very large METS
+    # With a manifest, representation METS checksums are taken from it and the new checksum of the METS is recorded in it
+    # Returns the applied update, incl. the ID references that don't match any ID and the number of elements written
+
+    if streaming:
+        mets_update = MetsUpdate(mets_path, manifest=manifest, metadata=metadata, rep_names=rep_names)
+        walk_streaming(mets_path, mets_update.index_start, mets_update.index_end, mets_update.start_ns)
+        mets_update.reset()
+        rewrite_file_streaming(mets_path, mets_update.start, mets_update.end, mets_update.start_ns)
+    else:
+        tree, mets_update = update_mets_tree(mets_path, mets_path, manifest, metadata=metadata, rep_names=rep_names)
+        get_backend().write(tree, mets_path, mets_update.namespaces)
+
+    if manifest is not None:
+        manifest.set(mets_path, hash_file_digests(mets_path, manifest.algorithms))
+
+    report_dangling_references(mets_update)
+    return mets_update
+
+
+def report_dangling_references(mets_update:MetsUpdate):
+    for tag, attribute, old_id in mets_update.dangling_references:
+        logging.warning("%s: %s %s references unknown ID '%s'" % (mets_update.mets_path, tag, attribute, old_id))
+
+
+def prepare_journaled_mets(mets_path:Path, aip_path:Path, manifest:Manifest, journal:Journal) -> bool:
+    # Returns False if the journal has the METS as updated already
+    # In a resumed conversion the METS may be partly written or updated without being journaled, so it's copied from the SIP again
+    relative_path = mets_path.relative_to(aip_path)
+    entry = journal.updated.get(relative_path.as_posix())
+    if entry is not None:
+        if manifest is not None:
+            manifest.set(mets_path, entry.get('checksums') or hash_file_digests(mets_path, manifest.algorithms))
+        return False
+    if journal.resumed:
+        shutil.copy2(journal.sip_file(relative_path), mets_path)
+    return True
+
+
+def update_rep_mets_file(rep_mets_path:Path, streaming:bool=False, algorithms:list=None) -> tuple[int, dict]:
+    # Update one representation METS, run on the update_rep_mets process pool
+    # Returns the number of elements written and, if algorithms are given, the digests of the new METS
+    mets_update = update_mets(rep_mets_path, streaming)
+    return mets_update.element_count, hash_file_digests(rep_mets_path, algorithms) if algorithms else None
+
+
+def update_rep_mets(aip_path:Path, streaming:bool=False, manifest:Manifest=None, journal:Journal=None, workers:int=None, rep_names:list=None) -> dict:
+    # Update each non-preservation METS.xml, concurrently on a pool of workers processes (one per CPU by default)
+    # rep_names are the representations to update, e.g. the new names of the SIP representations, listed from the representations directory if not given
+    # Results are merged into the manifest and journal in representation order once all METS are updated, before the root METS needs them
+    # Returns {rep METS path: number of elements written}, METS the journal has as updated already are skipped
+    if rep_names is None:
+        rep_names = [rep_path.name for rep_path in (aip_path / 'representations').iterdir()]
+    rep_mets_paths = []
+    for rep_name in sorted(rep_names):
+        rep_path = (aip_path / 'representations' / rep_name)
         # Ignore preservation reps
         if rep_path.stem.endswith('-preservation'):
             continue
         rep_mets_path = (rep_path / 'METS.xml')
-        update_mets(rep_mets_path)
-    pass
+        if journal is not None and not prepare_journaled_mets(rep_mets_path, aip_path, manifest, journal):
+            continue
+        rep_mets_paths.append(rep_mets_path)
+
+    if workers is None:
+        # CPUs this process may run on
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    workers = min(workers, len(rep_mets_paths))
+    arguments = ([streaming] * len(rep_mets_paths), [manifest.algorithms if manifest is not None else None] * len(rep_mets_paths))
+    if workers > 1:
+        with process_pool(workers) as executor:
+            results = list(executor.map(update_rep_mets_file, rep_mets_paths, *arguments))
+    else:
+        results = list(map(update_rep_mets_file, rep_mets_paths, *arguments))
+
+    element_counts = {}
+    for rep_mets_path, (element_count, checksums) in zip(rep_mets_paths, results):
+        element_counts[rep_mets_path] = element_count
+        if manifest is not None:
+            manifest.set(rep_mets_path, checksums)
+        if journal is not None:
+            journal.add_updated(rep_mets_path.relative_to(aip_path), checksums)
+    return element_counts
+
+
+def plan_representation_renames(representations_path:Path, inventory:Inventory=None) -> dict:
+    # {rep name: rep0x} for each directory in representations, zero padded counter in directory order
+    # inventory is the inventory of the SIP, its representations directory is listed instead of representations_path
+    if inventory is not None:
+        rep_paths = [(representations_path / name) for name in inventory.children('representations') if inventory.is_dir('representations/' + name)]
+    else:
+        rep_paths = [rep_path for rep_path in representations_path.iterdir() if rep_path.is_dir()]
+    renames = {}
+    rep_couter = 0
+    for rep_path in rep_paths:
+        rep_couter += 1
+        renames[rep_path.name] = 'rep'+str(rep_couter).zfill(2)
+    return renames
 
 
-def transform_representations(aip_path:Path):
+def transform_representations(aip_path:Path, manifest:Manifest=None, journal:Journal=None, inventory:Inventory=None):
     # For each directory in representation, rename it rep0x and create rep0x-preservation
-    rep_couter = 0
-    for rep_path in (aip_path / "representations").iterdir():
-        if rep_path.is_dir():
-            rep_couter += 1
-            # Rename rep name with zero padded counter
-            new_rep_name = 'rep'+str(rep_couter).zfill(2)
-            new_rep_path = (rep_path.parent / new_rep_name)
+    # With a journal the renames are journaled before they are made, so a resumed conversion finishes the same renames
+    # inventory is the inventory of the SIP the AIP was copied from, the representations are planned from it
+    renames = journal.renames if journal is not None else None
+    if renames is None:
+        renames = plan_representation_renames((aip_path / "representations"), inventory)
+        if journal is not None:
+            journal.add_renames(renames)
+
+    for rep_name, new_rep_name in renames.items():
+        rep_path = (aip_path / "representations" / rep_name)
+        new_rep_path = (rep_path.parent / new_rep_name)
+        # Only a resumed conversion can find a rename done already, a new one planned the renames from the inventory
+        if (journal is not None and not journal.resumed) or (rep_path.is_dir() and not new_rep_path.is_dir()):
             rep_path.rename(new_rep_path)
+        if manifest is not None:
+            manifest.rename(rep_path, new_rep_path)
+
+        # Create preservation rep incl. data directory
+        new_rep_preservation_name = new_rep_name + "-preservation"
+        new_rep_preservation_path = (rep_path.parent / new_rep_preservation_name / "data")
+        new_rep_preservation_path.mkdir(parents=True, exist_ok=journal is not None and journal.resumed)
+
+
+def copy_sip_to_aip(sip_path:Path, aip_path:Path, copy_strategy:str='copy', manifest:Manifest=None, journal:Journal=None, workers:int=None, inventory:Inventory=None, store:ContentStore=None) -> tuple:
+    # Copy all directories and files from sip to aip on workers threads, recording their checksums in the manifest
+    # Files the journal has as copied already are skipped, with an inventory of the SIP it isn't walked again
+    # With a content store payload files are linked from it, and added to it if it doesn't have them yet
+    # Returns the number of files copied with each strategy and the number of bytes copied
+    return copy_tree(sip_path, aip_path, copy_strategy, manifest, journal, workers, inventory, store)
+
+
+def metadata_paths(aip_path:Path, inventory:Inventory=None) -> list:
+    # XML files under the metadata directory of the AIP, listed from the SIP inventory if given
+    if inventory is not None:
+        return [(aip_path / relative_path) for relative_path in sorted(inventory.files()) if relative_path.startswith('metadata/') and relative_path.lower().endswith('.xml')]
+    return sorted(path for path in (aip_path / 'metadata').rglob('*') if path.is_file() and path.name.lower().endswith('.xml'))
+
+
+def update_metadata(aip_path:Path, sip_name:str, manifest:Manifest=None, journal:Journal=None, workers:int=None, inventory:Inventory=None) -> dict:
+    # Replace references to the SIP name with the AIP name in every XML file under metadata (DC, EAD, PREMIS...)
+    # Files are rewritten in one streaming pass each, see metadata_rewrite, concurrently on a pool of worker processes (one per CPU by default)
+    # Rewritten files are journaled with their digests, for the manifest and the mdRef checksums of the root METS
+    # Returns {metadata path: number of references replaced}, files the journal has as updated already are skipped
+    algorithms = list(dict.fromkeys([mets_algorithm()] + (manifest.algorithms if manifest is not None else [])))
+    paths = []
+    for path in metadata_paths(aip_path, inventory):
+        entry = journal.updated.get(path.relative_to(aip_path).as_posix()) if journal is not None else None
+        if entry is not None:
+            if manifest is not None:
+                manifest.set(path, entry['checksums'])
+            continue
+        if journal is not None and journal.resumed:
+            # May have been rewritten without being journaled, start over from the SIP's
+            shutil.copy2(journal.sip_file(path.relative_to(aip_path)), path)
+        paths.append(path)
+
+    if workers is None:
+        # CPUs this process may run on
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    workers = min(workers, len(paths))
+    arguments = ([sip_name] * len(paths), [aip_path.stem] * len(paths), [algorithms] * len(paths))
+    if workers > 1:
+        with process_pool(workers) as executor:
+            results = list(executor.map(replace_name_in_file, paths, *arguments))
+    else:
+        results = list(map(replace_name_in_file, paths, *arguments))
+
+    replacements = {}
+    for path, (count, checksums) in zip(paths, results):
+        replacements[path] = count
+        if not count:
+            # Unchanged, the digests from copying it still hold
+            continue
+        if manifest is not None:
+            manifest.set(path, checksums)
+        if journal is not None:
+            journal.add_updated(path.relative_to(aip_path), checksums)
+    return replacements
 
-            # Create preservation rep incl. data directory
-            new_rep_preservation_name = new_rep_name + "-preservation"
-            new_rep_preservation_path = (rep_path.parent / new_rep_preservation_name / "data")
-            new_rep_preservation_path.mkdir(parents=True, exist_ok=False)
-
-
-def copy_sip_to_aip(sip_path:Path, aip_path:Path):
-    # Copy all directories and files from sip to aip
-    for file_folder in sip_path.iterdir():
-        if file_folder.is_dir():
-            shutil.copytree(file_folder, (aip_path / file_folder.stem), copy_function=shutil.copy2)
-        else:
-            shutil.copy2(file_folder, (aip_path / file_folder.name))
-
-
-def overwrite_and_create_directory(directory:Path):
-    # Delete directory if it exists and (re)create it
-    if directory.is_dir():
-        logging.info("Overwriting '%s'" % directory)
-        shutil.rmtree(directory)
-    directory.mkdir(parents=True, exist_ok=False)
 
+def rewritten_metadata(aip_path:Path, journal:Journal) -> dict:
+    # {path relative to the AIP: (size, digests)} of the metadata files update_metadata rewrote, for the root METS
+    return {relative_path: ((aip_path / relative_path).stat().st_size, entry['checksums']) for relative_path, entry in journal.updated.items() if relative_path.startswith('metadata/')}
 
-def update_metadata(aip_path:Path, sip_name:str):
-    # Update referencese to SIP name with new AIP name
-    # TODO Update different types of metadata
 
-    # Descriptive DC.xml
-    dc_metadata_path = (aip_path / 'metadata' / 'descriptive' / 'DC.xml')
-    if dc_metadata_path.is_file():
-        dc_tree = ET.parse(dc_metadata_path)
-        dc_root = dc_tree.getroot()
-        for child in dc_root:
-            if sip_name in str(child.text):
-                child.text = child.text.replace(sip_name, aip_path.stem)
-    
-        dc_tree.write(dc_metadata_path, encoding='utf-8', xml_declaration=True)
+def mdref_algorithms(mets_path:Path) -> dict:
+    # {href: algorithm} of the mdRefs with a CHECKSUM, the algorithm MetsUpdate.update_checksum will write for the file they reference
+    algorithms = {}
+    for _, element in ET.iterparse(mets_path, events=('end',)):
+        if element.tag.rpartition('}')[2] == 'mdRef' and element.get('CHECKSUM') is not None:
+            href = element.get('{http://www.w3.org/1999/xlink}href')
+            if href is not None:
+                algorithms[href] = CHECKSUM_ALGORITHMS.get(element.get('CHECKSUMTYPE'), mets_algorithm())
+        element.clear()
+    return algorithms
 
 
 def new_uuid(prefix:str="uuid") -> str:
     return prefix + "-" + str(uuid.uuid4())
 
 
-def transform_sip_to_aip(sip_path:Path, output_path:Path) -> str:
+def transform_sip_to_aip(sip_path:Path, output_path:Path, copy_strategy:str='copy', streaming:bool=False, metrics:PackageMetrics=None, manifest:bool=False, resume:bool=True, verify:bool=False, package_format:str=None, rep_workers:int=None, copy_workers:int=None, inventory:Inventory=None, dedup_path:Path=None) -> str:
+    # metrics records each stage, the caller writes the record once the package is done
+    # manifest writes a manifest of the AIP per digest algorithm, files are hashed while they are copied
+    # Progress is journaled next to the AIP, an unfinished conversion of the same SIP is resumed unless resume is off
+    # verify re-hashes files copied before resuming, if their checksum was journaled
+    # package_format writes the AIP straight into a package instead, see transform_sip_to_package
+    # rep_workers is the number of processes updating representation METS and metadata files, one per CPU by default
+    # copy_workers is the number of threads copying SIP files, see copy_tree for the default
+    # inventory is the inventory of the SIP from validate_input_directories, the SIP is scanned if not given
+    # dedup_path is a content store the payload files are linked from instead of copied, see content_store
+    if package_format is not None:
+        return transform_sip_to_package(sip_path, output_path, package_format, metrics, manifest, inventory)
 
     sip_name = sip_path.stem
-    aip_name = new_uuid()
+    try:
+        journal = find_journal(output_path, sip_path, verify) if resume else None
+    except JournalLockedError as e:
+        fatal_error(str(e))
+    aip_name = journal.aip_name if journal is not None else new_uuid()
 
     # For Testing
     # aip_name = sip_name
 
     aip_path = (output_path / aip_name)
+    aip_manifest = Manifest(aip_path) if manifest else None
+
+    if metrics is None:
+        metrics = PackageMetrics()
+    metrics.record['package'] = aip_name
+    metrics.record['sip'] = str(sip_path)
+    metrics.record['resumed'] = journal is not None
+    metrics.start()
+
+    try:
+        # Index the SIP once for all stages
+        with metrics.stage('scan') as stage:
+            if inventory is None:
+                inventory = scan_inventory(sip_path)
+            stage['files'] = len(inventory.files())
+
+        if journal is None:
+            # Create output directory with the journal. AIP names are new UUIDs, an existing directory belongs to another conversion
+            # (e.g. on another host sharing the output directory) and is never overwritten
+            output_path.mkdir(parents=True, exist_ok=True)
+            try:
+                journal = create_journal(output_path, sip_path, aip_name, verify)
+            except FileExistsError:
+                fatal_error(str(aip_path) + " already exists, it isn't overwritten")
+        else:
+            logging.info("Resuming conversion of '%s' to '%s'" % (sip_path, aip_name))
+
+        # Copy SIP contents to AIP directory
+        with metrics.stage('copy') as stage:
+            if journal.is_done('copy'):
+                if aip_manifest is not None:
+                    for entry in journal.copied.values():
+                        aip_manifest.set((aip_path / entry['copied']), entry.get('checksums'))
+            else:
+                store = ContentStore(dedup_path) if dedup_path is not None else None
+                try:
+                    copied, copied_bytes = copy_sip_to_aip(sip_path, aip_path, copy_strategy, aip_manifest, journal, copy_workers, inventory, store)
+                finally:
+                    if store is not None:
+                        store.close()
+                stage['files'] = sum(copied.values())
+                stage['copied_bytes'] = copied_bytes
+                if store is not None:
+                    stage['dedup_saved_bytes'] = store.saved_bytes
+                    logging.info("Linked %d files from content store '%s', %d bytes saved" % (store.hits, dedup_path, store.saved_bytes))
+                journal.done('copy')
+
+        # Update metadata to reflect new directory name
+        with metrics.stage('update_metadata') as stage:
+            if journal.is_done('update_metadata'):
+                if aip_manifest is not None:
+                    for relative_path, (_, checksums) in rewritten_metadata(aip_path, journal).items():
+                        aip_manifest.set((aip_path / relative_path), checksums)
+            else:
+                replacements = update_metadata(aip_path, sip_name, aip_manifest, journal, rep_workers, inventory)
+                stage['files'] = len(replacements)
+                stage['replacements'] = sum(replacements.values())
+                journal.done('update_metadata')
+
+        # Transform the AIP representations directory to AIP specification
+        with metrics.stage('transform_representations') as stage:
+            if journal.is_done('transform_representations'):
+                if aip_manifest is not None:
+                    for rep_name, new_rep_name in journal.renames.items():
+                        aip_manifest.rename((aip_path / 'representations' / rep_name), (aip_path / 'representations' / new_rep_name))
+            else:
+                transform_representations(aip_path, aip_manifest, journal, inventory)
+                journal.done('transform_representations')
+            # The representations and their preservation reps
+            stage['files'] = 2 * len(journal.renames)
+
+        with metrics.stage('update_rep_mets') as stage:
+            element_counts = update_rep_mets(aip_path, streaming, aip_manifest, journal, rep_workers, list(journal.renames.values()))
+            stage['files'] = len(element_counts)
+            stage['mets_elements'] = sum(element_counts.values())
+
+        with metrics.stage('update_root_mets') as stage:
+            mets_update = update_root_mets(aip_path, streaming, aip_manifest, journal, rewritten_metadata(aip_path, journal), list(journal.renames.values()))
+            if mets_update is not None:
+                stage['files'] = 1
+                stage['mets_elements'] = mets_update.element_count
+
+        if aip_manifest is not None:
+            # Files copied before resuming without a manifest
+            aip_manifest.hash_missing()
+            aip_manifest.write()
+
+        # The AIP is complete
+        journal.remove()
+    finally:
+        if journal is not None:
+            journal.close()
+        metrics.finish()
 
-    # Update metadata to reflect new directory name
-    update_metadata(aip_path, sip_name)
+    return aip_name
 
-    # (Re-)create output directory
-    overwrite_and_create_directory(aip_path)
-    
-    # Copy SIP contents to AIP directory
-    copy_sip_to_aip(sip_path, aip_path)
 
-    # Transform the AIP representations directory to AIP specification
-    transform_representations(aip_path)
+def package_member_path(relative_path:Path, renames:dict, is_directory:bool=False) -> Path:
+    # Path in the AIP of a file or directory in the SIP, as copy_sip_to_aip and transform_representations would place it
+    parts = list(relative_path.parts)
+    if len(parts) > 1 or is_directory:
+        parts[0] = Path(parts[0]).stem
+    if len(parts) > 1 and parts[0] == 'representations':
+        parts[1] = renames.get(parts[1], parts[1])
+    return Path(*parts)
+
 
-    update_rep_mets(aip_path)
+def transform_sip_to_package(sip_path:Path, output_path:Path, package_format:str='tar', metrics:PackageMetrics=None, manifest:bool=False, inventory:Inventory=None) -> str:
+    # Write the AIP straight into a package, output_path/<aip name><extension>, with the same layout as the AIP directory
+    # Files are streamed into the package from the SIP and the METS are updated in memory, nothing is staged on disk
+    # but metadata files larger than METADATA_SPOOL_SIZE, which are rewritten to a temporary file like update_metadata does
+    # The SIP is listed from its inventory, scanned if not given
+    # Returns the AIP name
 
-    update_root_mets(aip_path)
+    aip_name = new_uuid()
+    # Paths in the package, nothing is written here
+    aip_path = Path(aip_name)
+    package_path = (output_path / (aip_name + PACKAGE_FORMATS[package_format]))
+    temporary_path = package_path.with_name(package_path.name + '.tmp')
+    aip_manifest = Manifest(aip_path) if manifest else None
+    # Digests of the files for the manifest, the METS are digested for the root METS as well
+    algorithms = aip_manifest.algorithms if aip_manifest is not None else []
+    mets_algorithms = list(dict.fromkeys([mets_algorithm()] + algorithms))
+
+    if metrics is None:
+        metrics = PackageMetrics()
+    metrics.record['package'] = aip_name
+    metrics.record['sip'] = str(sip_path)
+    metrics.start()
+
+    with metrics.stage('scan') as stage:
+        if inventory is None:
+            inventory = scan_inventory(sip_path)
+        stage['files'] = len(inventory.files())
+    renames = plan_representation_renames((sip_path / 'representations'), inventory)
+    # Algorithms of the root METS mdRef checksums, a rewritten metadata file can't be hashed again once it's in the package
+    metadata_algorithms = mdref_algorithms(sip_path / 'METS.xml') if inventory.is_file('METS.xml') else {}
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    package = open_package(temporary_path, aip_name, package_format)
+    try:
+        with metrics.stage('package') as stage:
+            stage['files'] = 0
+            stage['mets_elements'] = 0
+            stage['replacements'] = 0
+            representations = {}
+            # {path relative to the AIP: (size, digests)} of the rewritten metadata files, for the mdRefs of the root METS
+            metadata = {}
+            root_mets_path = None
+            package.add_directory('', sip_path)
+            for directory, directory_names, file_names in inventory.walk():
+                directory = (sip_path / directory)
+                directory_names.sort()
+                for name in directory_names:
+                    member_path = package_member_path(Path(directory, name).relative_to(sip_path), renames, is_directory=True)
+                    package.add_directory(member_path.as_posix(), Path(directory, name))
+                for name in sorted(file_names):
+                    src = Path(directory, name)
+                    member_path = package_member_path(src.relative_to(sip_path), renames)
+                    stage['files'] += 1
+                    if member_path == Path('METS.xml'):
+                        # Needs the final representation METS
+                        root_mets_path = src
+                        continue
+                    if len(member_path.parts) == 3 and member_path.parts[0] == 'representations' and name == 'METS.xml':
+                        tree, mets_update = update_mets_tree(src, (aip_path / member_path))
+                        report_dangling_references(mets_update)
+                        data = get_backend().tostring(tree, mets_update.namespaces)
+                        checksums = hash_bytes(data, mets_algorithms)
+                        package.add_bytes(member_path.as_posix(), data)
+                        representations[(aip_path / member_path.parent)] = (len(data), checksums[mets_algorithm()])
+                        stage['mets_elements'] += mets_update.element_count
+                    elif member_path.parts[0] == 'metadata' and name.lower().endswith('.xml'):
+                        with open(src, 'rb') as source_file, tempfile.SpooledTemporaryFile(max_size=METADATA_SPOOL_SIZE) as rewritten:
+                            count, digests = replace_name_stream(source_file, rewritten, sip_path.stem, aip_name,
+                                                                 list(dict.fromkeys(mets_algorithms + [metadata_algorithms.get(member_path.as_posix(), mets_algorithm())])))
+                            if count:
+                                size = rewritten.tell()
+                                rewritten.seek(0)
+                                package.add_fileobj(member_path.as_posix(), rewritten, size)
+                                metadata[member_path.as_posix()] = (size, digests)
+                                checksums = {algorithm: digests[algorithm] for algorithm in algorithms}
+                                stage['replacements'] += count
+                        if not count:
+                            # Unchanged like update_metadata leaves it
+                            checksums = package.add_file(member_path.as_posix(), src, algorithms)
+                    else:
+                        checksums = package.add_file(member_path.as_posix(), src, algorithms)
+                    if aip_manifest is not None:
+                        aip_manifest.set((aip_path / member_path), checksums)
+
+            # Preservation reps incl. data directory
+            for new_rep_name in renames.values():
+                package.add_directory('representations/%s-preservation' % new_rep_name)
+                package.add_directory('representations/%s-preservation/data' % new_rep_name)
+
+            if root_mets_path is not None:
+                tree, mets_update = update_mets_tree(root_mets_path, (aip_path / 'METS.xml'), representations=dict(sorted(representations.items())), metadata=metadata)
+                report_dangling_references(mets_update)
+                data = get_backend().tostring(tree, mets_update.namespaces)
+                package.add_bytes('METS.xml', data)
+                stage['mets_elements'] += mets_update.element_count
+                if aip_manifest is not None:
+                    aip_manifest.set((aip_path / 'METS.xml'), hash_bytes(data, algorithms))
+
+            if aip_manifest is not None:
+                for algorithm in aip_manifest.algorithms:
+                    package.add_bytes(manifest_name(algorithm), aip_manifest.text(algorithm).encode('utf-8'))
+
+        package.close()
+        os.replace(temporary_path, package_path)
+    except BaseException:
+        package.close()
+        temporary_path.unlink(missing_ok=True)
+        raise
+    finally:
+        metrics.finish()
 
     return aip_name
 
 
 def fatal_error(error:str):
     logging.error(error)
-    # TODO Revert changes?
+    # An unfinished AIP is resumed from its journal when the SIP is converted again, or removed with rollback_aip.py
     sys.exit('Fatal Error: '+ error)
 
 
-def validate_input_directories(sip_path:Path, output_path:Path) -> tuple[Path, Path]:
+def validate_input_directories(sip_path:Path, output_path:Path) -> tuple[Path, Path, Inventory]:
+    # Returns the inventory of the SIP as well, the conversion takes everything it needs to know about the SIP files from it
 
     # SIP must exists
     if not sip_path.exists():
@@ -349,39 +862,83 @@ def validate_input_directories(sip_path:Path, output_path:Path) -> tuple[Path, P
     if not sip_path.is_dir():
         fatal_error(str(sip_path) + " is not a directory")
     
+    inventory = scan_inventory(sip_path)
+
     # SIP must contain representations directory
-    representations_path = (sip_path / 'representations')
-    if not representations_path.is_dir():
+    if not inventory.is_dir('representations'):
         fatal_error("SIP doesn't contain representations directory")
 
     # SIP representations directory must contatin rep directories
-    rep_paths = representations_path.iterdir()
-    if not rep_paths:
+    rep_names = inventory.children('representations')
+    if not rep_names:
         fatal_error("No rep directories found in representations")
         
     # SIP reps must contain METS.xml files
-    for rep_path in rep_paths:
-        mets_path = (rep_path / 'METS.xml')
-        if not mets_path.is_file():
+    for rep_name in rep_names:
+        if not inventory.is_file('representations/%s/METS.xml' % rep_name):
             fatal_error("One or more SIP representations don't contain METS.xml")
 
     # Ouput destination should be a directory if it exists
     if output_path.exists() and not output_path.is_dir():
         fatal_error("Output destination must be a directory")
     
-    return sip_path, output_path
+    return sip_path, output_path, inventory
+
+def validate_conversion_options(options:dict):
+    # Options taken by every script converting SIPs, checked before any SIP is converted
+    require_values(options, CONVERSION_VALUE_OPTIONS)
+
+    if options.get('copy', 'copy') not in COPY_STRATEGIES:
+        fatal_error("Copy strategy must be one of: " + ', '.join(COPY_STRATEGIES))
+
+    if options.get('package') is not None and options['package'] not in PACKAGE_FORMATS:
+        fatal_error("Package format must be one of: " + ', '.join(PACKAGE_FORMATS))
+
+    # Package output streams the SIP files into the package and updates the METS in memory, these would be ignored
+    if options.get('package') is not None:
+        for name in ('dedup', 'streaming'):
+            if name in options:
+                fatal_error("--%s can't be used with --package" % name)
+        if options.get('copy', 'copy') != 'copy':
+            fatal_error("--copy can't be used with --package")
+
 
 def main(argv) -> str:
     Path("logs").mkdir(exist_ok=True)
     logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
+    argv, options = split_options(argv)
     if len(argv) != 2:
         logging.error("Incorrect script call format")
-        sys.exit("Command should have the form:\npython aip_to_eark_aip.py <SIP Directory> <Output Directory>")
-    
-    sip_path, output_path = validate_input_directories(Path(argv[0]), Path(argv[1]))
+        sys.exit("Command should have the form:\npython aip_to_eark_aip.py [--copy=<Strategy>] [--streaming] [--package=<Format>] [--manifest] [--no-resume] [--verify] [--rep-workers=N] [--copy-workers=N] [--dedup=<Store Directory>] [--digests=<Algorithm>,...] [--xml=<Backend>] [--inventory=<Inventory File>] [--metrics=<Metrics File>] [--profile] [--trace-memory] <SIP Directory> <Output Directory>")
+
+    validate_conversion_options(options)
+    copy_strategy = options.get('copy', 'copy')
+    package_format = options.get('package')
 
-    aip_name = transform_sip_to_aip(sip_path, output_path)
+    if 'xml' in options:
+        try:
+            set_backend(options['xml'])
+        except ValueError as e:
+            fatal_error(str(e))
+
+    if 'digests' in options:
+        try:
+            set_algorithms(str(options['digests']).split(','))
+        except ValueError as e:
+            fatal_error(str(e))
+
+    sip_path, output_path, inventory = validate_input_directories(Path(argv[0]), Path(argv[1]))
+    if 'inventory' in options:
+        inventory.write(options['inventory'])
+
+    metrics = PackageMetrics(profile=bool(options.get('profile')), trace_memory=bool(options.get('trace-memory')))
+    aip_name = transform_sip_to_aip(sip_path, output_path, copy_strategy, bool(options.get('streaming')), metrics, bool(options.get('manifest')),
+                                    resume=not options.get('no-resume'), verify=bool(options.get('verify')), package_format=package_format,
+                                    rep_workers=int(options['rep-workers']) if 'rep-workers' in options else None,
+                                    copy_workers=int(options['copy-workers']) if 'copy-workers' in options else None, inventory=inventory,
+                                    dedup_path=Path(options['dedup']) if 'dedup' in options else None)
+    metrics.write(options.get('metrics', DEFAULT_METRICS_PATH))
 
     return aip_name
 
@@ -0,0 +1,178 @@
+from pathlib import Path
+import random
+import sys
+import zipfile
+import xml.etree.ElementTree as ET
+
+import py7zr
+
+from checksum import hash_file
+from sip_to_eark_aip import new_uuid, date_time_now, require_values, split_options
+
+
+# Generate synthetic E-ARK SIPs for benchmarking
+
+NAMESPACES = {
+    'mets': 'http://www.loc.gov/METS/',
+    'csip': 'https://DILCIS.eu/XML/METS/CSIPExtensionMETS',
+    'sip': 'https://DILCIS.eu/XML/METS/SIPExtensionMETS',
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+}
+SCHEMA_LOCATION = "http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/mets.xsd https://dilcis.eu/XML/METS/SIPExtensionMETS https://earkcsip.dilcis.eu/schema/DILCISExtensionSIPMETS.xsd"
+
+
+def write_payload_file(path:Path, size:int, rng:random.Random):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = min(remaining, 1024 * 1024)
+            f.write(rng.randbytes(block))
+            remaining -= block
+
+
+def file_attributes(file_path:Path) -> dict:
+    # SIZE and SHA-256 CHECKSUM of a file referenced by the METS, none if the file doesn't exist
+    if not file_path.is_file():
+        return {}
+    return {'SIZE': str(file_path.stat().st_size), 'CHECKSUM': hash_file(file_path, 'sha256'), 'CHECKSUMTYPE': 'SHA-256'}
+
+
+def write_mets(mets_path:Path, objid:str, file_hrefs:list, rep_names:list=()):
+    # METS with a dmdSec, an amdSec, one file per href and an mptr per representation
+    # hrefs are relative to the METS, the files they reference are written first so their size and checksum can be recorded
+    mets = '{%s}' % NAMESPACES['mets']
+    xlink = '{%s}' % NAMESPACES['xlink']
+    for prefix, uri in NAMESPACES.items():
+        ET.register_namespace(prefix, uri)
+
+    mets_element = ET.Element(mets + 'mets', attrib={
+        'OBJID': objid,
+        'TYPE': 'Mixed',
+        'PROFILE': 'https://earksip.dilcis.eu/profile/E-ARK-SIP.xml',
+        '{%s}schemaLocation' % NAMESPACES['xsi']: SCHEMA_LOCATION,
+        '{%s}CONTENTINFORMATIONTYPE' % NAMESPACES['csip']: 'MIXED',
+    })
+    metsHdr_element = ET.SubElement(mets_element, mets + 'metsHdr', attrib={
+        'CREATEDATE': date_time_now(),
+        '{%s}OAISPACKAGETYPE' % NAMESPACES['csip']: 'SIP',
+    })
+    agent_element = ET.SubElement(metsHdr_element, mets + 'agent', attrib={'ROLE': 'CREATOR', 'TYPE': 'OTHER', 'OTHERTYPE': 'SOFTWARE'})
+    ET.SubElement(agent_element, mets + 'name').text = 'Synthetic SIP Generator'
+    ET.SubElement(metsHdr_element, mets + 'metsDocumentID').text = 'METS.xml'
+
+    dmd_id = new_uuid()
+    dmdSec_element = ET.SubElement(mets_element, mets + 'dmdSec', attrib={'ID': dmd_id, 'CREATED': date_time_now()})
+    ET.SubElement(dmdSec_element, mets + 'mdRef', attrib={
+        'LOCTYPE': 'URL', 'MDTYPE': 'DC', xlink + 'type': 'simple', xlink + 'href': 'metadata/descriptive/DC.xml'})
+    amd_id = new_uuid()
+    amdSec_element = ET.SubElement(mets_element, mets + 'amdSec', attrib={'ID': amd_id})
+    digiprovMD_element = ET.SubElement(amdSec_element, mets + 'digiprovMD', attrib={'ID': new_uuid()})
+    ET.SubElement(digiprovMD_element, mets + 'mdRef', attrib={
+        'LOCTYPE': 'URL', 'MDTYPE': 'PREMIS', xlink + 'type': 'simple', xlink + 'href': 'metadata/preservation/premis.xml'})
+
+    fileSec_element = ET.SubElement(mets_element, mets + 'fileSec', attrib={'ID': new_uuid()})
+    fileGrp_element = ET.SubElement(fileSec_element, mets + 'fileGrp', attrib={'ID': new_uuid(), 'USE': 'Data', 'ADMID': amd_id})
+    file_ids = []
+    # Representation METS reference the payload files in turn, each is hashed once
+    attributes = {}
+    for href in file_hrefs:
+        if href not in attributes:
+            attributes[href] = file_attributes(mets_path.parent / href)
+        file_ids.append(new_uuid('ID'))
+        file_element = ET.SubElement(fileGrp_element, mets + 'file', attrib={
+            'ID': file_ids[-1], 'MIMETYPE': 'application/octet-stream', 'CREATED': date_time_now(), **attributes[href]})
+        ET.SubElement(file_element, mets + 'FLocat', attrib={'LOCTYPE': 'URL', xlink + 'type': 'simple', xlink + 'href': href})
+    rep_fileGrp_ids = []
+    for rep_name in rep_names:
+        rep_fileGrp_ids.append(new_uuid())
+        rep_fileGrp_element = ET.SubElement(fileSec_element, mets + 'fileGrp', attrib={'ID': rep_fileGrp_ids[-1], 'USE': 'Representations/' + rep_name})
+        rep_file_element = ET.SubElement(rep_fileGrp_element, mets + 'file', attrib={
+            'ID': new_uuid('ID'), 'MIMETYPE': 'text/xml', **file_attributes(mets_path.parent / 'representations' / rep_name / 'METS.xml')})
+        ET.SubElement(rep_file_element, mets + 'FLocat', attrib={
+            'LOCTYPE': 'URL', xlink + 'type': 'simple', xlink + 'href': 'representations/%s/METS.xml' % rep_name})
+
+    structMap_element = ET.SubElement(mets_element, mets + 'structMap', attrib={'ID': new_uuid(), 'TYPE': 'PHYSICAL', 'LABEL': 'CSIP'})
+    root_div_element = ET.SubElement(structMap_element, mets + 'div', attrib={'ID': new_uuid(), 'LABEL': objid})
+    ET.SubElement(root_div_element, mets + 'div', attrib={'ID': new_uuid(), 'LABEL': 'Metadata', 'DMDID': dmd_id, 'ADMID': amd_id})
+    data_div_element = ET.SubElement(root_div_element, mets + 'div', attrib={'ID': new_uuid(), 'LABEL': 'Data'})
+    for file_id in file_ids:
+        ET.SubElement(data_div_element, mets + 'fptr', attrib={'FILEID': file_id})
+    for rep_name, rep_fileGrp_id in zip(rep_names, rep_fileGrp_ids):
+        rep_div_element = ET.SubElement(root_div_element, mets + 'div', attrib={'ID': new_uuid(), 'LABEL': 'Representations/' + rep_name})
+        ET.SubElement(rep_div_element, mets + 'mptr', attrib={
+            xlink + 'type': 'simple', xlink + 'href': 'representations/%s/METS.xml' % rep_name, xlink + 'title': rep_fileGrp_id, 'LOCTYPE': 'URL'})
+
+    tree = ET.ElementTree(mets_element)
+    ET.indent(tree, space='    ', level=0)
+    tree.write(mets_path, encoding='utf-8', xml_declaration=True)
+
+
+def create_synthetic_sip(sip_path:Path, representations:int=2, mets_files:int=100, payload_files:int=10, payload_size:int=1024, seed:int=0) -> Path:
+    # Representation METS get mets_files file entries, referencing the payload files in turn
+    rng = random.Random(seed)
+    sip_name = sip_path.name
+
+    (sip_path / 'metadata' / 'descriptive').mkdir(parents=True, exist_ok=True)
+    (sip_path / 'metadata' / 'preservation').mkdir(parents=True, exist_ok=True)
+    (sip_path / 'metadata' / 'descriptive' / 'DC.xml').write_text(
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier>%s</dc:identifier><dc:title>%s</dc:title></metadata>' % (sip_name, sip_name))
+    (sip_path / 'metadata' / 'preservation' / 'premis.xml').write_text(
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        '<premis xmlns="http://www.loc.gov/premis/v3" version="3.0"><object><objectIdentifier><objectIdentifierValue>%s</objectIdentifierValue></objectIdentifier></object></premis>' % sip_name)
+
+    rep_names = ['rep%d' % (rep + 1) for rep in range(representations)]
+    for rep_name in rep_names:
+        rep_path = (sip_path / 'representations' / rep_name)
+        payload_hrefs = []
+        for index in range(payload_files):
+            payload_hrefs.append('data/file%06d.bin' % index)
+            write_payload_file((rep_path / payload_hrefs[-1]), payload_size, rng)
+        file_hrefs = [payload_hrefs[index % len(payload_hrefs)] if payload_hrefs else 'data/missing.bin' for index in range(mets_files)]
+        write_mets((rep_path / 'METS.xml'), rep_name, file_hrefs)
+
+    write_mets((sip_path / 'METS.xml'), sip_name, [], rep_names)
+    return sip_path
+
+
+def create_preservation_payload(rep_preservation_path:Path, archive_format:str='zip', files:int=10, file_size:int=1024, seed:int=0) -> Path:
+    # Single zip or 7z in the preservation representation data directory, as Archivematica produces
+    rng = random.Random(seed)
+    data_path = (rep_preservation_path / 'data')
+    data_path.mkdir(parents=True, exist_ok=True)
+    archive_path = (data_path / ('%s.%s' % (new_uuid(), archive_format)))
+    if archive_format == 'zip':
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for index in range(files):
+                archive.writestr('objects/file%06d.bin' % index, rng.randbytes(file_size))
+    elif archive_format == '7z':
+        with py7zr.SevenZipFile(archive_path, 'w') as archive:
+            for index in range(files):
+                archive.writestr(rng.randbytes(file_size), 'objects/file%06d.bin' % index)
+    else:
+        raise ValueError("Unknown archive format '%s'" % archive_format)
+    return archive_path
+
+
+def main(argv) -> Path:
+    argv, options = split_options(argv)
+    if len(argv) != 1:
+        sys.exit("Command should have the form:\npython synthetic_sip.py [--representations=N] [--mets-files=N] [--payload-files=N] [--payload-size=Bytes] [--seed=N] <SIP Directory>")
+    require_values(options, ['representations', 'mets-files', 'payload-files', 'payload-size', 'seed'])
+
+    sip_path = Path(argv[0])
+    if sip_path.exists():
+        sys.exit(str(sip_path) + " already exists")
+    return create_synthetic_sip(
+        sip_path,
+        representations=int(options.get('representations', 2)),
+        mets_files=int(options.get('mets-files', 100)),
+        payload_files=int(options.get('payload-files', 10)),
+        payload_size=int(options.get('payload-size', 1024)),
+        seed=int(options.get('seed', 0)))
+
+
+if __name__ == '__main__':
+    print(main(sys.argv[1:]))
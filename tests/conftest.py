@@ -0,0 +1,5 @@
+from pathlib import Path
+import sys
+
+# The scripts are top level modules of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,27 @@
+import os
+
+import batch_sip_to_eark_aip
+from batch_sip_to_eark_aip import convert_sip, transform_sips
+from synthetic_sip import create_synthetic_sip
+
+
+def crashing_convert_sip(sip_path, output_path, options, metrics_options=None):
+    # Takes its worker process down on the SIP named 'crash', like a segfault in a parser would
+    if sip_path.name == 'crash':
+        os._exit(1)
+    return convert_sip(sip_path, output_path, options, metrics_options)
+
+
+def test_sip_that_kills_its_worker_fails_alone(tmp_path, monkeypatch):
+    # Workers are forked, so they see the patched conversion
+    monkeypatch.setattr(batch_sip_to_eark_aip, 'convert_sip', crashing_convert_sip)
+    sip_paths = [create_synthetic_sip(tmp_path / 'sips' / name, representations=1, mets_files=2, payload_files=2) for name in ('a', 'crash', 'b', 'c')]
+    (tmp_path / 'out').mkdir()
+
+    results = transform_sips(sip_paths, tmp_path / 'out', workers=2, metrics_options={'metrics_path': tmp_path / 'metrics.jsonl'})
+
+    assert list(results) == sip_paths
+    assert results[sip_paths[1]] == (False, "The worker process converting it died")
+    assert all(results[sip_path][0] for sip_path in sip_paths if sip_path.name != 'crash')
+    # A conversion killed with the pool, before it wrote anything, may leave an empty hidden journal
+    assert sorted(path.name for path in (tmp_path / 'out').iterdir() if not path.name.startswith('.')) == sorted(results[sip_path][1] for sip_path in sip_paths if sip_path.name != 'crash')
@@ -0,0 +1,104 @@
+import errno
+import hashlib
+import os
+
+import pytest
+
+import content_store
+from content_store import ContentStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Hardlink from the store whatever the filesystem under tmp_path supports
+    def no_reflink(src, dst):
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported")
+    monkeypatch.setattr(content_store, 'reflink_file', no_reflink)
+    with ContentStore(tmp_path / 'store') as store:
+        yield store
+
+
+def write(path, data:bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def test_identical_files_are_stored_once(tmp_path, store):
+    data = b'payload' * 1000
+    src_a = write(tmp_path / 'sip_a' / 'file.bin', data)
+    src_b = write(tmp_path / 'sip_b' / 'other.bin', data)
+    (tmp_path / 'aip').mkdir()
+
+    digests_a, hit_a = store.link(src_a, tmp_path / 'aip' / 'a.bin', ['md5'])
+    digests_b, hit_b = store.link(src_b, tmp_path / 'aip' / 'b.bin', ['md5'])
+
+    assert (hit_a, hit_b) == (False, True)
+    assert digests_a == digests_b == {'sha256': hashlib.sha256(data).hexdigest(), 'md5': hashlib.md5(data).hexdigest()}
+    object_path = store.object_path(digests_a['sha256'])
+    assert os.stat(tmp_path / 'aip' / 'a.bin').st_ino == os.stat(object_path).st_ino == os.stat(tmp_path / 'aip' / 'b.bin').st_ino
+    assert store.saved_bytes == len(data)
+    store.flush()
+    assert store.stats() == {'objects': 1, 'stored_bytes': len(data), 'links': 2, 'saved_bytes': len(data)}
+
+
+def test_new_file_is_read_once(tmp_path, store, monkeypatch):
+    # A size the store doesn't have is hashed while it's copied into the store
+    def hash_file_digests(*args):
+        raise AssertionError("file read twice")
+    monkeypatch.setattr(content_store, 'hash_file_digests', hash_file_digests)
+    src = write(tmp_path / 'sip' / 'file.bin', b'new content')
+    (tmp_path / 'aip').mkdir()
+
+    digests, hit = store.link(src, tmp_path / 'aip' / 'file.bin')
+
+    assert not hit
+    assert (tmp_path / 'aip' / 'file.bin').read_bytes() == b'new content'
+    assert store.object_path(digests['sha256']).read_bytes() == b'new content'
+    assert not [path for path in (store.store_path / 'objects').rglob('.tmp-*')]
+
+
+def test_link_limit_rolls_over_to_a_new_replica(tmp_path, store, monkeypatch):
+    data = b'schema' * 100
+    src = write(tmp_path / 'sip' / 'schema.xsd', data)
+    (tmp_path / 'aip').mkdir()
+    digests, _ = store.link(src, tmp_path / 'aip' / 'first.xsd')
+    object_path = store.object_path(digests['sha256'])
+    full_inode = os.stat(object_path).st_ino
+
+    link = content_store.hardlink_file
+
+    def hardlink_file(src, dst):
+        if os.stat(src).st_ino == full_inode:
+            raise OSError(errno.EMLINK, "Too many links")
+        link(src, dst)
+    monkeypatch.setattr(content_store, 'hardlink_file', hardlink_file)
+
+    _, hit = store.link(src, tmp_path / 'aip' / 'second.xsd')
+
+    assert hit
+    assert os.stat(object_path).st_ino != full_inode
+    assert os.stat(tmp_path / 'aip' / 'second.xsd').st_ino == os.stat(object_path).st_ino
+    # Files linked before keep the old replica
+    assert os.stat(tmp_path / 'aip' / 'first.xsd').st_ino == full_inode
+    assert (tmp_path / 'aip' / 'second.xsd').read_bytes() == data
+
+
+def test_store_on_another_filesystem_is_copied_from(tmp_path, store, monkeypatch):
+    def hardlink_file(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(content_store, 'hardlink_file', hardlink_file)
+    src = write(tmp_path / 'sip' / 'file.bin', b'data')
+    os.chmod(src, 0o640)
+    (tmp_path / 'aip').mkdir()
+
+    store.link(src, tmp_path / 'aip' / 'a.bin')
+    _, hit = store.link(src, tmp_path / 'aip' / 'b.bin')
+
+    assert hit and not store.hardlink
+    for name in ('a.bin', 'b.bin'):
+        path = tmp_path / 'aip' / name
+        assert path.read_bytes() == b'data'
+        # A copy, with the metadata of the SIP file
+        assert os.stat(path).st_nlink == 1
+        assert os.stat(path).st_mode & 0o777 == 0o640
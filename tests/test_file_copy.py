@@ -0,0 +1,41 @@
+import errno
+import os
+
+import pytest
+
+import file_copy
+from file_copy import detect_copy_strategy
+
+
+def no_reflink(src, dst):
+    open(dst, 'wb').close()
+    raise OSError(errno.EOPNOTSUPP, "reflink not supported")
+
+
+@pytest.mark.parametrize('copy_file_range, expected', [(True, 'kernel'), (False, 'copy')])
+def test_auto_without_reflink(tmp_path, monkeypatch, copy_file_range, expected):
+    monkeypatch.setattr(file_copy, 'reflink_file', no_reflink)
+    if not copy_file_range:
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    elif not hasattr(os, 'copy_file_range'):
+        pytest.skip("os.copy_file_range isn't available")
+    # Copying the file in the probe would fail the test
+    monkeypatch.setattr(file_copy, 'kernel_copy_file', None)
+    src = tmp_path / 'payload.bin'
+    src.write_bytes(b'x' * 1024)
+    (tmp_path / 'aip').mkdir()
+
+    assert detect_copy_strategy(src, tmp_path / 'aip') == expected
+    assert list((tmp_path / 'aip').iterdir()) == []
+
+
+def test_auto_with_reflink(tmp_path, monkeypatch):
+    cloned = []
+    monkeypatch.setattr(file_copy, 'reflink_file', lambda src, dst: cloned.append((src, dst)) or open(dst, 'wb').close())
+    src = tmp_path / 'payload.bin'
+    src.write_bytes(b'x')
+    (tmp_path / 'aip').mkdir()
+
+    assert detect_copy_strategy(src, tmp_path / 'aip') == 'reflink'
+    assert [src_path for src_path, _ in cloned] == [src]
+    assert list((tmp_path / 'aip').iterdir()) == []
@@ -0,0 +1,133 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import os
+
+import pytest
+
+import queue_sip_to_eark_aip
+from job_queue import JobQueue
+from queue_sip_to_eark_aip import QueueWorker, run_job
+from synthetic_sip import create_synthetic_sip
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return tmp_path / 'queue.sqlite'
+
+
+def claim_all(queue_path, worker:str) -> list:
+    with JobQueue(queue_path) as queue:
+        claimed = []
+        while True:
+            job = queue.claim(worker)
+            if job is None:
+                return claimed
+            claimed.append(job['id'])
+
+
+def test_jobs_are_added_once_and_claimed_in_order(tmp_path, queue_path):
+    with JobQueue(queue_path) as queue:
+        assert queue.add('aip', tmp_path / 'sip1', tmp_path / 'out')
+        assert queue.add('aip', tmp_path / 'sip2', tmp_path / 'out')
+        assert not queue.add('aip', tmp_path / 'sip1', tmp_path / 'out')
+        with pytest.raises(ValueError):
+            queue.add('unknown', tmp_path / 'sip3')
+
+        first, second = queue.claim('a'), queue.claim('b')
+        assert (first['path'], first['worker'], first['attempts']) == (str(tmp_path / 'sip1'), 'a', 1)
+        assert second['path'] == str(tmp_path / 'sip2')
+        assert queue.claim('c') is None
+        assert queue.finish(first, True, 'uuid-1')
+        assert queue.counts() == {'queued': 0, 'running': 1, 'done': 1, 'failed': 0}
+
+
+def test_concurrent_workers_claim_every_job_once(tmp_path, queue_path):
+    with JobQueue(queue_path) as queue:
+        for index in range(40):
+            queue.add('aip', tmp_path / ('sip%d' % index), tmp_path / 'out')
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        claimed = [job_id for ids in executor.map(claim_all, [queue_path] * 4, ['w%d' % worker for worker in range(4)]) for job_id in ids]
+    assert sorted(claimed) == list(range(1, 41))
+
+
+def test_stale_job_is_requeued_and_fenced(tmp_path, queue_path, clock):
+    with JobQueue(queue_path, now=clock.time) as queue:
+        queue.add('aip', tmp_path / 'sip', tmp_path / 'out')
+        stalled = queue.claim('a')
+
+        clock.now += 100
+        assert queue.requeue_stale(timeout=300) == []
+        assert queue.heartbeat([stalled]) == []
+        clock.now += 301
+        assert [job['id'] for job in queue.requeue_stale(timeout=300)] == [stalled['id']]
+
+        taken_over = queue.claim('b')
+        assert (taken_over['id'], taken_over['claim'], taken_over['attempts']) == (stalled['id'], 2, 2)
+        # The first worker comes back, its heartbeat and result are refused
+        assert queue.heartbeat([stalled]) == [stalled]
+        assert not queue.finish(stalled, False, 'late failure')
+        assert queue.finish(taken_over, True, 'uuid-1')
+        assert queue.jobs('done')[0]['result'] == 'uuid-1'
+
+
+def test_job_fails_after_max_attempts(tmp_path, queue_path, clock):
+    with JobQueue(queue_path, now=clock.time) as queue:
+        queue.add('aip', tmp_path / 'sip', tmp_path / 'out')
+        for attempt in range(2):
+            queue.claim('w%d' % attempt)
+            clock.now += 301
+            queue.requeue_stale(timeout=300, max_attempts=2)
+        assert queue.counts()['failed'] == 1
+        assert queue.claim('w') is None
+
+        assert queue.requeue_failed() == 1
+        job = queue.claim('w')
+        assert (job['attempts'], job['claim']) == (1, 3)
+
+
+def test_release_does_not_count_an_attempt(tmp_path, queue_path):
+    with JobQueue(queue_path) as queue:
+        queue.add('aip', tmp_path / 'sip', tmp_path / 'out')
+        job = queue.claim('a')
+        assert queue.release(job)
+        assert not queue.release(job)
+        job = queue.claim('b')
+        assert (job['attempts'], job['claim']) == (1, 2)
+
+
+def crashing_run_job(job, options, metrics_options=None, preservation_options=None):
+    # Takes its worker process down on the SIP named 'crash', like a segfault in a parser would
+    if Path(job['path']).name == 'crash':
+        os._exit(1)
+    return run_job(job, options, metrics_options, preservation_options)
+
+
+def test_job_that_kills_its_worker_fails_alone(tmp_path, queue_path, monkeypatch):
+    # Workers are forked, so they see the patched job
+    monkeypatch.setattr(queue_sip_to_eark_aip, 'run_job', crashing_run_job)
+    (tmp_path / 'out').mkdir()
+    with JobQueue(queue_path) as queue:
+        for name in ('a', 'crash', 'b', 'c'):
+            queue.add('aip', create_synthetic_sip(tmp_path / 'sips' / name, representations=1, mets_files=2, payload_files=2), tmp_path / 'out')
+
+    status = QueueWorker(queue_path, workers=2, poll_interval=0.05, metrics_options={'metrics_path': tmp_path / 'metrics.jsonl'}).run(once=True)
+
+    assert (status['completed'], status['failed']) == (3, 1)
+    with JobQueue(queue_path) as queue:
+        failed, = queue.jobs('failed')
+        assert (Path(failed['path']).name, failed['result']) == ('crash', "The worker process running it died")
+        # The jobs that shared the pool with it weren't charged another attempt
+        assert [job['attempts'] for job in queue.jobs()] == [1, 1, 1, 1]
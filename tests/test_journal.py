@@ -0,0 +1,95 @@
+import hashlib
+
+import pytest
+
+import file_copy
+import rollback_aip
+from journal import JournalLockedError, create_journal, find_journal
+from sip_to_eark_aip import transform_sip_to_aip
+from synthetic_sip import create_synthetic_sip
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.fixture
+def sip_path(tmp_path):
+    return create_synthetic_sip(tmp_path / 'sip', representations=2, mets_files=5, payload_files=5, payload_size=256)
+
+
+def check_manifest(aip_path):
+    for line in (aip_path / 'manifest-sha256.txt').read_text().splitlines():
+        checksum, relative_path = line.split('  ', 1)
+        assert hashlib.sha256((aip_path / relative_path).read_bytes()).hexdigest() == checksum, relative_path
+
+
+def payload_digests(path):
+    return sorted(hashlib.sha256(file.read_bytes()).hexdigest() for file in path.rglob('*.bin'))
+
+
+@pytest.mark.parametrize('crash_after', [1, 6, 12])
+def test_resume_after_crash(tmp_path, sip_path, monkeypatch, crash_after):
+    output_path = tmp_path / 'out'
+    output_path.mkdir()
+    copy_file = file_copy.copy_file
+    calls = []
+
+    def crashing_copy_file(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == crash_after:
+            raise Crash()
+        return copy_file(*args, **kwargs)
+    monkeypatch.setattr(file_copy, 'copy_file', crashing_copy_file)
+    with pytest.raises(Crash):
+        transform_sip_to_aip(sip_path, output_path, manifest=True, copy_workers=1)
+    monkeypatch.setattr(file_copy, 'copy_file', copy_file)
+
+    unfinished = rollback_aip.unfinished_aips(output_path)
+    assert list(unfinished.values()) == [str(sip_path.resolve())]
+
+    aip_name = transform_sip_to_aip(sip_path, output_path, manifest=True, copy_workers=1)
+
+    assert list(unfinished) == [aip_name]
+    assert sorted(path.name for path in output_path.iterdir()) == [aip_name]
+    check_manifest(output_path / aip_name)
+    # Representations are renamed, every payload file is there once
+    assert payload_digests(output_path / aip_name / 'representations') == payload_digests(sip_path / 'representations')
+
+
+def test_running_conversion_is_not_resumed(tmp_path, sip_path):
+    output_path = tmp_path / 'out'
+    output_path.mkdir()
+    journal = create_journal(output_path, sip_path, 'uuid-running')
+
+    with pytest.raises(JournalLockedError):
+        find_journal(output_path, sip_path)
+    with pytest.raises(SystemExit):
+        transform_sip_to_aip(sip_path, output_path)
+    assert rollback_aip.rollback(output_path) == []
+    assert (output_path / 'uuid-running').is_dir()
+
+    # Resumable once the conversion stopped
+    journal.close()
+    resumed = find_journal(output_path, sip_path)
+    assert resumed is not None and resumed.aip_name == 'uuid-running'
+    resumed.close()
+    assert rollback_aip.rollback(output_path) == ['uuid-running']
+    assert list(output_path.iterdir()) == []
+
+
+def test_journal_left_under_its_temporary_name_is_removed(tmp_path, sip_path):
+    # The conversion was killed after creating its AIP directory, before its journal was renamed into place
+    output_path = tmp_path / 'out'
+    output_path.mkdir()
+    journal = create_journal(output_path, sip_path, 'uuid-killed')
+    temporary_path = output_path / '.uuid-killed.journal.tmp'
+    journal.journal_path.rename(temporary_path)
+
+    # Still being created
+    assert find_journal(output_path, sip_path) is None
+    assert temporary_path.is_file() and (output_path / 'uuid-killed').is_dir()
+    journal.close()
+
+    assert find_journal(output_path, sip_path) is None
+    assert list(output_path.iterdir()) == []
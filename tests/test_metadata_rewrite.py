@@ -0,0 +1,74 @@
+import hashlib
+import shutil
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from metadata_rewrite import replace_name, replace_name_in_file
+from sip_to_eark_aip import transform_sip_to_aip
+from synthetic_sip import create_synthetic_sip
+
+
+def test_text_and_attributes_are_replaced(tmp_path):
+    source = tmp_path / 'DC.xml'
+    source.write_text('<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<!-- sip-1 --><metadata xmlns:dc="http://purl.org/dc/elements/1.1/" id="sip-1">'
+                      '<dc:identifier>sip-1</dc:identifier><dc:title>A &amp; sip-1<![CDATA[sip-1 <raw>]]></dc:title><empty ref="x sip-1" /></metadata>', encoding='utf-8')
+
+    replacements, digests = replace_name(source, tmp_path / 'out.xml', 'sip-1', 'uuid-1', ['sha256'])
+
+    assert replacements == 5
+    assert (tmp_path / 'out.xml').read_text(encoding='utf-8') == ('<?xml version="1.0" encoding="utf-8"?>\n'
+        '<!-- sip-1 --><metadata xmlns:dc="http://purl.org/dc/elements/1.1/" id="uuid-1">'
+        '<dc:identifier>uuid-1</dc:identifier><dc:title>A &amp; uuid-1<![CDATA[uuid-1 <raw>]]></dc:title><empty ref="x uuid-1"/></metadata>')
+    assert list(digests) == ['sha256']
+
+
+def test_namespaces_and_schema_locations_are_kept(tmp_path):
+    source = tmp_path / 'ead.xml'
+    source.write_text('<ead xmlns="urn:sip-1:ead" xmlns:s="http://www.w3.org/2001/XMLSchema-instance" s:schemaLocation="urn:sip-1:ead sip-1.xsd">'
+                      '<c xmlns:p="urn:sip-1" p:ref="sip-1" s:noNamespaceSchemaLocation="sip-1.xsd">sip-1</c>'
+                      '<d xmlns:s="urn:other" s:schemaLocation="sip-1" /></ead>', encoding='utf-8')
+
+    replacements, _ = replace_name_in_file(source, 'sip-1', 'uuid-1')
+
+    assert replacements == 3
+    assert source.read_text(encoding='utf-8') == ('<ead xmlns="urn:sip-1:ead" xmlns:s="http://www.w3.org/2001/XMLSchema-instance" s:schemaLocation="urn:sip-1:ead sip-1.xsd">'
+                                                  '<c xmlns:p="urn:sip-1" p:ref="uuid-1" s:noNamespaceSchemaLocation="sip-1.xsd">uuid-1</c>'
+                                                  '<d xmlns:s="urn:other" s:schemaLocation="uuid-1"/></ead>')
+
+
+def test_file_without_the_name_is_untouched(tmp_path):
+    source = tmp_path / 'premis.xml'
+    source.write_text("<premis  a='1'>other</premis>", encoding='utf-8')
+    mtime = source.stat().st_mtime_ns
+
+    assert replace_name_in_file(source, 'sip-1', 'uuid-1') == (0, None)
+    assert source.read_text(encoding='utf-8') == "<premis  a='1'>other</premis>"
+    assert source.stat().st_mtime_ns == mtime
+    assert [path.name for path in tmp_path.iterdir()] == ['premis.xml']
+
+
+@pytest.mark.parametrize('package_format', ['tar', 'zip'])
+def test_package_output_rewrites_metadata_like_directory_output(tmp_path, package_format):
+    sip_path = create_synthetic_sip(tmp_path / 'sip-1', representations=1, mets_files=2, payload_files=2, payload_size=64)
+    mets_path = sip_path / 'METS.xml'
+    # mdRefs with a size and a checksum of another type than the METS algorithm
+    mets_path.write_text(mets_path.read_text(encoding='utf-8').replace('MDTYPE="DC"', 'MDTYPE="DC" SIZE="1" CHECKSUM="0" CHECKSUMTYPE="MD5"'), encoding='utf-8')
+
+    directory_name = transform_sip_to_aip(sip_path, tmp_path / 'directory', manifest=True)
+    package_name = transform_sip_to_aip(sip_path, tmp_path / 'package', manifest=True, package_format=package_format)
+    shutil.unpack_archive(tmp_path / 'package' / (package_name + '.' + package_format), tmp_path / 'unpacked')
+
+    dc = {}
+    for aip_path in (tmp_path / 'directory' / directory_name, tmp_path / 'unpacked' / package_name):
+        dc_path = aip_path / 'metadata' / 'descriptive' / 'DC.xml'
+        data = dc_path.read_bytes()
+        assert b'sip-1' not in data
+        dc[aip_path] = data.replace(aip_path.name.encode(), b'AIP')
+        md_ref = ET.parse(aip_path / 'METS.xml').getroot().find('.//{http://www.loc.gov/METS/}mdRef[@MDTYPE="DC"]')
+        assert (md_ref.get('SIZE'), md_ref.get('CHECKSUMTYPE'), md_ref.get('CHECKSUM')) == (str(len(data)), 'MD5', hashlib.md5(data).hexdigest())
+        for line in (aip_path / 'manifest-sha256.txt').read_text().splitlines():
+            checksum, relative_path = line.split('  ', 1)
+            assert hashlib.sha256((aip_path / relative_path).read_bytes()).hexdigest() == checksum, relative_path
+    assert len(set(dc.values())) == 1
@@ -0,0 +1,59 @@
+import logging
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from sip_to_eark_aip import update_mets
+
+
+METS = '{http://www.loc.gov/METS/}'
+
+
+def write_mets(mets_path):
+    # Every kind of ID reference, incl. an IDREFS list and one FILEID that matches no ID
+    mets_path.parent.mkdir(parents=True)
+    mets_path.write_text('<?xml version="1.0" encoding="utf-8"?>\n'
+                         '<mets xmlns="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                         'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:csip="https://DILCIS.eu/XML/METS/CSIPExtensionMETS" OBJID="rep1">'
+                         '<metsHdr CREATEDATE="2020-01-01T00:00:00" />'
+                         '<dmdSec ID="dmd-1"><mdRef LOCTYPE="URL" MDTYPE="DC" xlink:href="metadata/DC.xml" /></dmdSec>'
+                         '<amdSec ID="amd-1"><digiprovMD ID="digiprov-1" /></amdSec>'
+                         '<amdSec ID="amd-2" />'
+                         '<fileSec ID="filesec-1"><fileGrp ID="grp-1" USE="Data" ADMID="amd-1 amd-2">'
+                         '<file ID="file-1" DMDID="dmd-1"><FLocat LOCTYPE="URL" xlink:href="data/a.bin" /></file>'
+                         '<file ID="file-2" ADMID="amd-2"><FLocat LOCTYPE="URL" xlink:href="data/b.bin" /></file>'
+                         '</fileGrp></fileSec>'
+                         '<structMap ID="struct-1" TYPE="PHYSICAL"><div ID="div-1" LABEL="rep1">'
+                         '<div ID="div-2" LABEL="Metadata" DMDID="dmd-1" ADMID="amd-1" />'
+                         '<div ID="div-3" LABEL="Data"><fptr FILEID="file-1" /><fptr FILEID="file-2" /><fptr FILEID="file-missing" /></div>'
+                         '<div ID="div-4" LABEL="Other"><mptr xlink:href="other.xml" xlink:title="grp-1" /></div>'
+                         '</div></structMap>'
+                         '</mets>', encoding='utf-8')
+    return mets_path
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_id_references_follow_the_new_ids(tmp_path, caplog, streaming):
+    mets_path = write_mets(tmp_path / 'aip' / 'representations' / 'rep1' / 'METS.xml')
+
+    with caplog.at_level(logging.WARNING):
+        mets_update = update_mets(mets_path, streaming)
+
+    root = ET.parse(mets_path).getroot()
+    new_ids = mets_update.id_updates
+    assert sorted(new_ids) == ['amd-1', 'amd-2', 'digiprov-1', 'div-1', 'div-2', 'div-3', 'div-4', 'dmd-1', 'file-1', 'file-2', 'filesec-1', 'grp-1', 'struct-1']
+    assert new_ids['file-1'].startswith('ID-') and new_ids['dmd-1'].startswith('uuid-')
+    assert sorted(element.get('ID') for element in root.iter() if element.get('ID') is not None) == sorted(new_ids.values())
+
+    file_grp = root.find('%sfileSec/%sfileGrp' % (METS, METS))
+    assert file_grp.get('ADMID') == '%s %s' % (new_ids['amd-1'], new_ids['amd-2'])
+    files = file_grp.findall(METS + 'file')
+    assert (files[0].get('DMDID'), files[1].get('ADMID')) == (new_ids['dmd-1'], new_ids['amd-2'])
+    metadata_div = root.find('.//%sdiv[@LABEL="Metadata"]' % METS)
+    assert (metadata_div.get('DMDID'), metadata_div.get('ADMID')) == (new_ids['dmd-1'], new_ids['amd-1'])
+    assert [fptr.get('FILEID') for fptr in root.iter(METS + 'fptr')] == [new_ids['file-1'], new_ids['file-2'], 'file-missing']
+    assert root.find('.//%smptr' % METS).get('{http://www.w3.org/1999/xlink}title') == new_ids['grp-1']
+
+    assert mets_update.dangling_references == [(METS + 'fptr', 'FILEID', 'file-missing')]
+    assert [record.getMessage() for record in caplog.records if 'unknown ID' in record.getMessage()] == [
+        "%s: %sfptr FILEID references unknown ID 'file-missing'" % (mets_path, METS)]
@@ -0,0 +1,28 @@
+import pytest
+
+from sip_to_eark_aip import split_options, validate_conversion_options
+
+
+@pytest.mark.parametrize('argv', [
+    ['--package=tar', '--dedup=store'],
+    ['--package=zip', '--streaming'],
+    ['--package=tar.gz', '--copy=reflink'],
+])
+def test_options_ignored_by_package_output_are_rejected(argv):
+    _, options = split_options(argv)
+    with pytest.raises(SystemExit, match='--package'):
+        validate_conversion_options(options)
+
+
+def test_package_output_options_are_accepted():
+    _, options = split_options(['--package=tar', '--copy=copy', '--manifest'])
+    validate_conversion_options(options)
+
+
+@pytest.mark.parametrize('name', ['workers', 'rep-workers', 'copy-workers', 'copy', 'package', 'dedup', 'digests'])
+def test_value_option_without_a_value_is_rejected(name):
+    # A bare --workers used to run with int(True), a single worker
+    _, options = split_options(['--' + name, 'sip'])
+    assert options[name] is True
+    with pytest.raises(SystemExit, match='--%s needs a value' % name):
+        validate_conversion_options(options)
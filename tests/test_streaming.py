@@ -0,0 +1,42 @@
+from pathlib import Path
+import re
+import xml.etree.ElementTree as ET
+
+from sip_to_eark_aip import transform_sip_to_aip
+from synthetic_sip import create_synthetic_sip
+
+
+METS = '{http://www.loc.gov/METS/}'
+XLINK = '{http://www.w3.org/1999/xlink}'
+
+
+def canonical_mets(mets_path) -> str:
+    # The METS in canonical form, with the generated IDs and AIP name numbered in order of appearance and dates fixed
+    # The checksums of representation METS are dropped, they differ with the IDs in them
+    root = ET.parse(mets_path).getroot()
+    for file_element in root.iter(METS + 'file'):
+        flocat = file_element.find(METS + 'FLocat')
+        if flocat is not None and flocat.get(XLINK + 'href', '').endswith('METS.xml'):
+            file_element.attrib.pop('CHECKSUM', None)
+    for element in root.iter():
+        for name in ('CREATED', 'CREATEDATE', 'LASTMODDATE'):
+            if name in element.attrib:
+                element.set(name, 'DATE')
+    ids = {}
+    data = re.sub(r'\b(?:uuid|ID)-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b',
+                  lambda match: ids.setdefault(match.group(0), 'ID%d' % len(ids)), ET.tostring(root, encoding='unicode'))
+    return ET.canonicalize(data, strip_text=True)
+
+
+def test_streaming_and_tree_write_the_same_mets(tmp_path):
+    sip_path = create_synthetic_sip(tmp_path / 'sip-1', representations=2, mets_files=5, payload_files=3, payload_size=64)
+
+    tree_name = transform_sip_to_aip(sip_path, tmp_path / 'tree')
+    streaming_name = transform_sip_to_aip(sip_path, tmp_path / 'streaming', streaming=True)
+
+    tree_path, streaming_path = (tmp_path / 'tree' / tree_name), (tmp_path / 'streaming' / streaming_name)
+    rep_mets_paths = sorted(path.relative_to(tree_path) for path in tree_path.glob('representations/*/METS.xml'))
+    assert rep_mets_paths == sorted(path.relative_to(streaming_path) for path in streaming_path.glob('representations/*/METS.xml'))
+    assert rep_mets_paths
+    for relative_path in [Path('METS.xml')] + rep_mets_paths:
+        assert canonical_mets(tree_path / relative_path) == canonical_mets(streaming_path / relative_path), relative_path
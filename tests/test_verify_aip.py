@@ -0,0 +1,38 @@
+import json
+
+import verify_aip
+from sip_to_eark_aip import transform_sip_to_aip
+from synthetic_sip import create_synthetic_sip
+
+
+def convert(tmp_path, name:str):
+    sip_path = create_synthetic_sip(tmp_path / 'sips' / name, representations=2, mets_files=6, payload_files=3, payload_size=256)
+    (tmp_path / 'aips').mkdir(exist_ok=True)
+    return tmp_path / 'aips' / transform_sip_to_aip(sip_path, tmp_path / 'aips')
+
+
+def test_aips_are_verified(tmp_path):
+    good, corrupt = convert(tmp_path, 'good'), convert(tmp_path, 'corrupt')
+    payload = next((corrupt / 'representations').glob('*/data/file000001.bin'))
+    payload.write_bytes(bytes(256))
+    (tmp_path / 'aips' / 'empty').mkdir()
+
+    reports = {report['aip']: report for report in verify_aip.verify_aips(verify_aip.find_aips([tmp_path / 'aips']), workers=1, quiet=True)}
+
+    assert reports[str(good)]['passed'] and reports[str(good)]['failures'] == []
+    # The root METS lists 2 representation METS, each lists 6 payload files
+    assert (reports[str(good)]['files'], reports[str(good)]['verified']) == (14, 14)
+    assert not reports[str(corrupt)]['passed']
+    # The payload file is listed twice
+    assert [failure['error'] for failure in reports[str(corrupt)]['failures']] == ['checksum mismatch'] * 2
+    assert reports[str(tmp_path / 'aips' / 'empty')]['failures'] == [{'path': str(tmp_path / 'aips' / 'empty' / 'METS.xml'), 'error': 'missing'}]
+
+
+def test_report_file(tmp_path, monkeypatch, capsys):
+    good = convert(tmp_path, 'good')
+    monkeypatch.chdir(tmp_path)
+
+    assert verify_aip.main(['--quiet', '--report=report.json', str(good)])
+
+    assert capsys.readouterr().out == "%s\tPASS\t14 files\t0 failures\n" % good
+    assert [report['aip'] for report in json.loads((tmp_path / 'report.json').read_text())] == [str(good)]
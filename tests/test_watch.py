@@ -0,0 +1,44 @@
+import os
+
+import batch_sip_to_eark_aip
+import watch_sip_to_eark_aip
+from synthetic_sip import create_synthetic_sip
+from watch_sip_to_eark_aip import WatchService
+
+
+def crashing_convert_sip(sip_path, output_path, options, metrics_options=None):
+    # Takes its worker process down on the SIP named 'crash', like a segfault in a parser would
+    if sip_path.name == 'crash':
+        os._exit(1)
+    return batch_sip_to_eark_aip.convert_sip(sip_path, output_path, options, metrics_options)
+
+
+def test_sip_that_kills_its_worker_is_quarantined(tmp_path, monkeypatch):
+    # Workers are forked, so they see the patched conversion
+    monkeypatch.setattr(watch_sip_to_eark_aip, 'convert_sip', crashing_convert_sip)
+    inbox = tmp_path / 'inbox'
+    for name in ('crash', 'good'):
+        create_synthetic_sip(inbox / name, representations=1, mets_files=2, payload_files=2)
+    service = WatchService(inbox, tmp_path / 'outbox', tmp_path / 'quarantine', workers=2, settle_time=0, poll_interval=0.05,
+                           status_path=tmp_path / 'status.json', metrics_options={'metrics_path': tmp_path / 'metrics.jsonl'})
+
+    status = service.run(once=True)
+
+    assert (status['completed'], status['failed']) == (1, 1)
+    assert sorted(path.name for path in (tmp_path / 'quarantine').iterdir()) == ['crash', 'crash.error']
+    assert 'worker process' in (tmp_path / 'quarantine' / 'crash.error').read_text(encoding='utf-8')
+    assert len([path for path in (tmp_path / 'outbox').iterdir() if not path.name.startswith('.')]) == 1
+    assert [path.name for path in inbox.iterdir()] == ['.processed']
+    assert [path.name for path in (inbox / '.processed').iterdir()] == ['good']
+
+
+def test_processed_sip_is_deleted_only_when_asked(tmp_path):
+    inbox = tmp_path / 'inbox'
+    create_synthetic_sip(inbox / 'good', representations=1, mets_files=2, payload_files=2)
+    service = WatchService(inbox, tmp_path / 'outbox', tmp_path / 'quarantine', delete_processed=True, workers=1, settle_time=0, poll_interval=0.05,
+                           status_path=tmp_path / 'status.json', metrics_options={'metrics_path': tmp_path / 'metrics.jsonl'})
+
+    status = service.run(once=True)
+
+    assert status['completed'] == 1
+    assert not any(inbox.iterdir())
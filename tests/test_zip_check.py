@@ -0,0 +1,96 @@
+import os
+import sys
+import zipfile
+
+import pytest
+
+import zip_check
+from checksum import hash_file_digests
+from zip_check import ZIPFILE_INTERNALS, check_zip_file, get_decompressor
+from zip_transcode import HashingWriter
+
+
+MEMBERS = {
+    'deflated.txt': (zipfile.ZIP_DEFLATED, b'deflated member ' * 5000),
+    'stored.bin': (zipfile.ZIP_STORED, os.urandom(50000)),
+    'lzma.txt': (zipfile.ZIP_LZMA, b'lzma member ' * 5000),
+    'empty.txt': (zipfile.ZIP_DEFLATED, b''),
+}
+
+
+@pytest.fixture(autouse=True)
+def small_reads(monkeypatch):
+    # Members span several reads and segments
+    monkeypatch.setattr(zip_check, 'READ_SIZE', 4096)
+    monkeypatch.setattr(zip_check, 'SEGMENT_SIZE', 10000)
+
+
+def write_zip(zip_path, streamed:bool=False):
+    # streamed writes to an unseekable file, so every member is followed by a data descriptor
+    with open(zip_path, 'wb') as f:
+        with zipfile.ZipFile(HashingWriter(f) if streamed else f, 'w') as zip_file:
+            for name, (compress_type, data) in MEMBERS.items():
+                zip_info = zipfile.ZipInfo(name)
+                zip_info.compress_type = compress_type
+                with zip_file.open(zip_info, 'w') as member:
+                    member.write(data)
+    return zip_path
+
+
+def corrupt(zip_path, name:str):
+    # Flip a byte in the middle of a member's data
+    with zipfile.ZipFile(zip_path) as zip_file:
+        info = zip_file.getinfo(name)
+    data = bytearray(zip_path.read_bytes())
+    data[info.header_offset + 30 + len(info.filename.encode()) + len(info.extra) + info.compress_size // 2] ^= 0xff
+    zip_path.write_bytes(bytes(data))
+
+
+@pytest.mark.parametrize('name', ZIPFILE_INTERNALS)
+def test_zipfile_internals_are_there(name):
+    assert hasattr(zipfile, name), "zipfile of Python %s has no %s, zip_check.get_decompressor must be updated" % (sys.version.split()[0], name)
+
+
+def test_decompressors():
+    assert get_decompressor(zipfile.ZIP_STORED) is None
+    for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+        assert hasattr(get_decompressor(compress_type), 'decompress')
+    with pytest.raises(NotImplementedError):
+        get_decompressor(99)
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_valid_zip(tmp_path, streamed):
+    zip_path = write_zip(tmp_path / 'valid.zip', streamed)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert all(bool(info.flag_bits & 0x08) == streamed for info in zip_file.infolist())
+
+    report = check_zip_file(zip_path, ['sha256', 'md5'], workers=2)
+
+    assert report['errors'] == []
+    assert (report['members'], report['unchecked'], report['bytes']) == (len(MEMBERS), 0, zip_path.stat().st_size)
+    assert report['digests'] == hash_file_digests(zip_path, ['sha256', 'md5'])
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+@pytest.mark.parametrize('name', ['deflated.txt', 'stored.bin', 'lzma.txt'])
+def test_corrupt_member(tmp_path, streamed, name):
+    zip_path = write_zip(tmp_path / 'corrupt.zip', streamed)
+    corrupt(zip_path, name)
+
+    report = check_zip_file(zip_path, ['sha256'], workers=2)
+
+    assert [error['member'] for error in report['errors']] == [name]
+    assert report['digests'] == hash_file_digests(zip_path, ['sha256'])
+
+
+def test_truncated_zip(tmp_path):
+    zip_path = write_zip(tmp_path / 'truncated.zip')
+    zip_path.write_bytes(zip_path.read_bytes()[:-100])
+
+    report = check_zip_file(zip_path, ['sha256'])
+
+    assert [error['member'] for error in report['errors']] == [None]
+    assert report['errors'][0]['error'].startswith('central directory')
+    assert report['digests'] == hash_file_digests(zip_path, ['sha256'])
+
@@ -0,0 +1,87 @@
+import io
+import sys
+import zipfile
+
+import py7zr
+import pytest
+
+import zip_transcode
+from checksum import hash_file_digests
+from zip_transcode import ZIPFILE_INTERNALS, HashingWriter, PrecompressedZipFile, compress_member, transcode_7z_to_zip
+
+
+@pytest.mark.parametrize('name', ZIPFILE_INTERNALS)
+def test_zipfile_internals_are_there(name):
+    with PrecompressedZipFile(io.BytesIO(), 'w') as zip_file:
+        assert hasattr(zip_file, name), "zipfile.ZipFile of Python %s has no %s, PrecompressedZipFile must be updated" % (sys.version.split()[0], name)
+
+
+@pytest.mark.parametrize('seekable', [True, False])
+def test_precompressed_members_read_back(seekable):
+    output = io.BytesIO()
+    with PrecompressedZipFile(output if seekable else HashingWriter(output), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('first.txt', b'streamed ' * 100)
+        for name, compress_type in [('deflated.txt', zipfile.ZIP_DEFLATED), ('stored.jpg', zipfile.ZIP_STORED)]:
+            zip_info = zipfile.ZipInfo(name)
+            zip_info.compress_type = compress_type
+            data = name.encode() * 1000
+            zip_file.write_compressed(zip_info, *compress_member(data, compress_type), len(data))
+        zip_file.writestr('last.txt', b'')
+
+    with zipfile.ZipFile(output) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == ['first.txt', 'deflated.txt', 'stored.jpg', 'last.txt']
+        assert zip_file.read('deflated.txt') == b'deflated.txt' * 1000
+        assert zip_file.read('stored.jpg') == b'stored.jpg' * 1000
+        assert not zip_file.getinfo('deflated.txt').flag_bits & 0x08
+
+
+def test_write_compressed_is_checked_like_other_members():
+    zip_file = PrecompressedZipFile(io.BytesIO(), 'w')
+    with zip_file.open('open.txt', 'w'):
+        with pytest.raises(ValueError):
+            zip_file.write_compressed(zipfile.ZipInfo('other.txt'), b'', 0, 0)
+    zip_file.close()
+    with pytest.raises(ValueError):
+        zip_file.write_compressed(zipfile.ZipInfo('closed.txt'), b'', 0, 0)
+
+
+def test_7z_is_transcoded(tmp_path):
+    archive_path = tmp_path / 'in.7z'
+    with py7zr.SevenZipFile(archive_path, 'w') as archive:
+        archive.writestr(b'a' * 5000, 'docs/a.txt')
+        archive.writestr(b'\xff\xd8' + bytes(range(256)) * 20, 'docs/b.jpg')
+        archive.writestr(b'', 'empty.txt')
+
+    digests = transcode_7z_to_zip(archive_path, tmp_path / 'out.zip', store_compressed=True, workers=2, algorithms=['sha256'])
+
+    assert digests == hash_file_digests(tmp_path / 'out.zip', ['sha256'])
+    with zipfile.ZipFile(tmp_path / 'out.zip') as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read('docs/a.txt') == b'a' * 5000
+        assert zip_file.read('docs/b.jpg') == b'\xff\xd8' + bytes(range(256)) * 20
+        assert zip_file.getinfo('docs/b.jpg').compress_type == zipfile.ZIP_STORED
+        assert zip_file.read('empty.txt') == b''
+
+
+def test_failed_transcode_leaves_no_zip(tmp_path, monkeypatch):
+    archive_path = tmp_path / 'in.7z'
+    with py7zr.SevenZipFile(archive_path, 'w') as archive:
+        for index in range(5):
+            archive.writestr(b'member %d ' % index * 1000, 'docs/%d.txt' % index)
+    (tmp_path / 'out.zip').write_bytes(b'previous zip')
+    members = []
+
+    def failing_compress_member(data, compress_type):
+        # Fails the transcode after some members are written
+        members.append(data)
+        if len(members) == 3:
+            raise OSError('No space left on device')
+        return compress_member(data, compress_type)
+    monkeypatch.setattr(zip_transcode, 'compress_member', failing_compress_member)
+
+    with pytest.raises(OSError):
+        transcode_7z_to_zip(archive_path, tmp_path / 'out.zip', workers=1)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['in.7z', 'out.zip']
+    assert (tmp_path / 'out.zip').read_bytes() == b'previous zip'
@@ -0,0 +1,227 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from urllib.parse import unquote
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from checksum import CHECKSUM_ALGORITHMS, hash_file
+from sip_to_eark_aip import require_values, split_options
+
+
+# Check the fixity of existing AIPs against the SIZE and CHECKSUM attributes in their METS
+
+METS_NAMESPACE = 'http://www.loc.gov/METS/'
+XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+
+
+def mets_files(mets_path:Path) -> list:
+    # Every file in a METS with its FLocat, parsed incrementally so large METS aren't held in memory
+    # Returns [{'path', 'size', 'checksum', 'algorithm'}], paths resolved against the METS directory
+    files = []
+    file_tag, flocat_tag = '{%s}file' % METS_NAMESPACE, '{%s}FLocat' % METS_NAMESPACE
+    for _, element in ET.iterparse(mets_path, events=('end',)):
+        if element.tag != file_tag:
+            continue
+        flocat = element.find(flocat_tag)
+        href = flocat.get('{%s}href' % XLINK_NAMESPACE) if flocat is not None else None
+        if href is not None:
+            files.append({
+                'path': (mets_path.parent / unquote(href)),
+                'size': int(element.get('SIZE')) if element.get('SIZE', '').isdigit() else None,
+                'checksum': element.get('CHECKSUM'),
+                'algorithm': element.get('CHECKSUMTYPE'),
+            })
+        element.clear()
+    return files
+
+
+def collect_files(aip_path:Path):
+    # Yields the files of the root METS and of every METS it references, e.g. the representation METS
+    mets_paths = [(aip_path / 'METS.xml')]
+    seen = set()
+    while mets_paths:
+        mets_path = mets_paths.pop(0)
+        if mets_path in seen:
+            continue
+        seen.add(mets_path)
+        for entry in mets_files(mets_path):
+            yield entry
+            if entry['path'].name == 'METS.xml' and entry['path'].is_file():
+                mets_paths.append(entry['path'])
+
+
+def check_file(entry:dict) -> str:
+    # Cheap checks before hashing, returns the failure or None
+    try:
+        size = os.stat(entry['path']).st_size
+    except FileNotFoundError:
+        return 'missing'
+    if entry['size'] is not None and size != entry['size']:
+        return 'size %d, expected %d' % (size, entry['size'])
+    if entry['checksum'] and entry['algorithm'] not in CHECKSUM_ALGORITHMS:
+        return "unsupported checksum type '%s'" % entry['algorithm']
+    entry['actual_size'] = size
+    return None
+
+
+class Progress:
+    # Files and bytes verified so far, written to stderr at most once a second
+    # AIPs are read as they're verified, so the totals aren't known in advance
+    def __init__(self, quiet:bool=False):
+        self.quiet = quiet
+        self.done_files = 0
+        self.done_bytes = 0
+        self.started = time.perf_counter()
+        self.reported = 0
+        self.lock = threading.Lock()
+
+    def update(self, size:int):
+        with self.lock:
+            self.done_files += 1
+            self.done_bytes += size
+            now = time.perf_counter()
+            if not self.quiet and now - self.reported >= 1:
+                self.reported = now
+                self.write()
+
+    def write(self):
+        sys.stderr.write("\rVerified %d files, %.1f MB, %.1f MB/s" % (self.done_files, self.done_bytes / 1e6, self.throughput() / 1e6))
+        sys.stderr.flush()
+
+    def throughput(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.done_bytes / elapsed if elapsed > 0 else 0.0
+
+
+def finish_report(report:dict) -> dict:
+    report['failures'].sort(key=lambda failure: failure['path'])
+    report['passed'] = report['passed'] and not report['failures']
+    logging.info("Verified '%s': %s, %d files, %d failures" % (report['aip'], 'passed' if report['passed'] else 'FAILED', report['files'], len(report['failures'])))
+    return report
+
+
+def verify_aips(aip_paths, workers:int=None, quiet:bool=False):
+    # Verify many AIPs, hashing the files of all of them on one thread pool to keep the storage busy
+    # AIPs are read one after another and at most a few files per thread are queued for hashing, so memory doesn't grow
+    # with the number of AIPs. Yields the report of each AIP as soon as its last file is verified, in the order they finish
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) * 4)
+    max_pending = 4 * workers
+    progress = Progress(quiet)
+    started = time.perf_counter()
+    # {future: (report, state, entry)}, state is [files of the AIP being hashed, whether its METS have been read completely]
+    pending = {}
+
+    def verify(entry:dict) -> str:
+        checksum = hash_file(entry['path'], CHECKSUM_ALGORITHMS[entry['algorithm']])
+        progress.update(entry['actual_size'])
+        return checksum
+
+    def collect(return_when) -> list:
+        # Record the hashed files, returns the reports that are complete
+        done, _ = wait(pending, return_when=return_when)
+        finished = []
+        for future in done:
+            report, state, entry = pending.pop(future)
+            try:
+                checksum = future.result()
+            except OSError as e:
+                report['failures'].append({'path': str(entry['path']), 'error': str(e)})
+            else:
+                report['verified'] += 1
+                report['bytes'] += entry['actual_size']
+                if checksum.lower() != entry['checksum'].lower():
+                    report['failures'].append({'path': str(entry['path']), 'error': 'checksum mismatch', 'expected': entry['checksum'], 'actual': checksum})
+            state[0] -= 1
+            if state == [0, True]:
+                finished.append(finish_report(report))
+        return finished
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for aip_path in aip_paths:
+            report = {'aip': str(aip_path), 'passed': True, 'files': 0, 'verified': 0, 'unchecked': 0, 'bytes': 0, 'failures': []}
+            if not (aip_path / 'METS.xml').is_file():
+                report['passed'] = False
+                report['failures'].append({'path': str(aip_path / 'METS.xml'), 'error': 'missing'})
+                yield finish_report(report)
+                continue
+            state = [0, False]
+            try:
+                for entry in collect_files(aip_path):
+                    report['files'] += 1
+                    error = check_file(entry)
+                    if error is not None:
+                        report['failures'].append({'path': str(entry['path']), 'error': error})
+                    elif not entry['checksum']:
+                        report['unchecked'] += 1
+                    else:
+                        while len(pending) >= max_pending:
+                            yield from collect(FIRST_COMPLETED)
+                        pending[executor.submit(verify, entry)] = (report, state, entry)
+                        state[0] += 1
+            except ET.ParseError as e:
+                report['passed'] = False
+                report['failures'].append({'path': str(aip_path), 'error': 'METS not readable: %s' % e})
+            state[1] = True
+            if state == [0, True]:
+                yield finish_report(report)
+        while pending:
+            yield from collect(FIRST_COMPLETED)
+    if not quiet and progress.done_files:
+        progress.write()
+        sys.stderr.write('\n')
+
+    elapsed = time.perf_counter() - started
+    logging.info("Verified %d files, %d bytes in %.1fs (%.1f MB/s)" % (progress.done_files, progress.done_bytes, elapsed, progress.done_bytes / elapsed / 1e6 if elapsed > 0 else 0.0))
+
+
+def find_aips(paths:list) -> list:
+    # A directory without a METS.xml is treated as a directory of AIPs
+    aip_paths = []
+    for path in paths:
+        if path.is_dir() and not (path / 'METS.xml').is_file():
+            aip_paths.extend(sorted(p for p in path.iterdir() if p.is_dir()))
+        else:
+            aip_paths.append(path)
+    return aip_paths
+
+
+def main(argv) -> bool:
+    # Prints a line per AIP as it's verified, returns whether all of them passed
+    Path("logs").mkdir(exist_ok=True)
+    logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    argv, options = split_options(argv)
+    if len(argv) < 1:
+        logging.error("Incorrect script call format")
+        sys.exit("Command should have the form:\npython verify_aip.py [--workers=N] [--report=<Report File>] [--quiet] <AIP Directory>...")
+    require_values(options, ['workers', 'report'])
+
+    aip_paths = find_aips([Path(arg) for arg in argv])
+    passed = True
+    # The report file is written as the AIPs are verified, a JSON array of the reports
+    report_file = open(options['report'], 'w') if 'report' in options else None
+    try:
+        if report_file is not None:
+            report_file.write('[')
+        for index, report in enumerate(verify_aips(aip_paths, int(options['workers']) if 'workers' in options else None, bool(options.get('quiet')))):
+            print("%s\t%s\t%d files\t%d failures" % (report['aip'], 'PASS' if report['passed'] else 'FAIL', report['files'], len(report['failures'])), flush=True)
+            if report_file is not None:
+                report_file.write((',\n' if index else '\n') + json.dumps(report, indent=4))
+            passed = passed and report['passed']
+        if report_file is not None:
+            report_file.write('\n]\n')
+    finally:
+        if report_file is not None:
+            report_file.close()
+    return passed
+
+
+if __name__ == '__main__':
+    if not main(sys.argv[1:]):
+        sys.exit(1)
@@ -0,0 +1,359 @@
+from collections import deque
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import ctypes
+import ctypes.util
+import json
+import logging
+import mimetypes
+import os
+import select
+import shutil
+import signal
+import sys
+import time
+
+from batch_sip_to_eark_aip import convert_sip
+from checksum import set_algorithms
+from journal import unfinished_aips
+from metrics import DEFAULT_METRICS_PATH
+from package_output import PACKAGE_FORMATS
+from rollback_aip import rollback
+from sip_to_eark_aip import process_pool, require_values, split_options, validate_conversion_options
+from xml_backend import set_backend
+
+
+# Watch an inbox for SIPs and convert them on a pool of worker processes kept running between SIPs
+# AIPs are built in a work directory and moved to the outbox when complete, failed SIPs are moved to quarantine
+# Converted SIPs are kept in a processed directory, <inbox>/.processed by default, unless deleting them is asked for
+# A SIP that brings its worker process down is quarantined too, and the pool is started again for the others
+
+DEFAULT_STATUS_PATH = Path('logs') / 'watch_status.json'
+
+# inotify events on the inbox that may mean a new or changed SIP
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+class InboxWatcher:
+    # Waits for changes in the inbox with inotify, or just sleeps between polls where inotify isn't available
+    # Only the inbox itself is watched, SIPs still being written are checked on every poll until they settle
+
+    def __init__(self, inbox_path:Path):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if libc.inotify_add_watch(fd, os.fsencode(inbox_path), IN_WATCH_MASK) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self.fd = fd
+        except (OSError, AttributeError) as e:
+            logging.info("inotify not available (%s), polling '%s'" % (e, inbox_path))
+
+    def mode(self) -> str:
+        return 'inotify' if self.fd is not None else 'polling'
+
+    def wait(self, timeout:float):
+        # Returns after timeout seconds, or earlier if something changed in the inbox
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def sip_signature(sip_path:Path) -> tuple[int, int, int]:
+    # (files, bytes, latest mtime) of everything under sip_path, unchanged once the SIP is fully written
+    files = size = latest = 0
+    for dir_path, _, file_names in os.walk(sip_path):
+        latest = max(latest, os.stat(dir_path).st_mtime_ns)
+        for file_name in file_names:
+            try:
+                stat = os.stat(os.path.join(dir_path, file_name))
+            except FileNotFoundError:
+                continue
+            files += 1
+            size += stat.st_size
+            latest = max(latest, stat.st_mtime_ns)
+    return files, size, latest
+
+
+def unique_path(directory:Path, name:str) -> Path:
+    # directory/name, with a number appended if it's taken
+    path = (directory / name)
+    number = 1
+    while path.exists():
+        path = (directory / ("%s-%d" % (name, number)))
+        number += 1
+    return path
+
+
+def warm_worker():
+    # Runs once in each worker process, the shell's Ctrl+C is handled by the service, not the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    mimetypes.init()
+
+
+class WatchService:
+    # options are passed on to transform_sip_to_aip, metrics_options to metrics.PackageMetrics (plus metrics_path)
+
+    def __init__(self, inbox_path:Path, outbox_path:Path, quarantine_path:Path, work_path:Path=None, processed_path:Path=None, delete_processed:bool=False,
+                 workers:int=None, settle_time:float=5.0, poll_interval:float=1.0, status_path:Path=DEFAULT_STATUS_PATH, metrics_options:dict=None, **options):
+        self.inbox_path = inbox_path
+        self.outbox_path = outbox_path
+        self.quarantine_path = quarantine_path
+        self.work_path = work_path if work_path is not None else (outbox_path / '.work')
+        self.processed_path = processed_path if processed_path is not None else (inbox_path / '.processed')
+        self.delete_processed = delete_processed
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.status_path = status_path
+        self.metrics_options = metrics_options
+        self.options = options
+        self.stopping = False
+
+        # {sip path: (signature, time the signature last changed, time first seen)}
+        self.waiting = {}
+        # (sip path, time first seen, bytes)
+        self.queued = deque()
+        # {future: (sip path, time first seen, bytes)}
+        self.running = {}
+        # SIPs taken from the inbox, so they aren't picked up again while they're moved out of it
+        self.taken = set()
+        # SIPs that were running alongside others when a worker died, they're converted on their own to find the one that did it
+        self.suspects = set()
+
+        self.started = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.latencies = []
+
+    def stop(self, signal_number=None, frame=None):
+        logging.info("Stopping, waiting for %d running conversions" % len(self.running))
+        self.stopping = True
+
+    def scan_inbox(self):
+        # Track new SIPs and queue the ones that haven't changed for settle_time
+        now = time.time()
+        for sip_path in sorted(self.inbox_path.iterdir()):
+            if sip_path.name.startswith('.') or sip_path in self.taken or not sip_path.is_dir():
+                continue
+            signature = sip_signature(sip_path)
+            if sip_path not in self.waiting:
+                self.waiting[sip_path] = (signature, now, now)
+                continue
+            last_signature, changed, seen = self.waiting[sip_path]
+            if signature != last_signature:
+                self.waiting[sip_path] = (signature, now, seen)
+            elif now - changed >= self.settle_time:
+                del self.waiting[sip_path]
+                self.taken.add(sip_path)
+                self.queued.append((sip_path, seen, signature[1]))
+        # SIPs removed from the inbox before they settled
+        for sip_path in [p for p in self.waiting if not p.exists()]:
+            del self.waiting[sip_path]
+
+    def finish(self, sip_path:Path, seen:float, size:int, success:bool, message:str):
+        # Move the AIP to the outbox and the SIP out of the inbox, or the SIP to quarantine
+        if success:
+            output_name = message + PACKAGE_FORMATS[self.options['package_format']] if self.options.get('package_format') else message
+            output_path = unique_path(self.outbox_path, output_name)
+            # The work directory can be on another filesystem, the AIP is moved under a hidden name so it only appears in the outbox complete
+            temporary_path = (self.outbox_path / ('.' + output_path.name + '.tmp'))
+            shutil.move((self.work_path / output_name), temporary_path)
+            os.replace(temporary_path, output_path)
+            if self.delete_processed:
+                shutil.rmtree(sip_path)
+            else:
+                shutil.move(sip_path, unique_path(self.processed_path, sip_path.name))
+            self.completed += 1
+            self.bytes += size
+            logging.info("Converted '%s' to '%s'" % (sip_path, output_path))
+        else:
+            # An unfinished AIP can't be resumed once its SIP has moved
+            sip = str(sip_path.resolve())
+            rollback(self.work_path, [aip_name for aip_name, aip_sip in unfinished_aips(self.work_path).items() if aip_sip == sip])
+            quarantined_path = unique_path(self.quarantine_path, sip_path.name)
+            shutil.move(sip_path, quarantined_path)
+            quarantined_path.with_name(quarantined_path.name + '.error').write_text(message + '\n', encoding='utf-8')
+            self.failed += 1
+            logging.error("Failed to convert '%s', moved to '%s': %s" % (sip_path, quarantined_path, message))
+        self.taken.discard(sip_path)
+        self.suspects.discard(sip_path)
+        self.latencies.append(time.time() - seen)
+
+    def can_submit(self) -> bool:
+        # Whether the next queued SIP can be started, suspects only run while no other SIP does
+        if not self.queued or len(self.running) >= self.workers:
+            return False
+        if not self.running:
+            return True
+        return self.queued[0][0] not in self.suspects and not any(sip_path in self.suspects for sip_path, _, _ in self.running.values())
+
+    def worker_died(self, crashed:list):
+        # crashed - (sip path, time first seen, bytes) of the SIPs that were running when a worker process died
+        # The SIP is quarantined if it was the only one running, otherwise they're all queued again to run on their own
+        if len(crashed) == 1:
+            sip_path, seen, size = crashed[0]
+            self.finish(sip_path, seen, size, False, "The worker process converting it died")
+            return
+        logging.warning("A worker process died converting one of %s, converting them one at a time" % ', '.join("'%s'" % sip_path for sip_path, _, _ in crashed))
+        for sip in reversed(crashed):
+            self.suspects.add(sip[0])
+            self.queued.appendleft(sip)
+
+    def status(self, watcher:InboxWatcher) -> dict:
+        uptime = time.time() - self.started
+        latencies = self.latencies[-100:]
+        return {
+            'pid': os.getpid(),
+            'inbox': str(self.inbox_path),
+            'watching': watcher.mode(),
+            'workers': self.workers,
+            'started': self.started,
+            'updated': time.time(),
+            'stopping': self.stopping,
+            'waiting': len(self.waiting),
+            'queued': len(self.queued),
+            'running': sorted(str(sip_path) for sip_path, _, _ in self.running.values()),
+            'completed': self.completed,
+            'failed': self.failed,
+            # Seconds from a SIP first being seen in the inbox to its AIP being in the outbox, over the last 100 SIPs
+            'latency': {
+                'last': self.latencies[-1] if self.latencies else None,
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'max': max(latencies) if latencies else None,
+            },
+            'throughput': {
+                'sips_per_hour': (self.completed + self.failed) / uptime * 3600 if uptime > 0 else 0.0,
+                'bytes_per_second': self.bytes / uptime if uptime > 0 else 0.0,
+            },
+        }
+
+    def write_status(self, watcher:InboxWatcher):
+        temporary_path = self.status_path.with_name(self.status_path.name + '.tmp')
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(self.status(watcher), f, indent=4)
+        os.replace(temporary_path, self.status_path)
+
+    def run(self, once:bool=False) -> dict:
+        # Convert SIPs until stopped, or with once until the inbox is empty
+        # Returns the final status
+        for path in (self.outbox_path, self.quarantine_path, self.work_path):
+            path.mkdir(parents=True, exist_ok=True)
+        if not self.delete_processed:
+            self.processed_path.mkdir(parents=True, exist_ok=True)
+        self.status_path.parent.mkdir(parents=True, exist_ok=True)
+
+        watcher = InboxWatcher(self.inbox_path)
+        logging.info("Watching '%s' (%s) with %d workers" % (self.inbox_path, watcher.mode(), self.workers))
+        executor = process_pool(self.workers, warm_worker)
+        try:
+            while True:
+                if not self.stopping:
+                    self.scan_inbox()
+                    while self.can_submit():
+                        sip_path, seen, size = self.queued.popleft()
+                        future = executor.submit(convert_sip, sip_path, self.work_path, self.options, self.metrics_options)
+                        self.running[future] = (sip_path, seen, size)
+
+                done = [f for f in self.running if f.done()]
+                if any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+                    # Every running conversion fails with the pool, wait for all of them before starting a new one
+                    wait(self.running)
+                    done = list(self.running)
+                crashed = []
+                for future in done:
+                    sip = self.running.pop(future)
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        crashed.append(sip)
+                    else:
+                        success, message = future.result()
+                        self.finish(*sip, success, message)
+                if crashed:
+                    executor.shutdown()
+                    executor = process_pool(self.workers, warm_worker)
+                    self.worker_died(crashed)
+
+                self.write_status(watcher)
+                if not self.running and (self.stopping or (once and not self.waiting and not self.queued)):
+                    break
+                watcher.wait(self.poll_interval)
+        finally:
+            executor.shutdown()
+            watcher.close()
+        return self.status(watcher)
+
+
+def main(argv) -> dict:
+    Path("logs").mkdir(exist_ok=True)
+    logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    argv, options = split_options(argv)
+    if len(argv) != 3:
+        logging.error("Incorrect script call format")
+        sys.exit("Command should have the form:\npython watch_sip_to_eark_aip.py [--workers=N] [--settle=<Seconds>] [--poll=<Seconds>] [--status=<Status File>] [--work=<Work Directory>] [--processed=<Processed SIP Directory>] [--delete-processed] [--once] "
+                 "[--copy=<Strategy>] [--streaming] [--package=<Format>] [--manifest] [--verify] [--rep-workers=N] [--copy-workers=N] [--dedup=<Store Directory>] [--digests=<Algorithm>,...] [--xml=<Backend>] [--metrics=<Metrics File>] [--profile] [--trace-memory] <Inbox Directory> <Outbox Directory> <Quarantine Directory>")
+
+    inbox_path, outbox_path, quarantine_path = (Path(arg) for arg in argv)
+    if not inbox_path.is_dir():
+        sys.exit('Fatal Error: ' + str(inbox_path) + " is not a directory")
+
+    validate_conversion_options(options)
+    require_values(options, ['settle', 'poll', 'status', 'work', 'processed'])
+    if 'processed' in options and options.get('delete-processed'):
+        sys.exit('Fatal Error: --processed and --delete-processed are exclusive')
+
+    if 'xml' in options:
+        # process_pool passes the backend on to the worker processes
+        try:
+            set_backend(options['xml'])
+        except ValueError as e:
+            sys.exit('Fatal Error: ' + str(e))
+
+    if 'digests' in options:
+        # Like the XML backend, the algorithms are passed on to the workers
+        try:
+            set_algorithms(str(options['digests']).split(','))
+        except ValueError as e:
+            sys.exit('Fatal Error: ' + str(e))
+
+    metrics_options = {
+        'metrics_path': options.get('metrics', DEFAULT_METRICS_PATH),
+        'profile': bool(options.get('profile')),
+        'trace_memory': bool(options.get('trace-memory')),
+    }
+
+    service = WatchService(inbox_path, outbox_path, quarantine_path, Path(options['work']) if 'work' in options else None, Path(options['processed']) if 'processed' in options else None,
+                           bool(options.get('delete-processed')), int(options.get('workers', os.cpu_count())), float(options.get('settle', 5)), float(options.get('poll', 1)), Path(options.get('status', DEFAULT_STATUS_PATH)), metrics_options,
+                           copy_strategy=options.get('copy', 'copy'), streaming=bool(options.get('streaming')), manifest=bool(options.get('manifest')), verify=bool(options.get('verify')),
+                           package_format=options.get('package'), rep_workers=int(options.get('rep-workers', 1)),
+                           copy_workers=int(options['copy-workers']) if 'copy-workers' in options else None,
+                           dedup_path=Path(options['dedup']) if 'dedup' in options else None)
+    signal.signal(signal.SIGTERM, service.stop)
+    signal.signal(signal.SIGINT, service.stop)
+    return service.run(bool(options.get('once')))
+
+
+if __name__ == '__main__':
+    status = main(sys.argv[1:])
+    print("%d converted, %d failed" % (status['completed'], status['failed']))
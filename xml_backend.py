@@ -0,0 +1,105 @@
+from pathlib import Path
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+from xml_rewrite import INDENT
+
+
+# Parse, build and write whole XML trees (METS, DC.xml) with ElementTree or, if it's selected, lxml
+# lxml parses and serializes in C, which is much faster on large METS. It writes the same elements, attributes, XML declaration,
+# indentation and ' />' closing empty elements as ElementTree, but keeps the namespace prefixes of the parsed document,
+# so it's opt-in and ElementTree's output stays the default
+# The streaming rewrite in xml_rewrite always uses ElementTree
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+
+
+class ElementTreeBackend:
+    name = 'etree'
+    Element = staticmethod(ET.Element)
+    SubElement = staticmethod(ET.SubElement)
+
+    def parse(self, path:Path):
+        return ET.parse(path)
+
+    def indent(self, tree):
+        ET.indent(tree, space=INDENT, level=0)
+
+    def tostring(self, tree, namespaces:dict=None) -> bytes:
+        # Prefixes are the ones registered with ET.register_namespace, namespaces is only used by lxml
+        return ET.tostring(tree.getroot(), encoding='utf-8', xml_declaration=True)
+
+    def write(self, tree, path:Path, namespaces:dict=None):
+        tree.write(path, encoding='utf-8', xml_declaration=True)
+
+
+class LxmlBackend:
+    name = 'lxml'
+
+    def __init__(self):
+        self.Element = lxml_etree.Element
+        self.SubElement = lxml_etree.SubElement
+
+    def parse(self, path:Path):
+        # Comments and processing instructions are dropped like ElementTree does, entities aren't loaded
+        # Parsers can't be shared between threads, so there's one per document
+        parser = lxml_etree.XMLParser(remove_comments=True, remove_pis=True, resolve_entities=False, no_network=True, huge_tree=True)
+        return lxml_etree.parse(str(path), parser)
+
+    def indent(self, tree):
+        lxml_etree.indent(tree, space=INDENT, level=0)
+
+    def unqualify_attributes(self, tree, uri:str):
+        # ElementTree writes attributes in the default namespace without a prefix, which leaves them in no namespace
+        for attribute in tree.xpath('//@*[namespace-uri() = $uri]', uri=uri):
+            element = attribute.getparent()
+            items = list(element.attrib.items())
+            element.attrib.clear()
+            for key, value in items:
+                element.set(key.split('}', 1)[1] if key == attribute.attrname else key, value)
+
+    def tostring(self, tree, namespaces:dict=None) -> bytes:
+        # namespaces {prefix: uri} as registered with ElementTree, '' being the default namespace
+        # Prefixes are kept as declared in the parsed document, moving the elements to rebind them costs more than lxml saves
+        if namespaces and namespaces.get(''):
+            self.unqualify_attributes(tree, namespaces[''])
+        # New elements declare the namespaces of their attributes themselves, e.g. ns0 for METS, which aren't used once
+        # the attributes are unqualified. ElementTree only declares namespaces that are used, and can't read ns0 prefixes back
+        lxml_etree.cleanup_namespaces(tree)
+        # '/>' can only be the end of an empty element, '>' is escaped in text and attribute values
+        return XML_DECLARATION + lxml_etree.tostring(tree.getroot(), encoding='utf-8').replace(b'/>', b' />')
+
+    def write(self, tree, path:Path, namespaces:dict=None):
+        data = self.tostring(tree, namespaces)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+XML_BACKENDS = {
+    'etree': ElementTreeBackend,
+    'lxml': LxmlBackend,
+}
+DEFAULT_BACKEND = 'etree'
+
+ELEMENT_TREE = ElementTreeBackend()
+_backend = None
+
+
+def set_backend(name:str):
+    global _backend
+    if name not in XML_BACKENDS:
+        raise ValueError("XML backend must be one of: " + ', '.join(XML_BACKENDS))
+    if name == 'lxml' and lxml_etree is None:
+        raise ValueError("The lxml XML backend needs the lxml package")
+    _backend = XML_BACKENDS[name]()
+
+
+def get_backend():
+    # The backend set with set_backend, ElementTree by default
+    if _backend is None:
+        set_backend(DEFAULT_BACKEND)
+    return _backend
@@ -0,0 +1,248 @@
+from collections import ChainMap
+from pathlib import Path
+import os
+import xml.etree.ElementTree as ET
+
+
+# Rewrite XML documents element by element
+#
+# A rewrite is described by two handlers, called in document order:
+#   start(element, path) -> bool   called with the element's attributes, return False to drop the element
+#   end(element, path) -> list     called after the element's children, return new children to append
+# where path is the tuple of tags from the root element to the element.
+#
+# rewrite_tree applies the handlers to a parsed tree. rewrite_streaming applies them while parsing
+# and writes the result as it goes, only keeping the currently open elements in memory. The output of
+# rewrite_streaming matches ET.indent(tree, space=INDENT) followed by tree.write(...).
+#
+# walk_tree and walk_streaming call the same handlers without changing or writing anything,
+# for collecting information in a first pass. The return value of end is ignored.
+
+INDENT = '    '
+
+
+def escape_cdata(text:str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def escape_attrib(text:str) -> str:
+    text = escape_cdata(text).replace('"', '&quot;')
+    return text.replace('\r', '&#13;').replace('\n', '&#10;').replace('\t', '&#09;')
+
+
+def rewrite_tree(root:ET.Element, start, end):
+    def visit(element:ET.Element, path:tuple):
+        for child in list(element):
+            child_path = path + (child.tag,)
+            if start(child, child_path) is False:
+                # Cleared first, lxml would otherwise keep the removed subtree valid on its own
+                child.clear()
+                element.remove(child)
+                continue
+            visit(child, child_path)
+        element.extend(end(element, path) or [])
+
+    root_path = (root.tag,)
+    start(root, root_path)
+    visit(root, root_path)
+
+
+def walk_tree(root:ET.Element, start, end):
+    def visit(element:ET.Element, path:tuple):
+        for child in element:
+            child_path = path + (child.tag,)
+            if start(child, child_path) is False:
+                continue
+            visit(child, child_path)
+        end(element, path)
+
+    root_path = (root.tag,)
+    start(root, root_path)
+    visit(root, root_path)
+
+
+def walk_streaming(source:Path, start, end, start_ns=None):
+    stack = []
+    skip_depth = 0
+    for event, item in ET.iterparse(source, events=['start-ns', 'start', 'end']):
+        if event == 'start-ns':
+            if start_ns is not None:
+                start_ns(*item)
+            continue
+
+        element = item
+        if skip_depth:
+            skip_depth += 1 if event == 'start' else -1
+            if not skip_depth:
+                stack[-1][0].remove(element)
+            continue
+
+        if event == 'start':
+            path = (stack[-1][1] if stack else ()) + (element.tag,)
+            if start(element, path) is False:
+                skip_depth = 1
+                continue
+            stack.append((element, path))
+            continue
+
+        end(element, stack.pop()[1])
+        # Free finished elements
+        if stack:
+            stack[-1][0].remove(element)
+
+
+class StreamingWriter:
+    # Serializes elements like ElementTree's writer with indentation applied
+
+    def __init__(self, file, namespaces:dict):
+        self.file = file
+        # Namespaces declared on the root element, may still be filled in until the root is written
+        self.root_namespaces = namespaces
+        # {uri: prefix} of namespaces in scope
+        self.scope = ChainMap()
+        self.generated_prefixes = 0
+
+    def qualify(self, tag:str, declarations:dict) -> str:
+        if tag[:1] != '{':
+            return tag
+        uri, local = tag[1:].split('}', 1)
+        prefix = self.scope.get(uri)
+        if prefix is None:
+            # Namespace not declared on the root element, declare it here
+            prefix = ET._namespace_map.get(uri)
+            while prefix is None or prefix in self.scope.values():
+                prefix = 'ns%d' % self.generated_prefixes
+                self.generated_prefixes += 1
+            self.scope[uri] = prefix
+            declarations[prefix] = uri
+        return '%s:%s' % (prefix, local) if prefix else local
+
+    def start_tag(self, element:ET.Element, is_root:bool=False) -> str:
+        if is_root:
+            self.scope = ChainMap({uri: prefix for prefix, uri in self.root_namespaces.items()})
+        self.scope = self.scope.new_child()
+        declarations = dict(self.root_namespaces) if is_root else {}
+        tag = self.qualify(element.tag, declarations)
+        attributes = [(self.qualify(key, declarations), value) for key, value in element.items()]
+        self.file.write('<' + tag)
+        for prefix, uri in sorted(declarations.items()):
+            self.file.write(' xmlns%s="%s"' % (':' + prefix if prefix else '', escape_attrib(uri)))
+        for key, value in attributes:
+            self.file.write(' %s="%s"' % (key, escape_attrib(value)))
+        return tag
+
+    def end_scope(self):
+        self.scope = self.scope.parents
+
+    def write_text(self, text:str, indentation:str):
+        # Whitespace only text is replaced with indentation, as ET.indent does
+        self.file.write(escape_cdata(text) if text and text.strip() else indentation)
+
+    def write_element(self, element:ET.Element, level:int):
+        # Serialize a complete element
+        tag = self.start_tag(element)
+        if len(element):
+            self.file.write('>')
+            self.write_text(element.text, '\n' + INDENT * (level + 1))
+            for index, child in enumerate(element):
+                self.write_element(child, level + 1)
+                self.write_text(child.tail, '\n' + INDENT * (level if index == len(element) - 1 else level + 1))
+            self.file.write('</%s>' % tag)
+        elif element.text:
+            self.file.write('>%s</%s>' % (escape_cdata(element.text), tag))
+        else:
+            self.file.write(' />')
+        self.end_scope()
+
+
+class _OpenElement:
+    def __init__(self, element:ET.Element, path:tuple):
+        self.element = element
+        self.path = path
+        self.level = len(path) - 1
+        # Start tag is written when the first child or the end is reached
+        self.tag = None
+        self.opened = False
+        self.last_child = None
+
+
+def rewrite_streaming(source:Path, destination:Path, start, end, start_ns=None):
+    # start_ns(prefix, uri) -> (prefix, uri) maps namespace declarations found while parsing
+    namespaces = {}
+    stack = []
+    skip_depth = 0
+
+    with open(destination, 'w', encoding='utf-8', errors='xmlcharrefreplace') as file:
+        file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        writer = StreamingWriter(file, namespaces)
+
+        def open_child(parent:_OpenElement):
+            child_indentation = '\n' + INDENT * (parent.level + 1)
+            if not parent.opened:
+                parent.tag = writer.start_tag(parent.element, is_root=not parent.level)
+                file.write('>')
+                writer.write_text(parent.element.text, child_indentation)
+                parent.opened = True
+            else:
+                writer.write_text(parent.last_child.tail, child_indentation)
+            parent.last_child = None
+
+        for event, item in ET.iterparse(source, events=['start-ns', 'start', 'end']):
+            if event == 'start-ns':
+                prefix, uri = start_ns(*item) if start_ns is not None else item
+                # A namespace whose uri was changed isn't used by the document, only declare it where used
+                if not stack and uri == item[1]:
+                    namespaces[prefix] = uri
+                continue
+
+            element = item
+            if skip_depth:
+                skip_depth += 1 if event == 'start' else -1
+                if not skip_depth:
+                    stack[-1].element.remove(element)
+                continue
+
+            if event == 'start':
+                path = (stack[-1].path if stack else ()) + (element.tag,)
+                if start(element, path) is False:
+                    skip_depth = 1
+                    continue
+                if stack:
+                    open_child(stack[-1])
+                stack.append(_OpenElement(element, path))
+                continue
+
+            current = stack.pop()
+            for new_child in end(element, current.path) or []:
+                open_child(current)
+                writer.write_element(new_child, current.level + 1)
+                current.last_child = new_child
+            if current.opened:
+                writer.write_text(current.last_child.tail, '\n' + INDENT * current.level)
+                file.write('</%s>' % current.tag)
+            else:
+                tag = writer.start_tag(element, is_root=not stack)
+                if element.text:
+                    file.write('>%s</%s>' % (escape_cdata(element.text), tag))
+                else:
+                    file.write(' />')
+            writer.end_scope()
+
+            # Only the tail is needed from here, free the rest of the element
+            if stack:
+                stack[-1].last_child = element
+                stack[-1].element.remove(element)
+                del element[:]
+                element.attrib.clear()
+                element.text = None
+
+
+def rewrite_file_streaming(path:Path, start, end, start_ns=None):
+    # Rewrite a file in place through a temporary file
+    temporary_path = path.with_name(path.name + '.tmp')
+    try:
+        rewrite_streaming(path, temporary_path, start, end, start_ns)
+        os.replace(temporary_path, path)
+    finally:
+        if temporary_path.exists():
+            temporary_path.unlink()
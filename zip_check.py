@@ -0,0 +1,196 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import logging
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+from checksum import MultiHash
+
+
+# Integrity check of a zip in one sequential read, fused with computing its digests
+# The central directory is read by zipfile, then the file is read from start to end: every byte is hashed, and the data of
+# every member is decompressed and checked against the CRC-32 and size in the central directory on a thread pool.
+# Segments of a member are checked in order, different members concurrently
+
+# Bytes read at a time
+READ_SIZE = 1024 * 1024
+# Compressed bytes of a member checked in one task
+SEGMENT_SIZE = 4 * 1024 * 1024
+# Bytes decompressed at a time, so a member with a very high compression ratio doesn't fill the memory
+DECOMPRESS_SIZE = 16 * 1024 * 1024
+
+# Local file header as in the zip specification (APPNOTE.TXT 4.3.7): signature, versions, flags, compression, time, date,
+# CRC-32, sizes, file name length and extra field length
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+LOCAL_HEADER_FILENAME_LENGTH = 10
+LOCAL_HEADER_EXTRA_FIELD_LENGTH = 11
+ZLIB_DECOMPRESS = type(zlib.decompressobj())
+
+# zipfile internals used here, tests/test_zip_check.py checks the running Python still has them
+ZIPFILE_INTERNALS = ['_get_decompressor']
+
+
+def get_decompressor(compress_type:int):
+    # zipfile's own decompressors, incl. its LZMA header handling, the only private zipfile API used here
+    # Raises NotImplementedError for compression methods zipfile doesn't support
+    return zipfile._get_decompressor(compress_type)
+
+
+class _MemberCheck:
+    # Check of one member, fed its compressed data in order
+
+    def __init__(self, info:zipfile.ZipInfo):
+        self.info = info
+        self.header = bytearray()
+        self.header_size = None
+        self.data_start = None
+        self.fed = 0
+        self.crc = 0
+        self.size = 0
+        self.error = None
+        self.checked = not info.flag_bits & 0x1
+        self.decompressor = None
+        if not self.checked:
+            return
+        try:
+            self.decompressor = get_decompressor(info.compress_type)
+        except NotImplementedError as e:
+            self.error = str(e)
+
+    def add_header(self, data:bytes) -> bytes:
+        # Collect the local file header, returns the rest of data once it's complete
+        self.header += data
+        if self.header_size is None and len(self.header) >= LOCAL_HEADER.size:
+            fields = LOCAL_HEADER.unpack(self.header[:LOCAL_HEADER.size])
+            if fields[0] != LOCAL_HEADER_SIGNATURE:
+                self.error = self.error or 'bad local file header'
+            self.header_size = LOCAL_HEADER.size + fields[LOCAL_HEADER_FILENAME_LENGTH] + fields[LOCAL_HEADER_EXTRA_FIELD_LENGTH]
+        if self.header_size is None or len(self.header) < self.header_size:
+            return b''
+        rest = bytes(self.header[self.header_size:])
+        self.data_start = self.info.header_offset + self.header_size
+        self.header = None
+        return rest
+
+    def feed(self, data:bytes, previous, last:bool):
+        # Runs on the thread pool, after the previous segment of the member
+        if previous is not None:
+            previous.result()
+        if self.error is not None or not self.checked:
+            return
+        try:
+            if self.decompressor is None:
+                self.update(data)
+            elif isinstance(self.decompressor, ZLIB_DECOMPRESS):
+                output = self.decompressor.decompress(data, DECOMPRESS_SIZE)
+                self.update(output)
+                while self.decompressor.unconsumed_tail:
+                    self.update(self.decompressor.decompress(self.decompressor.unconsumed_tail, DECOMPRESS_SIZE))
+            else:
+                self.update(self.decompressor.decompress(data))
+            if last:
+                self.finish()
+        except Exception as e:
+            self.error = 'decompression error: %s' % e
+
+    def update(self, data:bytes):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+    def finish(self):
+        if self.size != self.info.file_size:
+            self.error = 'size %d, expected %d' % (self.size, self.info.file_size)
+        elif self.crc != self.info.CRC:
+            self.error = 'CRC %08x, expected %08x' % (self.crc, self.info.CRC)
+        elif self.decompressor is not None and getattr(self.decompressor, 'eof', True) is False:
+            self.error = 'compressed data ends early'
+
+
+def check_zip_file(zip_path:Path, algorithms:list=None, workers:int=None) -> dict:
+    # Returns {'path', 'members', 'unchecked', 'errors': [{'member', 'error'}], 'bytes', 'seconds', 'digests'}
+    # member is None for errors of the zip itself. The digests of the whole file are computed even if it's corrupt
+    if workers is None:
+        workers = os.cpu_count() or 1
+    started = time.perf_counter()
+    errors = []
+    try:
+        with zipfile.ZipFile(zip_path) as zip_file:
+            infos = sorted(zip_file.infolist(), key=lambda info: info.header_offset)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, ValueError) as e:
+        errors.append({'member': None, 'error': 'central directory: %s' % e})
+        infos = []
+    members = deque(_MemberCheck(info) for info in infos)
+    checks = list(members)
+
+    file_hash = MultiHash(algorithms)
+    position = 0
+    pending = deque()
+    max_pending = 2 * workers
+    with open(zip_path, 'rb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        # (member, segment, future of the member's previous segment)
+        segment = (None, bytearray(), None)
+
+        def submit(member:_MemberCheck, data:bytes, previous, last:bool):
+            future = executor.submit(member.feed, data, previous, last)
+            pending.append(future)
+            while len(pending) > max_pending:
+                pending.popleft().result()
+            return future
+
+        for data in iter(lambda: f.read(READ_SIZE), b''):
+            file_hash.update(data)
+            chunk_start = position
+            position += len(data)
+            while members:
+                member = members[0]
+                if member.data_start is None:
+                    # Collecting the local header
+                    start = max(member.info.header_offset, chunk_start)
+                    if start >= position:
+                        break
+                    rest = member.add_header(data[start - chunk_start:])
+                    if member.data_start is None:
+                        break
+                    chunk_start, data = member.data_start, rest
+                end = member.data_start + member.info.compress_size
+                start = max(member.data_start + member.fed, chunk_start)
+                if start < min(end, position):
+                    piece = data[start - chunk_start:min(end, position) - chunk_start]
+                    member.fed += len(piece)
+                    _, buffer, previous = segment if segment[0] is member else (member, bytearray(), None)
+                    buffer += piece
+                    segment = (member, buffer, previous)
+                    if len(buffer) >= SEGMENT_SIZE:
+                        segment = (member, bytearray(), submit(member, bytes(buffer), previous, False))
+                if member.data_start + member.fed < end:
+                    break
+                # The member's data is complete
+                _, buffer, previous = segment if segment[0] is member else (member, bytearray(), None)
+                submit(member, bytes(buffer), previous, True)
+                segment = (None, bytearray(), None)
+                members.popleft()
+        for future in pending:
+            future.result()
+
+    for member in members:
+        member.error = member.error or 'truncated'
+    for member in checks:
+        if member.error is not None:
+            errors.append({'member': member.info.filename, 'error': member.error})
+    seconds = time.perf_counter() - started
+    report = {
+        'path': str(zip_path),
+        'members': len(checks),
+        'unchecked': sum(1 for member in checks if not member.checked),
+        'errors': errors,
+        'bytes': position,
+        'seconds': seconds,
+        'digests': file_hash.hexdigests(),
+    }
+    logging.info("Checked '%s': %d members, %d errors, %d bytes in %.2fs (%.1f MB/s)" % (zip_path, report['members'], len(errors), position, seconds, position / seconds / 1e6 if seconds > 0 else 0.0))
+    return report
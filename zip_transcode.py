@@ -0,0 +1,242 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os
+import zipfile
+import zlib
+
+import py7zr
+from py7zr.io import Py7zIO, WriterFactory
+
+from checksum import MultiHash
+
+
+# Members up to this size are buffered and compressed on the thread pool, larger members are streamed
+PARALLEL_MEMBER_SIZE = 8 * 1024 * 1024
+
+# Formats that are already compressed, stored as is when store_compressed is set
+COMPRESSED_SUFFIXES = {
+    '.zip', '.7z', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.jp2',
+    '.mp3', '.mp4', '.m4a', '.mkv', '.mov', '.avi', '.webm',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+}
+
+
+class HashingWriter:
+    # Write-only, unseekable file wrapper hashing everything written with every algorithm
+    # zipfile writes data descriptors instead of seeking back, so every byte is written once
+
+    def __init__(self, file, algorithms:list=None):
+        self.file = file
+        self.hash = MultiHash(algorithms)
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.hash.update(data)
+        self.file.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def seekable(self) -> bool:
+        return False
+
+    def seek(self, *args):
+        raise OSError("HashingWriter is not seekable")
+
+    def flush(self):
+        self.file.flush()
+
+    def hexdigests(self) -> dict:
+        return self.hash.hexdigests()
+
+
+def compress_member(data:bytes, compress_type:int) -> tuple[bytes, int]:
+    # Runs on the thread pool, zlib releases the GIL
+    crc = zlib.crc32(data)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return data, crc
+
+
+# ZipFile attributes PrecompressedZipFile relies on, tests/test_zip_transcode.py checks the running Python still has them
+ZIPFILE_INTERNALS = ['fp', 'filelist', 'NameToInfo', 'start_dir', '_lock', '_writing', '_seekable', '_allowZip64', '_didModify', '_writecheck']
+
+
+class PrecompressedZipFile(zipfile.ZipFile):
+    # ZipFile that can also write members compressed elsewhere, e.g. on a thread pool
+    # zipfile has no public way to do that, this is the only place using its internals
+
+    def write_compressed(self, zip_info:zipfile.ZipInfo, data:bytes, crc:int, size:int):
+        # Write a member whose data was already compressed with zip_info.compress_type
+        # Checked like ZipFile.open(zip_info, 'w'): the archive is open, no member is being written, and _writecheck's
+        # duplicate name, compression and zip64 checks
+        with self._lock:
+            if not self.fp:
+                raise ValueError("Attempt to write to ZIP archive that was already closed")
+            if self._writing:
+                raise ValueError("Can't write to the ZIP file while there is another write handle open on it")
+            zip_info.CRC = crc
+            zip_info.file_size = size
+            zip_info.compress_size = len(data)
+            # Sizes and CRC are known, so they go in the local header rather than a data descriptor
+            zip_info.flag_bits &= ~0x08
+            zip64 = max(size, len(data)) > zipfile.ZIP64_LIMIT
+            if zip64 and not self._allowZip64:
+                raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            zip_info.header_offset = self.fp.tell()
+            self._writecheck(zip_info)
+            self._didModify = True
+            self.fp.write(zip_info.FileHeader(zip64))
+            self.fp.write(data)
+            self.start_dir = self.fp.tell()
+            self.filelist.append(zip_info)
+            self.NameToInfo[zip_info.filename] = zip_info
+
+
+class _MemberWriter(Py7zIO):
+    # Receives one decompressed 7z member
+
+    def __init__(self, transcoder, name:str):
+        self.transcoder = transcoder
+        self.zip_info = transcoder.zip_info(name)
+        self.streamed = transcoder.member_size(name) is None or transcoder.member_size(name) > PARALLEL_MEMBER_SIZE
+        self.buffer = bytearray()
+        self.zip_member = None
+        self.length = 0
+
+    def write(self, s) -> int:
+        if self.streamed:
+            if self.zip_member is None:
+                self.zip_member = self.transcoder.open_member(self.zip_info)
+            self.zip_member.write(s)
+        else:
+            self.buffer += s
+        self.length += len(s)
+        return len(s)
+
+    def read(self, size=None) -> bytes:
+        return b''
+
+    def seek(self, offset:int, whence:int=0) -> int:
+        raise OSError("Member writer is not seekable")
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self):
+        pass
+
+    def size(self) -> int:
+        return self.length
+
+    def close(self):
+        if self.streamed:
+            if self.zip_member is None:
+                self.zip_member = self.transcoder.open_member(self.zip_info)
+            self.zip_member.close()
+        else:
+            self.transcoder.add_buffered(self.zip_info, bytes(self.buffer))
+            self.buffer = bytearray()
+        self.transcoder.written.add(self.zip_info.filename)
+
+
+class _ZipTranscoder(WriterFactory):
+    # Writes 7z members into a zip as py7zr decompresses them, in archive order
+    # Small members are compressed concurrently and written in order, large members are streamed
+
+    def __init__(self, zip_file:PrecompressedZipFile, executor:ThreadPoolExecutor, infos:dict, store_compressed:bool, max_pending:int):
+        self.zip_file = zip_file
+        self.executor = executor
+        self.infos = infos
+        self.store_compressed = store_compressed
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.written = set()
+
+    def create(self, filename:str) -> Py7zIO:
+        return _MemberWriter(self, filename)
+
+    def member_size(self, name:str):
+        info = self.infos.get(name)
+        return info.uncompressed if info is not None else None
+
+    def zip_info(self, name:str) -> zipfile.ZipInfo:
+        info = self.infos.get(name)
+        date_time = (1980, 1, 1, 0, 0, 0)
+        if info is not None and info.creationtime is not None and info.creationtime.year >= 1980:
+            date_time = info.creationtime.timetuple()[:6]
+        zip_info = zipfile.ZipInfo(name, date_time)
+        zip_info.external_attr = 0o644 << 16
+        if self.store_compressed and Path(name).suffix.lower() in COMPRESSED_SUFFIXES:
+            zip_info.compress_type = zipfile.ZIP_STORED
+        else:
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+        return zip_info
+
+    def add_buffered(self, zip_info:zipfile.ZipInfo, data:bytes):
+        future = self.executor.submit(compress_member, data, zip_info.compress_type)
+        self.pending.append((zip_info, len(data), future))
+        while len(self.pending) > self.max_pending:
+            self.write_pending(1)
+
+    def write_pending(self, count:int=None):
+        # Write finished members in order
+        while self.pending and (count is None or count > 0):
+            zip_info, size, future = self.pending.popleft()
+            data, crc = future.result()
+            self.zip_file.write_compressed(zip_info, data, crc, size)
+            if count is not None:
+                count -= 1
+
+    def open_member(self, zip_info:zipfile.ZipInfo):
+        # Keep member order - write earlier members before streaming this one
+        self.write_pending()
+        size = self.member_size(zip_info.filename) or 0
+        zip_info.file_size = size
+        return self.zip_file.open(zip_info, 'w', force_zip64=size > zipfile.ZIP64_LIMIT)
+
+    def finish(self):
+        self.write_pending()
+        # Members without data may not be passed to the factory
+        for name, info in self.infos.items():
+            if not info.is_directory and name not in self.written:
+                self.zip_file.writestr(self.zip_info(name), b'')
+
+
+def transcode_7z_to_zip(archive_path:Path, zip_path:Path, store_compressed:bool=False, workers:int=None, algorithms:list=None) -> dict:
+    # Transcode a 7z archive into a zip without extracting it to disk
+    # The zip is written under a temporary name next to it and renamed when complete, so a failed transcode
+    # never leaves a partial zip_path
+    # Returns the digests {algorithm: hex digest} of the written zip, all the set algorithms by default
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tmp_path = zip_path.with_name('.' + zip_path.name + '.tmp')
+    try:
+        # Passing a file object makes py7zr decompress members one after another, in archive order
+        with open(archive_path, 'rb') as archive_file, py7zr.SevenZipFile(archive_file, 'r') as archive:
+            infos = {info.filename: info for info in archive.list()}
+            with open(tmp_path, 'wb') as zip_output, ThreadPoolExecutor(max_workers=workers) as executor:
+                output = HashingWriter(zip_output, algorithms)
+                with PrecompressedZipFile(output, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zip_file:
+                    for name, info in infos.items():
+                        if info.is_directory:
+                            directory_info = zipfile.ZipInfo(name.rstrip('/') + '/')
+                            directory_info.external_attr = 0o40755 << 16 | 0x10
+                            zip_file.writestr(directory_info, b'')
+                    transcoder = _ZipTranscoder(zip_file, executor, infos, store_compressed, max_pending=2 * workers)
+                    archive.extractall(factory=transcoder)
+                    transcoder.finish()
+                zip_output.flush()
+                os.fsync(zip_output.fileno())
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return output.hexdigests()